@@ -143,10 +143,37 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         # 'rest_framework.authentication.BasicAuthentication',
         # 'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        # 'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ]
 }
 
+# Page sizes for the list endpoints when the client asks for cursor pagination (see api/pagination.py)
+API_DEFAULT_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 200
+# How many events are read and encoded at a time when a list is streamed (see api/streaming.py)
+API_STREAM_CHUNK_SIZE = 200
+# How often each worker checks whether its in-memory autocomplete index missed other processes' writes
+AUTOCOMPLETE_CHECK_SECONDS = 60
+# The shared cache for the public feeds (see api/caching.py)
+FEED_CACHE_MAX_ENTRIES = 256
+FEED_CACHE_SECONDS = 300
+FEED_CACHE_WINDOW_SECONDS = 60
+# How many days ahead each user's For You feed looks (see api/feeds.py)
+FOR_YOU_DAYS = 14
+# Serve getUpcoming, getEvent, search, getLikedEvents and getAllTags from api/async_views.py. Only worth it when
+# running under an ASGI server (GrinSync/asgi.py), since under WSGI each async view gets its own event loop
+ASYNC_READ_VIEWS = False
+# Store new repeating events as one row with a repeat rule instead of a row per occurrence (see api/recurrence.py)
+EVENT_REPEAT_RULES = False
+# How many checked auth tokens each worker remembers, and for how long (see api/authentication.py)
+AUTH_TOKEN_CACHE_MAX_ENTRIES = 1024
+AUTH_TOKEN_CACHE_SECONDS = 60
+# Where the scrape keeps the feed pages it last downloaded, to make conditional requests and for --replay
+SCRAPE_CACHE_DIR = BASE_DIR / 'scrape_cache'
+# Set to e.g. 0.9 for the scrape to also treat near identical titles at the same time as one event
+SCRAPE_FUZZY_TITLE_CUTOFF = None
+
 CSRF_USE_SESSIONS = False
 
 CSRF_TRUSTED_ORIGINS = ["https://grinsync.com"] # Needed for admin site for some reason?
@@ -160,6 +187,11 @@ EMAIL_TIMEOUT = 20
 DEFAULT_FROM_EMAIL = "info@grinsync.com"
 #EMAIL_HOST_USER in extra_settings
 #EMAIL_HOST_PASSWORD in extra_settings
+# Mail is queued and sent by the sendmail command (see api/outbox.py): how many to send at a time, and how often
+# (and how soon, doubling each time) to retry ones that fail
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_SECONDS = 60
 
 
 USE_X_FORWARDED_HOST = True
@@ -1,13 +1,32 @@
 from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
 import json
+import os
+import tempfile
 import time
-from django.test import TestCase
+from types import SimpleNamespace
+from django.core import mail
+from django.core.mail import get_connection
+from django.core.management import call_command
+from django.db import connection
+from asgiref.sync import async_to_sync
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from rest_framework.test import APIRequestFactory
 from rest_framework.authtoken import views as tokenViews
+from rest_framework.authtoken.models import Token
 from rest_framework.test import force_authenticate
+import api.async_views as asyncViews
+import api.versions as versions
 import api.views as views
-from api.models import User, Event, Tag
+from api import outbox
+from api.autocomplete import suggestions
+from api.aux_functions import bulkAddEventTags, bulkSetEventTags
+from api.locations import gazetteer
+from api.management.commands.scrape import DuplicateIndex, PageCache, feedPages, ingestFeed
+from api.models import User, Event, Location, Organization, OutboxEmail, Tag
 
 # Django REST framework extends the standard RequestFactory to support API calls
 factory = APIRequestFactory()
@@ -150,3 +169,682 @@ class APITestCase(TestCase):
         response = views.getEvent(getRequest)
         assert response.status_code == 200
         assert json.loads(response.content)['title'] != 'New Title!' # And that there's no effect
+
+    def testListQueryCountIsConstant(self):
+        """ Tests that serializing a list of events doesn't issue queries per event or per tag """
+        def countQueries():
+            request = factory.get('/api/upcoming/', {'tags':'ALL'})
+            force_authenticate(request, user=self.user1, token=self.token1)
+            with CaptureQueriesContext(connection) as queries:
+                response = views.getUpcoming(request)
+            assert response.status_code == 200
+            return len(queries), len(json.loads(response.content))
+
+        baseCount, baseEvents = countQueries()
+        for i in range(10):
+            extraTag = Tag.objects.create(name = f"Extra Tag {i}")
+            event = Event.objects.create(host=self.user2, title=f"Extra Event {i}", start=self.time,
+                                         end=self.time + timedelta(hours=1), studentsOnly=False)
+            event.tags.add(self.tag, extraTag)
+            self.user1.likedEvents.add(event)
+        newCount, newEvents = countQueries()
+        assert newEvents == baseEvents + 10
+        assert newCount == baseCount
+
+    def testCursorPagination(self):
+        """ Tests that paging through getAll returns every event once, in order """
+        self.event1.tags.add(self.tag)
+        self.event2.tags.add(self.tag)
+        for i in range(3):
+            event = Event.objects.create(host=self.user2, title=f"Paged Event {i}", start=self.time + timedelta(days=i),
+                                         end=self.time + timedelta(days=i, hours=1), studentsOnly=False)
+            event.tags.add(self.tag)
+
+        def pages(pageSize):
+            seen = []
+            params = {'pageSize': pageSize}
+            while True:
+                request = factory.get('/api/getAll/', params)
+                force_authenticate(request, user=self.user1, token=self.token1)
+                response = views.getAll(request)
+                assert response.status_code == 200
+                page = json.loads(response.content)
+                assert len(page['results']) <= pageSize
+                seen.extend(page['results'])
+                if not page['next']:
+                    return seen
+                params = {'pageSize': pageSize, 'cursor': page['next']}
+
+        seen = [event['id'] for event in pages(2)]
+        assert len(seen) == 5
+        assert seen == sorted(seen, key=lambda eid: (Event.objects.get(pk=eid).start, eid))
+
+        # Occurrences of a series stored as a rule are paged through along with the rows
+        series = Event.objects.create(host=self.user2, title="Every Other Day", studentsOnly=False, repeatDays=2,
+                                      start=self.time - timedelta(days=3), end=self.time - timedelta(days=3, hours=-1),
+                                      repeatUntil=self.time + timedelta(days=120))
+        series.tags.add(self.tag)
+        request = factory.get('/api/getAll/')
+        force_authenticate(request, user=self.user1, token=self.token1)
+        everything = json.loads(views.getAll(request).content)
+        assert len(everything) == 5 + 62
+        for pageSize in [1, 3, 50]:
+            assert [(event['id'], event['occurrenceStart']) for event in pages(pageSize)] == \
+                   [(event['id'], event['occurrenceStart']) for event in everything]
+
+        request = factory.get('/api/getAll/', {'cursor': 'not a cursor'})
+        response = views.getAll(request)
+        assert response.status_code == 400
+
+    def testStreamedFeedMatchesRegularFeed(self):
+        """ Tests that streaming getUpcoming returns the same events as the normal response """
+        self.event1.tags.add(self.tag)
+        self.event2.tags.add(self.tag)
+        request = factory.get('/api/upcoming/', {'tags':'ALL'})
+        force_authenticate(request, user=self.user1, token=self.token1)
+        expected = json.loads(views.getUpcoming(request).content)
+
+        request = factory.get('/api/upcoming/', {'tags':'ALL', 'stream':'true'})
+        force_authenticate(request, user=self.user1, token=self.token1)
+        response = views.getUpcoming(request)
+        assert response.status_code == 200
+        assert response.streaming
+        assert json.loads(b''.join(response.streaming_content)) == expected
+
+    def testSearch(self):
+        """ Tests that search finds events by their title, description and tags, and keeps up with edits """
+        self.event2.description = "Free pizza in the courtyard"
+        self.event2.save()
+        self.event2.tags.add(self.tag)
+
+        def searchIds(query, user=None):
+            request = factory.get('/api/search/', {'query': query})
+            if user:
+                force_authenticate(request, user=user)
+            response = views.search(request)
+            assert response.status_code == 200
+            return [event['id'] for event in json.loads(response.content)]
+
+        assert searchIds("pizza") == [self.event2.id]
+        assert searchIds("interest") == [self.event2.id] # Prefix of the tag name
+        assert set(searchIds("testing", self.user1)) == {self.event1.id, self.event2.id}
+        assert searchIds("testing") == [self.event2.id] # Student only events stay hidden
+
+        for limit in [0, -1]: # (LIMIT -1 would mean no limit at all to SQLite)
+            for search in [views.search, async_to_sync(asyncViews.search)]:
+                assert search(factory.get('/api/search/', {'query': "testing", 'limit': limit})).status_code == 400
+
+        self.user2.first_name = "Zelda"
+        self.user2.save()
+        assert searchIds("zelda") == [self.event2.id] # By the host's new name
+
+        self.event2.title = "Renamed Event"
+        self.event2.save()
+        assert searchIds("testing") == []
+        self.event2.delete()
+        assert searchIds("pizza") == []
+
+    def testAutocomplete(self):
+        """ Tests that autocomplete handles prefixes and typos, and keeps up with new events """
+        suggestions.rebuild() # The index is per process, so start from this test's database
+        Event.objects.create(host=self.user2, title="Open Mic Night", location="Joe Rosenfield Center 101",
+                             start=self.time, end=self.time + timedelta(hours=1), studentsOnly=False)
+
+        def suggest(query, user=None, **params):
+            request = factory.get('/api/autocomplete/', {'query': query, **params})
+            if user:
+                force_authenticate(request, user=user)
+            response = views.autocomplete(request)
+            assert response.status_code == 200
+            return json.loads(response.content)
+
+        assert suggest("rosenfeld")['locations'] == ["Joe Rosenfield Center 101"] # Typo
+        assert suggest("open mi")['events'][0]['title'] == "Open Mic Night" # Prefix
+        assert len(suggest("testing")['events']) == 1 # Student only events are hidden
+        assert len(suggest("testing", self.user1)['events']) == 2
+        assert suggest("xyzzy") == {'events': [], 'orgs': [], 'locations': []}
+        assert len(suggest("testing", self.user1, limit=1)['events']) == 1
+        for limit in [0, -1]:
+            request = factory.get('/api/autocomplete/', {'query': "testing", 'limit': limit})
+            assert views.autocomplete(request).status_code == 400
+
+        # Changes made by other processes get picked up once the versions show them
+        Event.objects.filter(pk = self.event2.pk).update(title = "Poetry Slam")
+        versions.bump(versions.EVENTS)
+        assert suggestions.rebuildIfChanged()
+        assert not suggestions.rebuildIfChanged()
+        assert suggest("poetr")['events'][0]['title'] == "Poetry Slam"
+
+    def testEventsInRange(self):
+        """ Tests that range queries return exactly the events overlapping the window """
+        longEvent = Event.objects.create(host=self.user2, title="Art Exhibit", start=self.time - timedelta(days=20),
+                                         end=self.time + timedelta(days=20), studentsOnly=False)
+        Event.objects.create(host=self.user2, title="Last Month", start=self.time - timedelta(days=40),
+                             end=self.time - timedelta(days=40, hours=-1), studentsOnly=False)
+
+        def rangeIds(params, user=None):
+            request = factory.get('/api/getEventsInRange/', params)
+            if user:
+                force_authenticate(request, user=user)
+            response = views.getEventsInRange(request)
+            assert response.status_code == 200
+            return {event['id'] for event in json.loads(response.content)}
+
+        window = {'from': (self.time - timedelta(days=1)).isoformat(), 'to': (self.time + timedelta(days=1)).isoformat()}
+        assert rangeIds(window) == {self.event2.id, longEvent.id}
+        assert rangeIds(window, self.user1) == {self.event1.id, self.event2.id, longEvent.id}
+        assert rangeIds({**window, 'studentsOnly': 'true'}, self.user1) == {self.event1.id}
+        assert rangeIds({**window, 'tags': 'Interesting Events'}) == set()
+
+        request = factory.get('/api/getEventsInDay/', {'start': self.time.isoformat()})
+        response = views.getEventsInDay(request)
+        assert response.status_code == 200
+        assert {event['id'] for event in json.loads(response.content)} == {self.event2.id, longEvent.id}
+
+        request = factory.get('/api/getEventsInRange/', {'from': window['to'], 'to': window['from']})
+        assert views.getEventsInRange(request).status_code == 400
+
+        # An even longer event from another process (so no signals here) is found once the version moves
+        farBack = Event.objects.bulk_create([Event(host=self.user2, title="Semester Long", studentsOnly=False,
+                                                   start=self.time - timedelta(days=100),
+                                                   end=self.time + timedelta(days=10))])[0]
+        versions.bump(versions.EVENTS)
+        assert farBack.id in rangeIds(window)
+
+    def testFeedCache(self):
+        """ Tests that cached feeds still show each user's favorites and pick up changes """
+        self.event1.tags.add(self.tag)
+        self.event2.tags.add(self.tag)
+        self.user2.likedEvents.add(self.event2)
+
+        def upcoming(user):
+            request = factory.get('/api/upcoming/', {'tags':'ALL'})
+            force_authenticate(request, user=user)
+            response = views.getUpcoming(request)
+            assert response.status_code == 200
+            return {event['id']: event for event in json.loads(response.content)}
+
+        assert upcoming(self.user2)[self.event2.id]['isFavorited'] is True
+        with self.assertNumQueries(2): # The version stamps and the favorites, the feed comes from the cache
+            assert upcoming(self.user2)[self.event2.id]['isFavorited'] is True
+        other = User.objects.create_user(username="third", password="thirdtest", type = 'COM')
+        with self.assertNumQueries(2): # Someone else with the same tags and audience shares the cached feed
+            assert upcoming(other)[self.event2.id]['isFavorited'] is False
+
+        self.event2.title = "Changed Title"
+        self.event2.save()
+        assert upcoming(other)[self.event2.id]['title'] == "Changed Title"
+
+        # Changes made by another process (no signals here) show up as soon as its version is bumped
+        Event.objects.filter(pk = self.event2.pk).update(title = "Changed Elsewhere")
+        versions.bump(versions.EVENTS)
+        assert upcoming(other)[self.event2.id]['title'] == "Changed Elsewhere"
+        request = factory.get('/api/getAll/')
+        force_authenticate(request, user=other)
+        assert views.getAll(request).status_code == 200 # Cache it
+        Event.objects.filter(pk = self.event2.pk).update(title = "Changed Again")
+        versions.bump(versions.EVENTS)
+        request = factory.get('/api/getAll/')
+        force_authenticate(request, user=other)
+        assert "Changed Again" in [event['title'] for event in json.loads(views.getAll(request).content)]
+
+    def testConditionalGet(self):
+        """ Tests that polling endpoints answer 304 until their data changes """
+        request = factory.get('/api/getAllTags/')
+        response = views.getTags(request)
+        assert response.status_code == 200
+        etag = response['ETag']
+
+        request = factory.get('/api/getAllTags/', HTTP_IF_NONE_MATCH=etag)
+        with self.assertNumQueries(1): # Just the version lookup
+            response = views.getTags(request)
+        assert response.status_code == 304
+
+        Tag.objects.create(name = "New Tag")
+        request = factory.get('/api/getAllTags/', HTTP_IF_NONE_MATCH=etag)
+        response = views.getTags(request)
+        assert response.status_code == 200
+        assert len(json.loads(response.content)) == 2
+
+        # Like a tag made by another process, which just bumps the version. The cached body mustn't outlive it
+        etag = response['ETag']
+        Tag.objects.bulk_create([Tag(name = "Scraped Tag")])
+        versions.bump(versions.TAGS)
+        for getTags in [views.getTags, async_to_sync(asyncViews.getTags)]:
+            response = getTags(factory.get('/api/getAllTags/', HTTP_IF_NONE_MATCH=etag))
+            assert response.status_code == 200
+            assert len(json.loads(response.content)) == 3
+
+        request = factory.get('/api/getLikedEvents/')
+        force_authenticate(request, user=self.user1)
+        etag = views.getLikedEvents(request)['ETag']
+        self.user1.likedEvents.add(self.event2)
+        request = factory.get('/api/getLikedEvents/', HTTP_IF_NONE_MATCH=etag)
+        force_authenticate(request, user=self.user1)
+        response = views.getLikedEvents(request)
+        assert response.status_code == 200
+
+        def likedEventsStatus(etag):
+            request = factory.get('/api/getLikedEvents/', HTTP_IF_NONE_MATCH=etag)
+            force_authenticate(request, user=self.user1)
+            response = views.getLikedEvents(request)
+            return response.status_code, response['ETag']
+
+        # They show their tags' names, and can be unliked from the event's side too
+        self.event2.tags.add(self.tag)
+        status, etag = likedEventsStatus(etag)
+        assert status == 200
+        self.tag.name = "Renamed Tag"
+        self.tag.save()
+        status, etag = likedEventsStatus(etag)
+        assert status == 200
+        assert likedEventsStatus(etag)[0] == 304
+        self.event2.likedUsers.clear()
+        assert likedEventsStatus(etag)[0] == 200
+
+    def testTagResolution(self):
+        """ Tests that tag names resolve through the shared map, including tags created after it was loaded """
+        def updateTags(tags):
+            request = factory.post('/api/updateInterestedTags/', {'tags': tags})
+            force_authenticate(request, user=self.user1)
+            return views.updateInterestedTags(request)
+
+        assert updateTags("Interesting Events;Not A Tag").status_code == 400
+        assert list(self.user1.interestedTags.all()) == [self.tag] # Left alone after a bad request
+
+        request = factory.post('/api/create/tag/', {'name': 'Brand New'})
+        force_authenticate(request, user=User.objects.create_superuser(username="staff", password="stafftest"))
+        assert views.createTag(request).status_code == 200
+        assert updateTags("Interesting Events;Brand New").status_code == 200
+        assert set(self.user1.interestedTags.values_list('name', flat=True)) == {"Interesting Events", "Brand New"}
+
+    def testCachedTokenAuthentication(self):
+        """ Tests that token checks are cached, and that deactivating or logging out takes effect right away """
+        token = Token.objects.create(user = self.user1)
+        def getUser():
+            request = factory.get('/api/getUser', HTTP_AUTHORIZATION = f"Token {token.key}")
+            return views.getUser(request)
+
+        assert getUser().status_code == 200
+        with CaptureQueriesContext(connection) as queries:
+            response = getUser()
+        assert response.status_code == 200
+        assert json.loads(response.content)['id'] == self.user1.pk
+        assert not any('authtoken_token' in query['sql'] for query in queries.captured_queries)
+
+        self.user1.is_active = False
+        self.user1.save()
+        assert getUser().status_code == 401
+        self.user1.is_active = True
+        self.user1.save()
+        assert getUser().status_code == 200
+        token.delete()
+        assert getUser().status_code == 401
+
+    def testScrapeIngest(self):
+        """ Tests that the scrape upserts its events in bulk, leaves claimed ones alone, spots rain locations, and skips
+        items that haven't changed """
+        moderator = User.objects.create_user(username="moderator", password="moderatortest")
+        def feedItem(liveWhaleID, title, location, description = "", tags = None):
+            return {'id': liveWhaleID, 'title': title, 'date_utc': "2030-04-01 17:00:00", 'date2_utc': None,
+                    'location_title': location, 'location': None, 'location_latitude': None,
+                    'location_longitude': None, 'description': description, 'tags': tags, 'event_types': None}
+
+        ingestFeed([feedItem(1, "Concert", "JRC 101"), feedItem(2, "Lecture", "Noyce", tags = ['Lectures'])])
+        concert, lecture = Event.objects.get(liveWhaleID = 1), Event.objects.get(liveWhaleID = 2)
+        assert concert.host == moderator and concert.lat is not None # Found in the common locations
+        assert list(lecture.tags.values_list('name', flat=True)) == ["Lectures"]
+
+        concert.host = self.user1 # Claimed
+        concert.save()
+        feed = [feedItem(1, "Renamed Concert", "JRC 101"), feedItem(2, "Lecture", "Noyce", "Updated"),
+                feedItem(3, "Picnic", "Central Park"), feedItem(4, "Picnic", "Harris", " rain "), feedItem(5, "", "")]
+        with CaptureQueriesContext(connection) as queries:
+            counts = ingestFeed(feed)
+        assert len(queries) < 22 # Doesn't grow with the feed (two of them keep the For You feeds up to date)
+        assert counts == {'inserted': 1, 'updated': 2, 'unchanged': 0, 'skipped': 2}
+        assert Event.objects.get(pk = concert.pk).title == "Concert"
+        assert Event.objects.get(pk = lecture.pk).description == "Updated"
+        picnic = Event.objects.get(title = "Picnic") # The second listing is a rain location for the first
+        assert picnic.liveWhaleID == 3 and picnic.location == "Central Park" and "Harris" in picnic.description
+        assert ingestFeed(feed) == {'inserted': 0, 'updated': 0, 'unchanged': 3, 'skipped': 2} # Fingerprints match
+
+    def testScrapeReplay(self):
+        """ Tests that the scrape can ingest a saved feed without going online """
+        User.objects.create_user(username="moderator", password="moderatortest")
+        feed = {'data': [{'id': 7, 'title': "Film Night", 'date_utc': "2030-04-01 01:00:00", 'date2_utc': None,
+                          'location_title': "Harris Cinema", 'location': None, 'location_latitude': None,
+                          'location_longitude': None, 'description': None, 'tags': None, 'event_types': None}]}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'feed.json')
+            with open(path, 'w', encoding='utf-8') as file:
+                json.dump(feed, file)
+            output = StringIO()
+            call_command('scrape', replay=path, stdout=output)
+        assert "1 inserted" in output.getvalue()
+        assert Event.objects.get(liveWhaleID = 7).title == "Film Night"
+
+        # A saved directory replays just the pages the last scrape found, not ones left over from longer feeds
+        with tempfile.TemporaryDirectory() as directory:
+            cache = PageCache(directory)
+            for page in [1, 2, 3]: # Page 3 was prefetched, but the feed ended at 2
+                item = {**feed['data'][0], 'id': 7 + page, 'title': f"Film Night {page}"}
+                cache.write(page, f"page {page}", SimpleNamespace(content = json.dumps({'data': [item]}).encode(),
+                                                                  headers = {}))
+            cache.commit(2)
+            assert sorted(os.listdir(directory)) == ['page-1.json', 'page-2.json', 'validators.json']
+            assert set(PageCache(directory).validators) == {'1', '2'}
+            output = StringIO()
+            call_command('scrape', replay=directory, stdout=output)
+        assert "2 inserted" in output.getvalue()
+        assert not Event.objects.filter(liveWhaleID = 10).exists()
+
+    def testFeedPages(self):
+        """ Tests that the feed's pages come out in order however the downloads finish, and stop at the last page """
+        def stubFetch(pages):
+            requested = []
+            def fetch(_session, page, _pageSize, _cache):
+                requested.append(page)
+                time.sleep(0.01 * (page % 3)) # So they finish out of order
+                return pages.get(page, {'data': []}), page != 2
+            return fetch, requested
+
+        # The feed says how many pages there are
+        pages = {page: {'meta': {'total_pages': 3}, 'data': [page] * 2} for page in [1, 2, 3]}
+        fetch, requested = stubFetch(pages)
+        assert list(feedPages(2, workers = 2, fetch = fetch)) == [([1, 1], True), ([2, 2], False), ([3, 3], True)]
+        assert max(requested) <= 2 * 2 # Nothing past what was prefetched before page 1 told us
+
+        # Or it just ends with a page that isn't full
+        pages = {1: {'data': [1, 1]}, 2: {'data': [2]}, 3: {'data': [3, 3]}}
+        fetch, requested = stubFetch(pages)
+        assert list(feedPages(2, workers = 2, fetch = fetch)) == [([1, 1], True), ([2], False)]
+
+    def testDuplicateIndex(self):
+        """ Tests that the scrape's duplicate detection ignores formatting, and optionally small title edits """
+        event = Event(title = "Film Night: Alien", start = self.time, end = self.time + timedelta(hours = 2))
+        for fuzzyCutoff in [None, 0.9]:
+            duplicates = DuplicateIndex(fuzzyCutoff)
+            duplicates.add(event)
+            assert duplicates.matches("film night - ALIEN", event.start, event.end) == [event]
+            assert duplicates.matches("Film Night: Alien", event.start, event.end + timedelta(hours = 1)) == []
+            assert (duplicates.matches("Film Night: Alein", event.start, event.end) == [event]) == bool(fuzzyCutoff)
+            assert duplicates.matches("Trivia Night", event.start, event.end) == []
+
+        event.title = "Trivia Night" # Moves when it changes
+        duplicates.update(event)
+        assert duplicates.matches("Trivia Night", event.start, event.end) == [event]
+        assert duplicates.matches("Film Night: Alien", event.start, event.end) == []
+
+    def testLocationLookup(self):
+        """ Tests that locations resolve to the first matching place, and that edited places are picked up """
+        gazetteer.markStale()
+        noyce = Location.objects.get(name = "Noyce")
+        assert gazetteer.lookup("JRC 101") == tuple(Location.objects.values_list('lat', 'long').get(name = "JRC"))
+        assert gazetteer.lookup("Harris Center, then Noyce") == (noyce.lat, noyce.long) # Noyce has priority
+        assert gazetteer.lookup("Somewhere in Des Moines") == (None, None)
+
+        Location.objects.create(name = "Faulconer", keywords = "faulconer, art gallery", lat = 41.7486,
+                                long = -92.7193)
+        assert gazetteer.lookup("Faulconer Gallery") == (Decimal('41.748600'), Decimal('-92.719300'))
+
+    def testBulkEventTags(self):
+        """ Tests that tagging lots of events takes the same few queries as tagging one """
+        events = [Event.objects.create(host = self.user1, title = f"Event {i}", location = "JRC", studentsOnly = False,
+                                       start = self.time, end = self.time + timedelta(hours = 1)) for i in range(10)]
+        bulkAddEventTags([(events[0], ["Interesting Events"])]) # Loads the tag names
+        with CaptureQueriesContext(connection) as queries:
+            bulkAddEventTags([(events[1], ["Interesting Events"])])
+        with self.assertNumQueries(len(queries)):
+            bulkAddEventTags([(event, ["Interesting Events"]) for event in events])
+        assert all(list(event.tags.all()) == [self.tag] for event in events)
+
+        changed = bulkSetEventTags([(event, ["brand new", "&amp; more"]) for event in events[:5]], create_new = True)
+        assert changed == {event.pk for event in events[:5]}
+        assert set(events[0].tags.values_list('name', flat=True)) == {"Brand New", "And More"}
+        assert list(events[9].tags.all()) == [self.tag]
+
+    def testCreateRepeatingEvent(self):
+        """ Tests that a repeating event makes its whole series, linked and tagged, in a flat number of queries """
+        def createSeries(repeatDate):
+            request = factory.post('/api/create/event/', {'title': "Weekly Meeting", 'location': "JRC 209",
+                                                          'studentsOnly': "false", 'tags': "Interesting Events",
+                                                          'start': "2030-01-31 12:00:00.000000",
+                                                          'repeatingMonths': 1, 'repeatDate': repeatDate})
+            force_authenticate(request, user=self.user1, token=self.token1)
+            with CaptureQueriesContext(connection) as queries:
+                response = views.createEvent(request)
+            assert response.status_code == 200
+            return Event.objects.get(pk = json.loads(response.content)['id']), len(queries)
+
+        createSeries("2030-03-01 00:00:00.000000") # Loads the tag names and such
+        _, shortSeriesQueries = createSeries("2030-03-01 00:00:00.000000")
+        event, longSeriesQueries = createSeries("2030-12-31 00:00:00.000000")
+        assert longSeriesQueries == shortSeriesQueries
+        series = [event]
+        while series[-1].nextRepeat:
+            series.append(series[-1].nextRepeat)
+        assert len(series) == 12
+        assert [occurrence.start.day for occurrence in series[:3]] == [31, 28, 31] # Doesn't drift after February
+        assert all(list(occurrence.tags.all()) == [self.tag] for occurrence in series)
+
+    def testEditSeries(self):
+        """ Tests that editing a series shifts, retitles, retags and cuts off every later occurrence in a flat number
+        of queries """
+        def editSeries(occurrences):
+            request = factory.post('/api/create/event/', {'title': "Weekly Meeting", 'location': "JRC 209",
+                                                          'studentsOnly': "false", 'start': "2030-01-07 12:00:00.000000",
+                                                          'repeatingDays': 7,
+                                                          'repeatDate': (timezone.datetime(2030, 1, 7) +
+                                                                         timedelta(weeks = occurrences - 1)
+                                                                        ).strftime("%Y-%m-%d %H:%M:%S.%f")})
+            force_authenticate(request, user=self.user1, token=self.token1)
+            eid = json.loads(views.createEvent(request).content)['id']
+            request = factory.post('/api/editEvent/', {'id': eid, 'title': "Weekly Meetup", 'tags': "Interesting Events",
+                                                       'start': "2030-01-07 13:00:00.000000",
+                                                       'end': "2030-01-07 14:00:00.000000",
+                                                       'repeatDate': "2030-01-21 00:00:00.000000"})
+            force_authenticate(request, user=self.user1, token=self.token1)
+            with CaptureQueriesContext(connection) as queries:
+                assert views.editEvent(request).status_code == 200
+            return Event.objects.get(pk = eid), len(queries)
+
+        editSeries(4) # Loads the tag names and such
+        _, shortSeriesQueries = editSeries(4)
+        event, longSeriesQueries = editSeries(30)
+        assert longSeriesQueries == shortSeriesQueries
+        series = [event]
+        while series[-1].nextRepeat:
+            series.append(series[-1].nextRepeat)
+        assert len(series) == 3 # Cut off after the 21st
+        assert all(occurrence.title == "Weekly Meetup" for occurrence in series)
+        assert [timezone.localtime(occurrence.start).hour for occurrence in series] == [13, 13, 13]
+        assert all(list(occurrence.tags.all()) == [self.tag] for occurrence in series)
+
+    @override_settings(EVENT_REPEAT_RULES = True)
+    def testRepeatRules(self):
+        """ Tests that a repeating event can be stored as a rule, and its occurrences changed or cancelled one by one """
+        request = factory.post('/api/create/event/', {'title': "Weekly Meeting", 'location': "JRC 209",
+                                                      'studentsOnly': "false", 'tags': "Interesting Events",
+                                                      'start': "2030-01-07 12:00:00.000000", 'repeatingDays': 7,
+                                                      'repeatDate': "2030-12-31 00:00:00.000000"})
+        force_authenticate(request, user=self.user1, token=self.token1)
+        response = views.createEvent(request)
+        assert response.status_code == 200
+        eid = json.loads(response.content)['id']
+        assert Event.objects.filter(title = "Weekly Meeting").count() == 1 # No row per occurrence
+
+        def occurrences():
+            request = factory.get('/api/getEventsInRange/', {'from': "2030-01-01", 'to': "2030-02-01"})
+            return [event for event in json.loads(views.getEventsInRange(request).content) if event['id'] == eid]
+
+        assert len(occurrences()) == 4 # The 7th, 14th, 21st and 28th
+        secondStart = occurrences()[1]['occurrenceStart']
+
+        request = factory.post('/api/editEvent/', {'id': eid, 'occurrenceStart': secondStart, 'title': "Special Meeting"})
+        force_authenticate(request, user=self.user1, token=self.token1)
+        assert views.editEvent(request).status_code == 200
+        assert [event['title'] for event in occurrences()] == ["Weekly Meeting", "Special Meeting",
+                                                              "Weekly Meeting", "Weekly Meeting"]
+
+        request = factory.delete('/api/deleteEvent/', {'id': eid, 'occurrenceStart': secondStart})
+        force_authenticate(request, user=self.user1, token=self.token1)
+        assert views.deleteEvent(request).status_code == 200
+        assert len(occurrences()) == 3
+
+        # There's no occurrence at a time that's not in the series
+        request = factory.post('/api/editEvent/', {'id': eid, 'occurrenceStart': "2030-01-08 12:00:00", 'title': "Nope"})
+        force_authenticate(request, user=self.user1, token=self.token1)
+        assert views.editEvent(request).status_code == 400
+
+        # Deleting from the third one on ends the series before it
+        request = factory.delete('/api/deleteEvent/', {'id': eid, 'occurrenceStart': occurrences()[1]['occurrenceStart'],
+                                                       'scope': "following"})
+        force_authenticate(request, user=self.user1, token=self.token1)
+        assert views.deleteEvent(request).status_code == 200
+        assert len(occurrences()) == 1
+
+    def testDeleteSeries(self):
+        """ Tests that a series can be deleted from an occurrence on, or all at once """
+        request = factory.post('/api/create/event/', {'title': "Weekly Meeting", 'location': "JRC 209",
+                                                      'studentsOnly': "false", 'start': "2030-01-07 12:00:00.000000",
+                                                      'repeatingDays': 7, 'repeatDate': "2030-02-11 00:00:00.000000"})
+        force_authenticate(request, user=self.user1, token=self.token1)
+        series = [Event.objects.get(pk = json.loads(views.createEvent(request).content)['id'])]
+        while series[-1].nextRepeat:
+            series.append(series[-1].nextRepeat)
+        assert len(series) == 6
+
+        def delete(event, scope):
+            request = factory.delete('/api/deleteEvent/', {'id': event.pk, 'scope': scope})
+            force_authenticate(request, user=self.user1, token=self.token1)
+            return views.deleteEvent(request).status_code
+
+        assert delete(series[3], "following") == 200
+        assert Event.objects.filter(title = "Weekly Meeting").count() == 3
+        series[2].refresh_from_db()
+        assert series[2].nextRepeat is None
+        assert delete(series[1], "series") == 200
+        assert not Event.objects.filter(title = "Weekly Meeting").exists()
+        assert delete(self.event1, "everything") == 400
+
+    def testEmailOutbox(self):
+        """ Tests that emails are queued rather than sent during the request, then sent (or retried) by sendmail """
+        request = factory.post('/api/create/user/', {'first_name': "New", 'last_name': "Student",
+                                                     'password': "newtest", 'type': "STU",
+                                                     'email': "newstudent@grinnell.edu"})
+        response = views.createUser(request)
+        assert response.status_code == 200
+        assert len(mail.outbox) == 0
+        assert OutboxEmail.objects.get().recipients == ["newstudent@grinnell.edu"]
+
+        call_command('sendmail', stdout = StringIO())
+        assert [message.to for message in mail.outbox] == [["newstudent@grinnell.edu"]]
+        assert OutboxEmail.objects.get().sent is not None
+
+        # A failed send is pushed back to try again later, rather than lost
+        outbox.queueMail("Subject", "Body", "info@grinsync.com", ["someone@grinnell.edu"])
+        with tempfile.TemporaryDirectory() as directory:
+            connection = get_connection('django.core.mail.backends.filebased.EmailBackend',
+                                        file_path = os.path.join(directory, 'mail'))
+        assert outbox.drain(connection = connection) == (0, 1) # The directory's gone, so it can't be written
+        failed = OutboxEmail.objects.get(sent__isnull = True)
+        assert failed.attempts == 1 and failed.sendAfter > timezone.now() and failed.lastError
+        assert outbox.drain() == (0, 0) # Not due yet
+
+    def testAsyncReadViews(self):
+        """ Tests that the async read views return what their sync versions do """
+        self.user1.likedEvents.add(self.event1)
+        token = Token.objects.create(user = self.user1)
+        checks = [('getUpcoming', {}), ('getUpcoming', {'tags': "ALL"}), ('getEvent', {'id': self.event1.id}),
+                  ('search', {'query': "Testing"}), ('getLikedEvents', {}), ('getTags', {})]
+        for name, params in checks:
+            for auth in [{'HTTP_AUTHORIZATION': f"Token {token.key}"}, {}]:
+                syncResponse = getattr(views, name)(factory.get('/api/', params, **auth))
+                asyncResponse = async_to_sync(getattr(asyncViews, name))(factory.get('/api/', params, **auth))
+                assert asyncResponse.status_code == syncResponse.status_code, (name, auth)
+                if syncResponse.status_code == 200:
+                    assert json.loads(asyncResponse.content) == json.loads(syncResponse.content), (name, auth)
+                    assert asyncResponse.headers.get('ETag') == syncResponse.headers.get('ETag')
+
+        # Including the occurrences of a series stored as a rule
+        series = Event.objects.create(host=self.user2, title="Daily Standup", studentsOnly=False, repeatDays=1,
+                                      start=self.time - timedelta(days=1), end=self.time - timedelta(days=1, hours=-1),
+                                      repeatUntil=self.time + timedelta(days=30))
+        series.tags.add(self.tag)
+        for params in [{}, {'tags': "ALL"}]:
+            # (async first, so it has to build the feed rather than finding the sync one's in the cache)
+            asyncResponse = async_to_sync(asyncViews.getUpcoming)(factory.get('/api/', params))
+            syncResponse = views.getUpcoming(factory.get('/api/', params))
+            assert asyncResponse.status_code == syncResponse.status_code == 200
+            upcoming = json.loads(asyncResponse.content)
+            assert upcoming == json.loads(syncResponse.content)
+            assert any(event['id'] == series.id for event in upcoming)
+
+        # Conditional requests get a 304 without running the view
+        response = async_to_sync(asyncViews.getTags)(factory.get('/api/getAllTags'))
+        request = factory.get('/api/getAllTags', HTTP_IF_NONE_MATCH = response.headers['ETag'])
+        assert async_to_sync(asyncViews.getTags)(request).status_code == 304
+        request = factory.get('/api/getLikedEvents', HTTP_AUTHORIZATION = "Token nope")
+        assert async_to_sync(asyncViews.getLikedEvents)(request).status_code == 401
+
+    def testForYouFeed(self):
+        """ Tests that the For You feed is kept up to date as events and follows change, and ranks by how well events
+        match and how soon they are """
+        org = Organization.objects.create(name = "Chess Club", email = "chess@grinnell.edu", is_active = True)
+        def event(title, days, org = None):
+            return Event.objects.create(host = self.user2, parentOrg = org, title = title,
+                                        start = self.time + timedelta(days = days),
+                                        end = self.time + timedelta(days = days, hours = 1), studentsOnly = False)
+        tagged, followed, liked, unrelated = (event("Tagged", 1), event("Followed", 2, org), event("Liked", 5),
+                                              event("Unrelated", 3))
+        tagged.tags.add(self.tag)
+        followed.tags.add(self.tag)
+        self.user1.followedOrgs.add(org)
+        self.user1.likedEvents.add(liked)
+
+        def forYou(**params):
+            request = factory.get('/api/forYou', params)
+            force_authenticate(request, user=self.user1, token=self.token1)
+            return [event['title'] for event in json.loads(views.getForYou(request).content)]
+
+        assert forYou() == ["Followed", "Liked", "Tagged"] # Tag and org beat just a tag, and sooner beats later
+        self.user1.followedOrgs.remove(org)
+        assert forYou() == ["Liked", "Tagged", "Followed"]
+        unrelated.tags.add(self.tag)
+        liked.delete()
+        assert forYou() == ["Tagged", "Followed", "Unrelated"]
+        assert forYou(limit = 2) == ["Tagged", "Followed"]
+        for limit in [0, -1, "two"]:
+            request = factory.get('/api/forYou', {'limit': limit})
+            force_authenticate(request, user=self.user1, token=self.token1)
+            assert views.getForYou(request).status_code == 400
+
+    def testHomePage(self):
+        """ Tests that the landing page is rendered once and shared until events change, and shows hosting orgs """
+        org = Organization.objects.create(name = "Chess Club", email = "chess@grinnell.edu", is_active = True)
+        event = Event.objects.create(host = self.user2, parentOrg = org, title = "Chess Night", studentsOnly = False,
+                                     start = self.time + timedelta(hours = 3), end = self.time + timedelta(hours = 4))
+        event.tags.add(self.tag)
+
+        response = views.home(factory.get('/'))
+        assert b"Chess Night" in response.content and b"Chess Club" in response.content
+        with CaptureQueriesContext(connection) as queries:
+            cached = views.home(factory.get('/'))
+        assert cached.content == response.content and len(queries) == 1 # Just the version check
+
+        request = factory.get('/', HTTP_IF_NONE_MATCH = response.headers['ETag'])
+        assert views.home(request).status_code == 304 # Nothing's changed
+
+        event.title = "Chess Tournament"
+        event.save()
+        assert b"Chess Tournament" in views.home(factory.get('/')).content
+
+        # Nothing that's already ended shows up, even though the page (and the feeds) are shared for a while
+        ended = Event.objects.create(host = self.user2, title = "Just Ended", studentsOnly = False,
+                                     start = timezone.now() - timedelta(hours = 1),
+                                     end = timezone.now() - timedelta(seconds = 1))
+        ended.tags.add(self.tag)
+        assert b"Just Ended" not in views.home(factory.get('/')).content
+        upcoming = json.loads(views.getUpcoming(factory.get('/api/upcoming/', {'tags': 'ALL'})).content)
+        assert ended.id not in [upcomingEvent['id'] for upcomingEvent in upcoming]
@@ -4,29 +4,38 @@ This file tells django where to direct each incoming request.
 Each url is linked to a function. Currently these are all in one file, but we should probably change that, 
 I'm just too worried it would break something. 
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import include, path
 from django.views.generic.base import TemplateView
 from rest_framework.authtoken import views as tokenViews
 from api import views as apiViews
+from api import async_views as asyncViews
+
+# The busiest read endpoints have async versions for when we're running under ASGI (see api/async_views.py)
+readViews = asyncViews if getattr(settings, 'ASYNC_READ_VIEWS', False) else apiViews
 
 urlpatterns = [
     path('', apiViews.home, name = 'homePage'),
     path('admin/', admin.site.urls),
     path('accounts/', include("django.contrib.auth.urls")),
-    path('api/search', apiViews.search, name = 'search'),
+    path('api/search', readViews.search, name = 'search'),
+    path('api/autocomplete', apiViews.autocomplete, name = 'autocomplete'),
     path('api/getUser', apiViews.getUser, name = 'getUser'),
-    path('api/getEvent', apiViews.getEvent, name = 'getEvent'),
+    path('api/getEvent', readViews.getEvent, name = 'getEvent'),
     path('api/getAll', apiViews.getAll, name = 'getAll'),
     path('api/getCreatedEvents', apiViews.getAllCreated, name = 'getCreatedEvents'),
-    path('api/getLikedEvents', apiViews.getLikedEvents, name = 'getLikedEvents'),
+    path('api/getLikedEvents', readViews.getLikedEvents, name = 'getLikedEvents'),
+    path('api/forYou', apiViews.getForYou, name = 'forYou'),
     path('api/likeEvent', apiViews.likeEvent, name = 'likeEvent'),
     path('api/unlikeEvent', apiViews.unlikeEvent, name = 'unlikeEvent'),
     path('api/toggleLikedEvent', apiViews.toggleLikedEvent, name = 'toggleLikedEvent'),
     path('api/editEvent', apiViews.editEvent, name = 'editEvent'),
     path('api/deleteEvent', apiViews.deleteEvent, name = 'deleteEvent'),
-    path('api/upcoming', apiViews.getUpcoming, name = 'getUpcomming'),
-    path('api/getAllTags', apiViews.getTags, name = 'getAllTags'),
+    path('api/upcoming', readViews.getUpcoming, name = 'getUpcomming'),
+    path('api/getEventsInRange', apiViews.getEventsInRange, name = 'getEventsInRange'),
+    path('api/getEventsInDay', apiViews.getEventsInDay, name = 'getEventsInDay'),
+    path('api/getAllTags', readViews.getTags, name = 'getAllTags'),
     path('api/getUserTags', apiViews.getUserTags, name = 'getUsersTags'),
     path('api/auth', tokenViews.obtain_auth_token),
     path('auth/', include('django.contrib.auth.urls')),
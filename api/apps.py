@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # pylint: disable=import-outside-toplevel, unused-import
+        from api import locations, search, signals # Registers the signal receivers
+        post_migrate.connect(search.createIndex, sender=self)
+        post_migrate.connect(locations.seedLocations, sender=self)
@@ -0,0 +1,173 @@
+"""
+async_views.py - async versions of the busiest read endpoints, for when we're served over ASGI
+
+Every view in views.py holds onto a worker thread for its whole request, including all the time it spends waiting
+on the database. These do the same work with django's async ORM instead, so when the site runs under an ASGI
+server (GrinSync/asgi.py, e.g. with uvicorn) one worker can have lots of requests waiting at once. They return the
+same JSON as their views.py versions, which stay as they are for WSGI. urls.py routes to these when the
+ASYNC_READ_VIEWS setting is on.
+
+DRF's api_view doesn't support async views, so asyncApiView stands in for it (token auth, allowed methods), and
+versions.aconditionalOn for the ETag/304 handling. The few pieces that only work synchronously (the tag map,
+full text search, expanding repeating events) run through sync_to_async, and paginated or streamed requests are
+just handed to the views.py version.
+"""
+import functools
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.http import JsonResponse
+from rest_framework.exceptions import AuthenticationFailed
+
+import api.caching as caching
+import api.pagination as pagination
+import api.recurrence as recurrence
+import api.search as searchIndex
+import api.serializers as serializers
+import api.streaming as streaming
+import api.versions as versions
+import api.views as views
+from api.authentication import aauthenticate
+from api.aux_functions import UnknownTagError, resolveTagList
+from api.caching import feedCache
+from api.models import Event, Tag
+
+
+def asyncApiView(syncView, methods = ('GET',), loginRequired = False):
+    """ Decorator doing what @api_view (and @permission_classes([IsAuthenticated])) do for the sync views. Requests
+    the async version doesn't handle itself (paginated or streamed ones) go to syncView """
+
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if pagination.isPaginated(request) or streaming.isStreamed(request):
+                return await sync_to_async(syncView)(request, *args, **kwargs)
+
+            if request.method not in methods:
+                return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status = 405)
+            try:
+                authenticated = await aauthenticate(request)
+            except AuthenticationFailed as e:
+                return unauthorized(str(e.detail))
+            request.user = authenticated[0] if authenticated else AnonymousUser()
+            if loginRequired and not request.user.is_authenticated:
+                return unauthorized("Authentication credentials were not provided.")
+            return await view(request, *args, **kwargs)
+        return wrapper
+
+    return decorator
+
+def unauthorized(detail):
+    """ The response DRF gives when token auth fails """
+    response = JsonResponse({'detail': detail}, status = 401)
+    response.headers['WWW-Authenticate'] = 'Token'
+    return response
+
+
+async def likedEventIDs(request):
+    """ The ids of the requesting user's liked events """
+    if not request.user.is_authenticated:
+        return set()
+    return {pk async for pk in request.user.likedEvents.values_list('pk', flat=True)}
+
+async def serializeEvents(request, events, occurrences = (), likedIDs = None):
+    """ Serializes a queryset of events (with any occurrences of repeating events mixed in), loading them first so
+    the serializer doesn't have to touch the database """
+    events = [event async for event in serializers.EventSerializer.eagerLoad(events)]
+    if likedIDs is None:
+        likedIDs = await likedEventIDs(request)
+    return serializers.EventSerializer(recurrence.merge(events, occurrences), many = True,
+                                       context={'request': request, 'likedEventIDs': likedIDs}).data
+
+
+@asyncApiView(views.getUpcoming)
+@versions.aconditionalOn(views.upcomingVersions, extraKey = views.audience, window = views.feedWindow)
+async def getUpcoming(request):
+    """ Return all the info for upcoming events. """
+    now = caching.currentWindow()
+    cacheKey = views.upcomingCacheKey(request, now)
+    eventsJson = feedCache.get(cacheKey)
+    if eventsJson is None:
+        since = caching.windowEnd(now)
+        try:
+            upcoming, events = await sync_to_async(views.upcomingEvents)(request, since)
+        except UnknownTagError as e:
+            return JsonResponse({'error' : str(e)}, safe=False, status = 400)
+        occurrences = await sync_to_async(recurrence.occurrencesIn)(events, since, since + timedelta(weeks = 1))
+        # Cache it without anyone's favorites, then fill in this user's
+        eventsJson = await serializeEvents(request, upcoming, occurrences, likedIDs = set())
+        feedCache.set(cacheKey, eventsJson)
+    return JsonResponse(caching.overlayFavorites(request, eventsJson, await likedEventIDs(request)), safe=False)
+
+@asyncApiView(views.getEvent)
+async def getEvent(request):
+    """ Return all the info for an event. Takes: id """
+    eid = request.GET.get("id", "")
+    try:
+        event = await serializers.EventSerializer.eagerLoad(Event.objects).aget(pk = eid)
+    except (Event.DoesNotExist, ValueError):
+        return JsonResponse({'error':f"Event with id '{eid}' does not exist"}, status = 404)
+    if (not request.user.is_authenticated) or (request.user.type != "STU"):
+        if event.studentsOnly:
+            return JsonResponse({'error':'This event is student only'}, status = 401)
+    liked = request.user.is_authenticated and await request.user.likedEvents.filter(pk = event.pk).aexists()
+    eventJson = serializers.EventSerializer(event, context={'request': request,
+                                                            'likedEventIDs': {event.pk} if liked else set()})
+    return JsonResponse(eventJson.data, safe=False)
+
+@asyncApiView(views.search)
+async def search(request):
+    """ Return the best matching events for a given search. Takes: query, and optionally tags and limit """
+    tags = request.GET.get("tags", None)
+    query = request.GET.get("query", None)
+    if not query:
+        return JsonResponse({'error' : "Required Argument 'query' was not provided"}, safe=False, status = 400)
+
+    tagIds = None
+    if tags:
+        try:
+            tagIds = await sync_to_async(resolveTagList)(tags)
+        except UnknownTagError as e:
+            return JsonResponse({'error' : str(e)}, safe=False, status = 400)
+
+    isStudent = request.user.is_authenticated and (request.user.type == "STU")
+
+    if await sync_to_async(searchIndex.isAvailable)():
+        try:
+            limit = min(int(request.GET.get("limit", searchIndex.MAX_RESULTS)), pagination.MAX_PAGE_SIZE)
+        except ValueError:
+            return JsonResponse({'error' : "'limit' must be an integer"}, safe=False, status = 400)
+        if limit < 1:
+            return JsonResponse({'error' : "'limit' must be positive"}, safe=False, status = 400)
+        rankedIds = await sync_to_async(searchIndex.searchEventIds)(query, limit, tagIds = tagIds,
+                                                                    includeStudentsOnly = isStudent)
+        matching = await serializeEvents(request, Event.objects.filter(pk__in = rankedIds))
+        rank = {eid: i for i, eid in enumerate(rankedIds)}
+        return JsonResponse(sorted(matching, key = lambda event: rank[event['id']]), safe=False)
+
+    # Not on SQLite, so just fall back to substring matching
+    matching = Event.objects.filter(title__contains = query) | Event.objects.filter(location__contains = query)
+    if tagIds is not None:
+        matching = matching.filter(tags__in = tagIds).distinct()
+    if not isStudent:
+        matching = matching.exclude(studentsOnly = True)
+    return JsonResponse(await serializeEvents(request, matching), safe=False)
+
+@asyncApiView(views.getLikedEvents, loginRequired = True)
+@versions.aconditionalOn(views.likedVersions, extraKey = views.audience)
+async def getLikedEvents(request):
+    """ Return all of a users liked events. """
+    likedEvents = request.user.likedEvents.all()
+    return JsonResponse(await serializeEvents(request, likedEvents), safe=False)
+
+@asyncApiView(views.getTags)
+@versions.aconditionalOn(lambda request: [versions.TAGS])
+async def getTags(request):
+    """ Return all the current tags. """
+    cacheKey = ('tags', versions.versionsKey(request, [versions.TAGS]))
+    tagsJson = feedCache.get(cacheKey)
+    if tagsJson is None:
+        tagsJson = serializers.TagSerializer([tag async for tag in Tag.objects.all()], many = True).data
+        feedCache.set(cacheKey, tagsJson)
+    return JsonResponse(tagsJson, safe=False)
@@ -0,0 +1,67 @@
+"""
+authentication.py - token authentication that doesn't hit the database on every request
+
+DRF's TokenAuthentication looks up the token and its user on every single authenticated call. Since a token maps to
+the same user until they log out or their account changes, we remember the (user, token) pair for up to
+AUTH_TOKEN_CACHE_SECONDS. The receivers in signals.py drop cached entries when a token is deleted or its user is
+saved or deleted (so deactivating or deleting an account takes effect right away in this process); the expiry
+covers changes made by other processes.
+
+Each request gets its own copy of the cached user, so nothing one request does to request.user leaks into another.
+"""
+import copy
+
+from django.conf import settings
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from api.caching import ExpiringLRUCache
+
+tokenCache = ExpiringLRUCache(maxEntries = getattr(settings, 'AUTH_TOKEN_CACHE_MAX_ENTRIES', 1024),
+                              entrySeconds = getattr(settings, 'AUTH_TOKEN_CACHE_SECONDS', 60))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """ TokenAuthentication with a bounded, expiring cache of the tokens it's already checked """
+
+    def authenticate_credentials(self, key):
+        cached = tokenCache.get(key)
+        if cached is None:
+            cached = super().authenticate_credentials(key) # Raises AuthenticationFailed for bad/inactive ones
+            tokenCache.set(key, cached)
+        user, token = cached
+        return (copy.copy(user), token)
+
+
+async def aauthenticate(request):
+    """ The (user, token) for a request to an async view (see async_views.py), checked the same way and with the
+    same cache as CachedTokenAuthentication. None if they didn't send a token, AuthenticationFailed if it's bad """
+    auth = get_authorization_header(request).split()
+    if (not auth) or (auth[0].lower() != b'token'):
+        return None
+    if len(auth) != 2:
+        raise AuthenticationFailed("Invalid token header.")
+    key = auth[1].decode(errors = 'replace')
+
+    cached = tokenCache.get(key)
+    if cached is None:
+        try:
+            token = await Token.objects.select_related('user').aget(key = key)
+        except Token.DoesNotExist as e:
+            raise AuthenticationFailed("Invalid token.") from e
+        if not token.user.is_active:
+            raise AuthenticationFailed("User inactive or deleted.")
+        cached = (token.user, token)
+        tokenCache.set(key, cached)
+    user, token = cached
+    return (copy.copy(user), token)
+
+
+def forgetToken(key):
+    """ Stops accepting a token from the cache (it'll be checked against the database next time) """
+    tokenCache.delete(key)
+
+def forgetUser(userId):
+    """ Drops every cached token for a user, for when their account changes """
+    tokenCache.deleteWhere(lambda key, cached: cached[0].pk == userId)
@@ -0,0 +1,297 @@
+"""
+autocomplete.py - in-memory, typo tolerant suggestions for the search bar
+
+People type things like "jrc", "rosenfeld" or "harris cen" and expect the right thing to come up while they're
+still typing, so we can't afford a database query per keystroke. Instead each worker keeps small word indexes of
+event titles, org names/aliases and event locations in memory:
+ - every word is indexed by its trigrams, so a misspelled word still finds the words it shares most trigrams with
+ - every word is also kept in a sorted list, so a partly typed word finds everything it's a prefix of
+
+The indexes are built from the database the first time they're used and updated in place by the receivers in
+signals.py when events or orgs change. To pick up changes made by other processes (like the nightly scrape), every
+AUTOCOMPLETE_CHECK_SECONDS we compare the events/orgs versions (see versions.py) with the ones the indexes were
+built from, and if they've moved, rebuild them in a background thread and swap them in when they're done.
+"""
+import bisect
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import connection
+
+import api.versions as versions
+from api.models import Event, Organization
+
+CHECK_SECONDS = getattr(settings, 'AUTOCOMPLETE_CHECK_SECONDS', 60)
+MIN_SIMILARITY = 0.3 # Same default cutoff as postgres' pg_trgm
+PREFIX_SIMILARITY = 0.9 # A typed prefix is almost as good as the whole word
+DEFAULT_LIMIT = 8
+
+
+def normalize(text):
+    """ Lowercases and strips accents, so 'Café' and 'cafe' are the same word """
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+def splitWords(text):
+    """ The normalized words in a string """
+    return re.findall(r'\w+', normalize(text))
+
+def trigrams(word):
+    """ The trigrams of a word, padded like pg_trgm so the start of a word counts for more """
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SuggestionIndex:
+    """ A trigram + prefix index over short strings (titles, names, locations) """
+
+    def __init__(self):
+        self.entries = {} # key -> (text, payload)
+        self.entryWords = {} # key -> set of words
+        self.wordKeys = defaultdict(set) # word -> keys of the entries with that word
+        self.trigramWords = defaultdict(set) # trigram -> words with that trigram
+        self.sortedWords = [] # Every word, sorted, for prefix lookups
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key, text, payload = None):
+        """ Adds (or replaces) an entry """
+        self.remove(key)
+        words = set(splitWords(text))
+        self.entries[key] = (text, payload)
+        self.entryWords[key] = words
+        for word in words:
+            if not self.wordKeys[word]: # New word
+                bisect.insort(self.sortedWords, word)
+                for trigram in trigrams(word):
+                    self.trigramWords[trigram].add(word)
+            self.wordKeys[word].add(key)
+
+    def remove(self, key):
+        """ Removes an entry if it's there """
+        if key not in self.entries:
+            return
+        del self.entries[key]
+        for word in self.entryWords.pop(key):
+            self.wordKeys[word].discard(key)
+            if not self.wordKeys[word]: # Nothing uses the word anymore
+                del self.wordKeys[word]
+                del self.sortedWords[bisect.bisect_left(self.sortedWords, word)]
+                for trigram in trigrams(word):
+                    self.trigramWords[trigram].discard(word)
+                    if not self.trigramWords[trigram]:
+                        del self.trigramWords[trigram]
+
+    def similarWords(self, queryWord):
+        """ Every indexed word similar enough to the query word, mapped to how similar it is (0 to 1) """
+        similar = {}
+
+        # Words the query word is the start of
+        i = bisect.bisect_left(self.sortedWords, queryWord)
+        while (i < len(self.sortedWords)) and self.sortedWords[i].startswith(queryWord):
+            word = self.sortedWords[i]
+            similar[word] = 1.0 if word == queryWord else PREFIX_SIMILARITY
+            i += 1
+
+        # Words that share enough trigrams with it, for typos
+        queryTrigrams = trigrams(queryWord)
+        shared = Counter()
+        for trigram in queryTrigrams:
+            shared.update(self.trigramWords.get(trigram, ()))
+        for word, count in shared.items():
+            similarity = count / (len(queryTrigrams) + len(trigrams(word)) - count)
+            if similarity >= MIN_SIMILARITY and similarity > similar.get(word, 0):
+                similar[word] = similarity
+        return similar
+
+    def query(self, text):
+        """ Returns (score, key, text, payload) for every entry matching the text, best first """
+        queryWords = splitWords(text)
+        if not queryWords:
+            return []
+
+        # An entry's score is the average over the query words of its best match for each
+        scores = defaultdict(float)
+        for queryWord in queryWords:
+            bestForWord = {}
+            for word, similarity in self.similarWords(queryWord).items():
+                for key in self.wordKeys[word]:
+                    if similarity > bestForWord.get(key, 0):
+                        bestForWord[key] = similarity
+            for key, similarity in bestForWord.items():
+                scores[key] += similarity / len(queryWords)
+
+        results = [(score, key) + self.entries[key] for key, score in scores.items() if score >= MIN_SIMILARITY]
+        results.sort(key = lambda result: (-result[0], len(result[2]))) # Ties go to the shorter string
+        return results
+
+
+class SuggestionIndexes:
+    """ The indexes for events, orgs and locations, with what's needed to keep them up to date """
+
+    def __init__(self):
+        self.events = SuggestionIndex()
+        self.orgs = SuggestionIndex()
+        self.locations = SuggestionIndex()
+        self.eventLocations = {} # event id -> its location key, so we can keep counts when events change
+        self.locationEvents = defaultdict(set) # location key -> ids of the events there
+
+    @classmethod
+    def load(cls):
+        """ Fresh indexes of everything in the database """
+        indexes = cls()
+        for eid, title, location, studentsOnly in Event.objects.values_list('pk', 'title', 'location', 'studentsOnly'):
+            indexes.addEvent(eid, title, location, studentsOnly)
+        for oid, name, alias in Organization.objects.filter(is_active = True).values_list('pk', 'name', 'alias'):
+            indexes.addOrg(oid, name, alias)
+        return indexes
+
+    def addEvent(self, eid, title, location, studentsOnly):
+        """ Adds (or replaces) an event, and its location """
+        self.removeEvent(eid)
+        self.events.add(eid, title, {'id': eid, 'title': title, 'studentsOnly': studentsOnly})
+        if location:
+            key = ' '.join(splitWords(location))
+            self.eventLocations[eid] = key
+            self.locationEvents[key].add(eid)
+            if key not in self.locations.entries:
+                self.locations.add(key, location)
+
+    def removeEvent(self, eid):
+        """ Removes an event, and its location if nothing else is there """
+        self.events.remove(eid)
+        key = self.eventLocations.pop(eid, None)
+        if key is not None:
+            self.locationEvents[key].discard(eid)
+            if not self.locationEvents[key]: # Nothing's there anymore
+                del self.locationEvents[key]
+                self.locations.remove(key)
+
+    def addOrg(self, oid, name, alias):
+        """ Adds (or replaces) an org """
+        self.orgs.add(oid, f"{name} {alias or ''}", {'id': oid, 'name': name, 'alias': alias})
+
+
+class Suggestions:
+    """ The process wide indexes. Everything that reads or changes them holds the lock, and rebuilds are done off
+    to the side and swapped in, so a request never sees them half built or changing under it """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.indexes = None # Not built yet
+        self.builtVersions = None # The events/orgs versions the indexes were built from
+        self.checkedAt = None
+        self.rebuilding = False
+
+    @staticmethod
+    def currentVersions():
+        """ The events and orgs versions, which change whenever any process changes them """
+        return versions.getVersions([versions.EVENTS, versions.ORGS])
+
+    def rebuild(self):
+        """ Reads everything from the database into fresh indexes, then swaps them in """
+        # Read the versions first: a change made while we're loading would then still look new next time we check
+        builtVersions = self.currentVersions()
+        indexes = SuggestionIndexes.load()
+        with self.lock:
+            self.indexes = indexes
+            self.builtVersions = builtVersions
+            self.checkedAt = time.monotonic()
+
+    def rebuildIfChanged(self):
+        """ Rebuilds the indexes if events or orgs have changed (in any process) since they were built. Returns
+        whether it did """
+        with self.lock:
+            self.checkedAt = time.monotonic()
+        if self.currentVersions() == self.builtVersions:
+            return False
+        self.rebuild()
+        return True
+
+    def _rebuildInBackground(self):
+        try:
+            self.rebuildIfChanged()
+        except Exception: # pylint: disable=broad-exception-caught
+            pass # Keep the indexes we have, and try again at the next check
+        finally:
+            self.rebuilding = False
+            connection.close() # This thread's own connection
+
+    def ensureFresh(self):
+        """ Builds the indexes the first time they're used. After that, every AUTOCOMPLETE_CHECK_SECONDS, starts a
+        rebuild in the background if anything has changed since, so requests never wait on one """
+        if self.indexes is None:
+            self.rebuild()
+            return
+        if self.rebuilding or (time.monotonic() - self.checkedAt < CHECK_SECONDS):
+            return
+        with self.lock:
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+        threading.Thread(target = self._rebuildInBackground, daemon = True).start()
+
+    def updateEvents(self, eventIds):
+        """ Re-reads the given events. Does nothing if we haven't been built yet, since building reads them anyway """
+        if self.indexes is None:
+            return
+        eventIds = set(eventIds)
+        rows = list(Event.objects.filter(pk__in = eventIds).values_list('pk', 'title', 'location', 'studentsOnly'))
+        with self.lock:
+            for eid, title, location, studentsOnly in rows:
+                self.indexes.addEvent(eid, title, location, studentsOnly)
+                eventIds.discard(eid)
+            for eid in eventIds: # Not found, so they've been deleted
+                self.indexes.removeEvent(eid)
+
+    def removeEvents(self, eventIds):
+        """ Drops deleted events """
+        if self.indexes is None:
+            return
+        with self.lock:
+            for eid in eventIds:
+                self.indexes.removeEvent(eid)
+
+    def updateOrg(self, org):
+        """ Re-reads an org (only active orgs are suggested) """
+        if self.indexes is None:
+            return
+        with self.lock:
+            if org.is_active:
+                self.indexes.addOrg(org.pk, org.name, org.alias)
+            else:
+                self.indexes.orgs.remove(org.pk)
+
+    def removeOrg(self, oid):
+        """ Drops a deleted org """
+        if self.indexes is None:
+            return
+        with self.lock:
+            self.indexes.orgs.remove(oid)
+
+    def suggest(self, text, limit = DEFAULT_LIMIT, includeStudentsOnly = False):
+        """ The best matching events, orgs and locations for what's been typed so far """
+        self.ensureFresh()
+        with self.lock: # Queries are all in memory, so holding it is cheap
+            eventMatches = self.indexes.events.query(text)
+            orgMatches = self.indexes.orgs.query(text)
+            locationMatches = self.indexes.locations.query(text)
+        events = []
+        for _, _, _, payload in eventMatches:
+            if includeStudentsOnly or not payload['studentsOnly']:
+                events.append({'id': payload['id'], 'title': payload['title']})
+                if len(events) >= limit:
+                    break
+        return {
+            'events': events,
+            'orgs': [payload for _, _, _, payload in orgMatches[:limit]],
+            'locations': [location for _, _, location, _ in locationMatches[:limit]],
+        }
+
+
+suggestions = Suggestions()
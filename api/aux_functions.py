@@ -1,29 +1,197 @@
+from datetime import timedelta
 import string
-from django.core.exceptions import ObjectDoesNotExist
-from api.models import Tag
+import threading
+import time
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F, Max
+from api import versions
+from api.changes import eventsChanged, tagsChanged
+from api.models import Event, Tag
 
+LONGEST_SPAN_CACHE_KEY = 'longestEventSpan'
+LONGEST_SPAN_CACHE_SECONDS = 600
+TAG_MAP_CHECK_SECONDS = 5
+
+
+## Tag names <-> ids. Tags barely ever change but get looked up by name on almost every request, so every process
+# keeps a map of them. Changes made here mark it stale right away (see signals.py), and changes made by other
+# processes are noticed by checking the tags version at most every TAG_MAP_CHECK_SECONDS
+class UnknownTagError(ValueError):
+    """ Raised when a tag name doesn't match any tag """
+    def __init__(self, name):
+        super().__init__(f"Requested tag '{name}' is not a valid tag")
+        self.name = name
+
+class TagMap:
+    """ A process wide, two way map between tag names and ids """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idsByName = {}
+        self.namesById = {}
+        self.version = None
+        self.checkedAt = None
+
+    def markStale(self):
+        """ Forces a reload on the next lookup """
+        with self.lock:
+            self.version = None
+            self.checkedAt = None
+
+    def refresh(self):
+        """ Reloads the tags if they've changed since we loaded them """
+        if (self.checkedAt is not None) and (time.monotonic() - self.checkedAt < TAG_MAP_CHECK_SECONDS):
+            return
+        version = versions.getVersions([versions.TAGS])[versions.TAGS][0]
+        with self.lock:
+            if version != self.version:
+                rows = list(Tag.objects.values_list('pk', 'name'))
+                self.idsByName = {name: pk for pk, name in rows}
+                self.namesById = dict(rows)
+                self.version = version
+            self.checkedAt = time.monotonic()
+
+    def idFor(self, name):
+        """ The id of the tag with the given name, or None """
+        self.refresh()
+        return self.idsByName.get(name, None)
+
+    def resolve(self, names):
+        """ Turns tag names into ids, raising UnknownTagError for the first one that doesn't exist """
+        self.refresh()
+        ids = []
+        for name in names:
+            if name not in self.idsByName:
+                raise UnknownTagError(name)
+            ids.append(self.idsByName[name])
+        return ids
+
+    def namesFor(self, ids):
+        """ Turns tag ids into names, skipping any we don't know """
+        self.refresh()
+        return [self.namesById[pk] for pk in ids if pk in self.namesById]
+
+tagMap = TagMap()
+
+def resolveTagList(tags):
+    """ Turns a ';' separated list of tag names into their ids in one go. Raises UnknownTagError """
+    return tagMap.resolve(tags.split(';'))
+
+
+## We'll define these funcitons here so that we can ensure consistent formatting in the tag names. The bulk versions
+# take (event or event id, tag names) pairs and use the same handful of queries however many events and tags there
+# are, so use them whenever there's more than one event. They write the through table directly, so they send
+# eventsChanged themselves rather than saving the events
+def normalizeTagName(tag):
+    """ Cleans up a tag name the way we store them (the calendar's tags especially are all over the place) """
+    if 'sport' in tag:
+        tag = 'Sports'
+    tag = tag.replace('&amp;','and')
+    return string.capwords(tag)
+
+def tagIdsFor(names, create_new = False):
+    """ Maps each of the tag names to the id of its (normalized) tag. Missing tags are all created at once if
+    create_new is set, and left out otherwise """
+    normalized = {name: normalizeTagName(name) for name in set(names)}
+    tagIds = {tag: tagMap.idFor(tag) for tag in set(normalized.values())}
+    missing = [tag for tag, tagId in tagIds.items() if tagId is None]
+    if missing and create_new:
+        Tag.objects.bulk_create([Tag(name = tag) for tag in missing], ignore_conflicts = True)
+        tagIds.update(Tag.objects.filter(name__in = missing).values_list('name', 'pk'))
+        tagsChanged.send(sender = Tag) # bulk_create doesn't send post_save
+    return {name: tagIds[tag] for name, tag in normalized.items() if tagIds[tag] is not None}
+
+def bulkUpdateEventTags(eventTags, create_new = False, replace = False, sendSignals = True):
+    """ Adds the tags to each event, removing any others if replace is set. Returns the ids of the events whose tags
+    changed """
+    eventTags = [(getattr(event, 'pk', event), list(tags)) for event, tags in eventTags]
+    tagIds = tagIdsFor([name for _, tags in eventTags for name in tags], create_new)
+    wanted = {(eventId, tagIds[name]) for eventId, tags in eventTags for name in tags if name in tagIds}
+
+    through = Event.tags.through
+    existing = {(eventId, tagId): pk for pk, eventId, tagId in through.objects.filter(
+                    event_id__in = {eventId for eventId, _ in eventTags}).values_list('pk', 'event_id', 'tag_id')}
+    removed = {pair: pk for pair, pk in existing.items() if pair not in wanted} if replace else {}
+    added = wanted - existing.keys()
+    if removed:
+        through.objects.filter(pk__in = removed.values()).delete()
+    if added:
+        through.objects.bulk_create([through(event_id = eventId, tag_id = tagId) for eventId, tagId in added],
+                                    ignore_conflicts = True)
+
+    changedIds = {eventId for eventId, _ in added} | {eventId for eventId, _ in removed}
+    if changedIds and sendSignals:
+        eventsChanged.send(sender=Event, eventIds=changedIds)
+    return changedIds
+
+def bulkAddEventTags(eventTags, create_new = False, sendSignals = True):
+    """ Adds tags to lots of events at once """
+    return bulkUpdateEventTags(eventTags, create_new, sendSignals = sendSignals)
+
+def bulkSetEventTags(eventTags, create_new = False, sendSignals = True):
+    """ Sets the tags of lots of events at once """
+    return bulkUpdateEventTags(eventTags, create_new, replace = True, sendSignals = sendSignals)
 
-## We'll define these funcitons here so that we can ensure consistent formatting in the tag names
-# They save the event too, which feels harmless, but I'm not sure if it's really the behavior one would expect
 def addEventTags(event, tags, create_new = False):
     """ Adds tags from the iterable to the given event """
-    for tag in tags:
-        if 'sport' in tag:
-            tag = 'Sports'
-        tag = tag.replace('&amp;','and')
-        tag = string.capwords(tag)
-        if create_new:
-            tagObj, created = Tag.objects.get_or_create(name=tag) #pylint: disable=W0612
-        else:
-            try:
-                tagObj = Tag.objects.get(name=tag)
-            except ObjectDoesNotExist:
-                continue
-        event.tags.add(tagObj)
-    event.save()
+    bulkAddEventTags([(event, tags)], create_new)
     return event
 
 def setEventTags(event, tags, create_new = False):
     """ Set's an events tags to the provded tags"""
-    event.tags.clear()
-    return addEventTags(event, tags, create_new)
+    bulkSetEventTags([(event, tags)], create_new)
+    return event
+
+
+## Range queries. An event overlaps [start, end) if it starts before the end and ends after the start, but on its
+# own "starts before the end" matches every event in history. No event can start earlier than the longest event
+# is long before the window though, so that bound lets the (start, end) index read just the rows near the window
+def getLongestEventSpan():
+    """ The duration of the longest event. It's cached under the events version, so a change made by any process
+    moves everyone on to a fresh (recomputed) entry right away """
+    version, modified = versions.getVersions([versions.EVENTS])[versions.EVENTS]
+    # (with when it changed too, in case the versions ever start over, like between tests)
+    cacheKey = f"{LONGEST_SPAN_CACHE_KEY}:{version}:{modified.timestamp() if modified else 0}"
+    span = cache.get(cacheKey)
+    if span is None:
+        span = Event.objects.aggregate(longest = Max(F('end') - F('start')))['longest'] or timedelta(0)
+        cache.set(cacheKey, span, LONGEST_SPAN_CACHE_SECONDS)
+    return span
+
+def eventsInRange(events, start, end):
+    """ Filters an Event queryset down to events overlapping the [start, end) window """
+    return events.filter(start__gte = start - getLongestEventSpan(), start__lt = end, end__gt = start)
+
+
+## Repeating events stored as a chain of rows (nextRepeat). Walking the chain in python costs a query per occurrence,
+# so we have the database follow it with a recursive query instead (sqlite and postgres both support them)
+def repeatChain(eventId, wholeSeries = False):
+    """ The event and every later occurrence in its series (or every occurrence, with wholeSeries), in order, with
+    just their ids and starts loaded """
+    table = connection.ops.quote_name(Event._meta.db_table)
+    nextColumn = connection.ops.quote_name(Event._meta.get_field('nextRepeat').column)
+    previous, first = "", "%s"
+    if wholeSeries: # Walk back to the first occurrence, then forwards from there
+        previous = f"""previous(id, depth) AS (
+            SELECT id, 0 FROM {table} WHERE id = %s
+            UNION ALL
+            SELECT event.id, previous.depth + 1 FROM {table} event JOIN previous ON event.{nextColumn} = previous.id
+        ),"""
+        first = "(SELECT id FROM previous ORDER BY depth DESC LIMIT 1)"
+    return list(Event.objects.raw(f"""
+        WITH RECURSIVE {previous} chain(id, nextId, depth) AS (
+            SELECT id, {nextColumn}, 0 FROM {table} WHERE id = {first}
+            UNION ALL
+            SELECT event.id, event.{nextColumn}, chain.depth + 1 FROM {table} event JOIN chain ON event.id = chain.nextId
+        )
+        SELECT event.id, event.start FROM chain JOIN {table} event ON event.id = chain.id ORDER BY chain.depth
+        """, [eventId]))
+
+def followingRepeats(eventId):
+    """ The event and every later occurrence in its series """
+    return repeatChain(eventId)
+
+def seriesRepeats(eventId):
+    """ Every occurrence in the event's series """
+    return repeatChain(eventId, wholeSeries = True)
@@ -0,0 +1,121 @@
+"""
+caching.py - a shared cache for the public feeds
+
+getUpcoming, getAll, getTags and the landing page compute the same few tag/audience filtered lists over and over,
+even though everyone asking for the same tags gets the same events. So we cache the serialized body, keyed on
+what actually changes the result: (endpoint, the tags asked for, whether they can see student only events, the
+time window, and the events/tags versions from versions.py). The one per user bit, isFavorited, is left out of the
+cached body and filled in afterwards by overlayFavorites, so one cached body serves everyone.
+
+The cache is per process, but the versions are in the database, so a write from any process (another worker, the
+nightly scrape) moves every process on to new keys right away. The receivers in signals.py also drop this
+process's entries when events or tags change, just so the outdated ones don't sit around taking up room; the
+rest expire after FEED_CACHE_SECONDS, and the least recently used ones are evicted once there are more than
+FEED_CACHE_MAX_ENTRIES.
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+MAX_ENTRIES = getattr(settings, 'FEED_CACHE_MAX_ENTRIES', 256)
+ENTRY_SECONDS = getattr(settings, 'FEED_CACHE_SECONDS', 300)
+WINDOW_SECONDS = getattr(settings, 'FEED_CACHE_WINDOW_SECONDS', 60)
+
+# Which endpoints depend on what, so a change only drops the entries it affects
+EVENT_FEEDS = ('upcoming', 'all', 'home')
+TAG_FEEDS = ('upcoming', 'all', 'home', 'tags')
+
+
+class ExpiringLRUCache:
+    """ A thread safe LRU cache with expiring entries. For the feeds, keys are tuples starting with the endpoint """
+
+    def __init__(self, maxEntries = MAX_ENTRIES, entrySeconds = ENTRY_SECONDS):
+        self.maxEntries = maxEntries
+        self.entrySeconds = entrySeconds
+        self.entries = OrderedDict() # key -> (expiry, value), least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ The cached value for the key, or None """
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        """ Caches a value, evicting the least recently used entries if we're full """
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.entrySeconds, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last = False)
+
+    def getOrSet(self, key, compute):
+        """ The cached value for the key, computing and caching it first if needed """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def delete(self, key):
+        """ Drops a single entry if it's there """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def deleteWhere(self, test):
+        """ Drops every entry whose (key, value) passes the test """
+        with self.lock:
+            for key in [key for key, (_, value) in self.entries.items() if test(key, value)]:
+                del self.entries[key]
+
+    def invalidate(self, endpoints = None):
+        """ Drops every entry for the given endpoints (or every entry if none are given). Only frees up room, since
+        the feed entries are keyed on the versions anyway """
+        with self.lock:
+            if endpoints is None:
+                self.entries.clear()
+                return
+            for key in [key for key in self.entries if key[0] in endpoints]:
+                del self.entries[key]
+
+
+feedCache = ExpiringLRUCache()
+
+
+def currentWindow():
+    """ The current time, rounded down to the cache window, so requests in the same window share an entry """
+    now = timezone.now()
+    return now - timedelta(seconds = now.timestamp() % WINDOW_SECONDS)
+
+def windowEnd(window):
+    """ When a cache window ends. Feeds of what hasn't finished yet filter on this rather than on the start of the
+    window, so nothing in a shared entry has already ended while it's being served (at worst, something ending in
+    the next WINDOW_SECONDS drops off a little early) """
+    return window + timedelta(seconds = WINDOW_SECONDS)
+
+
+def tagsKey(tags):
+    """ Normalizes a ';' separated tag list so the same tags in a different order share an entry """
+    return tuple(sorted(set(tags.split(';'))))
+
+
+def overlayFavorites(request, events, likedIDs = None):
+    """ Fills in isFavorited for the requesting user on a cached (shared, so not modified here) list of events.
+    Async views look up the user's likedIDs themselves and pass them in """
+    if not request.user.is_authenticated:
+        return events
+    if likedIDs is None:
+        likedIDs = set(request.user.likedEvents.values_list('pk', flat=True))
+    if not likedIDs:
+        return events
+    return [{**event, 'isFavorited': True} if event['id'] in likedIDs else event for event in events]
@@ -0,0 +1,55 @@
+"""
+changes.py - the signals sent when events or tags change
+
+Anything built out of the events (the search index, caches, etc.) should listen to eventsChanged and eventsDeleted
+rather than to post_save directly. Those two fire for normal saves and deletes, for tag changes, and for renamed
+orgs/tags, but code that writes events without save() (bulk_create, bulk_update, QuerySet.update) has to send them
+itself, since django won't.
+
+    eventsChanged.send(sender=Event, eventIds=[...])
+
+Same goes for tags: anything that creates, renames or deletes them without save()/delete() should send tagsChanged.
+
+Saving or deleting lots of events one at a time (like QuerySet.delete() does under the hood) would send a signal per
+event, so wrap those in batchedEventSignals() to send one of each at the end instead.
+
+They live here rather than in signals.py (where the receivers are) so the code that sends them doesn't have to
+import everything the receivers do.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.dispatch import Signal
+
+from api.models import Event
+
+# Both are sent with eventIds, an iterable of the affected event ids
+eventsChanged = Signal()
+eventsDeleted = Signal()
+tagsChanged = Signal() # Sent with nothing else
+
+pending = threading.local() # The event ids collected by batchedEventSignals, per thread
+
+def sendEventSignal(signal, eventIds):
+    """ Sends eventsChanged/eventsDeleted, or holds onto the ids if we're in batchedEventSignals """
+    batch = getattr(pending, 'batch', None)
+    if batch is None:
+        signal.send(sender=Event, eventIds=eventIds)
+    else:
+        batch[signal].update(eventIds)
+
+@contextmanager
+def batchedEventSignals():
+    """ Collects the event signals sent by saves and deletes in the block, and sends them once when it's done """
+    if getattr(pending, 'batch', None) is not None: # Already batching further up
+        yield
+        return
+    pending.batch = {eventsChanged: set(), eventsDeleted: set()}
+    try:
+        yield
+    finally:
+        batch, pending.batch = pending.batch, None
+    if batch[eventsDeleted]:
+        eventsDeleted.send(sender=Event, eventIds=batch[eventsDeleted])
+    if batch[eventsChanged] - batch[eventsDeleted]:
+        eventsChanged.send(sender=Event, eventIds=batch[eventsChanged] - batch[eventsDeleted])
@@ -0,0 +1,104 @@
+"""
+feeds.py - each user's For You feed, kept up to date as things change
+
+The For You feed is every upcoming event that matches one of the user's interested tags, is hosted by an org they
+follow, or that they've liked. Working that out per request means joining across four tables, so we keep the
+matches in FeedEntry instead, each with an affinity score (TAG_WEIGHT per matching tag, plus ORG_WEIGHT for a
+followed org and LIKED_WEIGHT for a liked event). The receivers in signals.py update the entries for events when
+they change (eventsChanged) and for users when their tags, follows or likes change, so reading the feed is one
+indexed query. Recency isn't stored, since it changes as time passes: it's applied when the feed is read, as
+RECENCY_WEIGHT off the score per day until the event starts.
+
+Entries for events that have passed are just ignored, and cleared out by the rebuildfeeds command (which also
+fills in every feed from scratch, e.g. after first migrating).
+"""
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Value
+from django.utils import timezone
+
+import api.recurrence as recurrence
+from api.models import Event, FeedEntry, User
+
+TAG_WEIGHT = 1.0
+ORG_WEIGHT = 2.0
+LIKED_WEIGHT = 3.0
+RECENCY_WEIGHT = 0.1 # Per day until it starts
+FEED_DAYS = getattr(settings, 'FOR_YOU_DAYS', 14) # How far ahead the feed looks
+BATCH_SIZE = 500
+
+
+def upcomingEvents(now = None):
+    """ Events (and series stored as a rule) that haven't finished yet """
+    now = now or timezone.now()
+    return Event.objects.filter(Q(end__gte = now) | Q(repeatUntil__gte = now))
+
+
+def scoreEntries(events, userIds = None):
+    """ The FeedEntries (unsaved) for the events, for every user they match or just the given users """
+    # Every (user, event) match, with what matched and the event's times, in one query
+    def matching(through, eventPath, kind):
+        rows = through.objects.filter(**{f"{eventPath}__in": events})
+        if userIds is not None:
+            rows = rows.filter(user_id__in = userIds)
+        return rows.annotate(kind = Value(kind)).values_list('user_id', eventPath, f"{eventPath}__start",
+                                                              f"{eventPath}__end", f"{eventPath}__repeatUntil", 'kind')
+    rows = matching(User.interestedTags.through, 'tag__event', 'tags').union(
+               matching(User.followedOrgs.through, 'organization__childEvents', 'org'),
+               matching(User.likedEvents.through, 'event', 'liked'), all = True)
+
+    matches = defaultdict(Counter) # (user, event) -> what matched
+    spans = {}
+    for userId, eventId, start, end, repeatUntil, kind in rows:
+        matches[(userId, eventId)][kind] += 1
+        spans[eventId] = (start, end if repeatUntil is None else repeatUntil + (end - start))
+    return [FeedEntry(user_id = userId, event_id = eventId, start = spans[eventId][0], end = spans[eventId][1],
+                      score = TAG_WEIGHT * match['tags'] + ORG_WEIGHT * match['org'] + LIKED_WEIGHT * match['liked'])
+            for (userId, eventId), match in matches.items()]
+
+
+def updateEvents(eventIds):
+    """ Recomputes every feed's entries for the events """
+    eventIds = list(eventIds)
+    with transaction.atomic(savepoint = False):
+        FeedEntry.objects.filter(event_id__in = eventIds).delete()
+        FeedEntry.objects.bulk_create(scoreEntries(upcomingEvents().filter(pk__in = eventIds)),
+                                      batch_size = BATCH_SIZE)
+
+def updateUsers(userIds):
+    """ Recomputes the users' feeds """
+    userIds = list(userIds)
+    with transaction.atomic(savepoint = False):
+        FeedEntry.objects.filter(user_id__in = userIds).delete()
+        FeedEntry.objects.bulk_create(scoreEntries(upcomingEvents(), userIds), batch_size = BATCH_SIZE)
+
+def rebuild():
+    """ Recomputes every feed from scratch, dropping the entries for events that have passed """
+    with transaction.atomic():
+        FeedEntry.objects.all().delete()
+        FeedEntry.objects.bulk_create(scoreEntries(upcomingEvents()), batch_size = BATCH_SIZE)
+
+
+def forYou(user, limit = None):
+    """ The user's upcoming matching events (and occurrences of matching repeating events), best first """
+    now = timezone.now()
+    horizon = now + timedelta(days = FEED_DAYS)
+    entries = FeedEntry.objects.filter(user = user, end__gte = now, start__lt = horizon)
+    if getattr(user, 'type', None) != "STU": # hide student-only events if user is not a student
+        entries = entries.exclude(event__studentsOnly = True)
+    entries = entries.select_related('event__host', 'event__parentOrg', 'event__previousRepeat')
+    entries = list(entries.prefetch_related('event__tags'))
+
+    scores = {entry.event_id: entry.score for entry in entries}
+    events = [entry.event for entry in entries if entry.event.repeatUntil is None]
+    events += recurrence.expand([entry.event for entry in entries if entry.event.repeatUntil is not None],
+                                now, horizon)
+
+    def rank(event):
+        daysAway = max((event.start - now).total_seconds() / 86400, 0)
+        return (-(scores[event.pk] - RECENCY_WEIGHT * daysAway), event.start, event.pk)
+    events.sort(key = rank)
+    return events if limit is None else events[:limit]
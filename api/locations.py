@@ -0,0 +1,95 @@
+"""
+locations.py - coordinates for places around campus, by name
+
+The calendar only has coordinates for some events, so for the rest the scrape looks for the names of places it knows
+in the event's location. The places are Location rows, editable in the admin (and seeded with the ones we started
+with), which every process compiles into one regex the first time it needs them. Each branch of the regex is a
+lookahead for one place's keywords, tried in priority order, so a location mentioning two places gets the first one
+rather than whichever is mentioned first. Lookups are memoized, since the same few strings come up over and over.
+Saving or deleting a Location starts over (see signals.py).
+"""
+import re
+import threading
+
+from api.models import Location
+
+MAX_MEMOIZED = 10000
+
+# What we started with, in priority order: (name, keywords, (lat, long))
+DEFAULT_LOCATIONS = [
+    ("HSSC", ['hssc', 'humanities and social science'], (41.750897, -92.72107)),
+    ("Noyce", ['noyce'], (41.748778, -92.720069)),
+    ("JRC", ['jrc', 'rosenfield center'], (41.74929, -92.720118)),
+    ("Burling", ['burling'], (41.74672, -92.720287)),
+    ("Bucksbaum", ['bucksbaum'], (41.746485, -92.721170)),
+    ("Steiner", ['steiner'], (41.747309, -92.722076)),
+    ("CRSSJ", ['crssj'], (41.749286, -92.723188)),
+    ("Forum", ['forum'], (41.74748, -92.720104)),
+    ("Kington", ['kington'], (41.748449, -92.721456)),
+    ("Harris", ['harris'], (41.751082, -92.720641)),
+    ("Herrick", ['herrick'], (41.747604, -92.722204)),
+    ("Main Hall", ['main hall'], (41.74664, -92.718331)),
+    ("Bear", ['bear', 'charles benson', 'brac', 'darby'], (41.752130, -92.719527)),
+    ("Rosenbloom Field", ['rosenbloom', 'football field', 'stride field'], (41.75318, -92.719881)),
+    ("Osgood Natatorium", ['osgood', 'natatorium'], (41.752342, -92.720638)),
+    ("Track", ['track'], (41.752342, -92.720638)),
+    ("Tennis Courts", ['tennis courts'], (41.752765, -92.718050)),
+    ("Central Park", ['central park'], (41.74238, -92.723181)),
+    ("Stew", ['stew'], (41.744202, -92.724325)),
+]
+
+
+def seedLocations(**_kwargs):
+    """ Adds the default locations if there aren't any. Hooked up to post_migrate """
+    if Location.objects.exists():
+        return
+    Location.objects.bulk_create([Location(name = name, keywords = ', '.join(keywords), lat = lat, long = long,
+                                           priority = priority)
+                                  for priority, (name, keywords, (lat, long)) in enumerate(DEFAULT_LOCATIONS)])
+    gazetteer.markStale()
+
+
+class Gazetteer:
+    """ Every Location compiled into one matcher, plus what we've already looked up with it """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pattern = None
+        self.coordinates = [] # The coordinates for each branch of the pattern
+        self.memo = {}
+
+    def markStale(self):
+        """ Recompiles on the next lookup """
+        with self.lock:
+            self.pattern = None
+            self.memo = {}
+
+    def compile(self):
+        """ Builds the pattern from the Locations """
+        branches = []
+        coordinates = []
+        for keywords, lat, long in Location.objects.order_by('priority', 'pk').values_list('keywords', 'lat', 'long'):
+            terms = [re.escape(term.strip().lower()) for term in keywords.split(',') if term.strip()]
+            if terms:
+                branches.append(f"(?=.*?(?:{'|'.join(terms)}))(?P<place{len(coordinates)}>)")
+                coordinates.append((lat, long))
+        # Never matches if there aren't any places
+        self.pattern = re.compile('|'.join(branches) if branches else r'(?!)', re.DOTALL)
+        self.coordinates = coordinates
+        self.memo = {}
+
+    def lookup(self, location):
+        """ The (lat, long) of the first known place mentioned in the location string, or (None, None) """
+        with self.lock:
+            if location in self.memo:
+                return self.memo[location]
+            if self.pattern is None:
+                self.compile()
+            match = self.pattern.match(location.lower())
+            coordinates = self.coordinates[int(match.lastgroup[5:])] if match else (None, None)
+            if len(self.memo) >= MAX_MEMOIZED:
+                self.memo = {}
+            self.memo[location] = coordinates
+            return coordinates
+
+gazetteer = Gazetteer()
@@ -0,0 +1,19 @@
+"""
+This file creates a command that can be run from the command line. It recomputes everyone's For You feed from
+scratch (see api/feeds.py), which fills them in after first migrating and clears out entries for events that have
+passed. Feeds are otherwise kept up to date as things change, so running it nightly from cron is plenty.
+"""
+from django.core.management.base import BaseCommand
+
+from api import feeds
+from api.models import FeedEntry
+
+
+## This is what allows us to run this as a command from the console. The command name is the filename
+class Command(BaseCommand):
+    """ The wraper to run this command from the terminal """
+    help = "Recomputes every user's For You feed"
+
+    def handle(self, *args, **options):
+        feeds.rebuild()
+        self.stdout.write(f"{FeedEntry.objects.count()} feed entries")
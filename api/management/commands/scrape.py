@@ -2,20 +2,37 @@
 This file creates a command that can be run from the command line. It scrapes events from Grinnell's live
 calendar via API and is run by cron on the server every night.
 """
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from decimal import Decimal
+from itertools import islice
+from pathlib import Path
+import difflib
+import hashlib
 import json
 import re
+import threading
 import pytz
-from django.core.exceptions import ObjectDoesNotExist
+import requests
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from requests import get
+from django.db import transaction
+from requests.adapters import HTTPAdapter
 
-from api.aux_functions import addEventTags
-from api.models import Event, User
+from api.aux_functions import bulkAddEventTags, normalizeTagName
+from api.changes import eventsChanged
+from api.locations import gazetteer
+from api.models import Event, FeedFingerprint, User
 
 CST = pytz.timezone('America/Chicago')
 
-autoPopulateUser = User.objects.get(username="moderator")
+BATCH_SIZE = 500 # Rows per bulk insert/update/lookup
+# The fields the scrape fills in (and keeps up to date) on the events it populates
+SYNCED_FIELDS = ['title', 'location', 'start', 'end', 'description', 'studentsOnly', 'liveWhaleID', 'contactEmail',
+                 'lat', 'long']
+ALT_LOCATION_NOTE = "\n<br><i>Potential Alternative/Rain Location Automatically Detected: {}</i>"
+COORDINATE_PLACES = Decimal('0.000001') # What Event.lat/long store
 
 # RSS_URL = "https://events.grinnell.edu/live/rss/events"
 
@@ -35,169 +52,475 @@ autoPopulateUser = User.objects.get(username="moderator")
 #     return False
 
 
-def checkCommonGrinnellLocations(loc_name):
-    """ Checks a location string for common location names and returns the coordinates of that place if on record. """
-    loc_name = loc_name.lower()
-    knownLocations = [(['hssc', 'humanities and social science'] , (41.750897, -92.72107)),
-                        (['noyce'],(41.748778, -92.720069)),
-                        (['jrc', 'rosenfield center'],(41.74929, -92.720118)),
-                        (['burling'],(41.74672, -92.720287)),
-                        (['bucksbaum'],(41.746485, -92.721170)),
-                        (['steiner'],(41.747309, -92.722076)),
-                        (['crssj'],(41.749286, -92.723188)),
-                        (['forum'],(41.74748, -92.720104)),
-                        (['kington'],(41.748449, -92.721456)),
-                        (['harris'],(41.751082, -92.720641)),
-                        (['herrick'],(41.747604, -92.722204)),
-                        (['main hall'],(41.74664, -92.718331)),
-                        (['bear', 'charles benson', 'brac', 'darby'],(41.752130, -92.719527)),
-                        (['rosenbloom','football field', 'stride field'], (41.75318, -92.719881)),
-                        (['osgood', 'natatorium'],(41.752342, -92.720638)),
-                        (['track'],(41.752342, -92.720638)),
-                        (['tennis courts'],(41.752765, -92.718050)),
-                        (['central park'],(41.74238, -92.723181)),
-                        (['stew'],(41.744202, -92.724325))
-                     ]
-
-    for terms, coords in knownLocations:
-        if any(x in loc_name for x in terms):
-            return coords
-
-    return (None, None)
-
 #pylint: disable=C0301
 #JSON_URL = "https://events.grinnell.edu/live/json/events/response_fields/all/near_location/8421/near_distance/10/paginate/false"
 #JSON_URL = "https://events.grinnell.edu/live/json/events/response_fields/all/near_location/8421/near_distance/10"
 JSON_URL = "https://events.grinnell.edu/live/json/events/response_fields/all/paginate/"
+PAGE_URL = JSON_URL + "{pageSize}/page/{page}"
+PAGE_SIZE = 100 # Events per page of the feed
+FETCH_WORKERS = 4 # Pages downloaded at once
+FETCH_TIMEOUT = 20
+CACHE_DIR = getattr(settings, 'SCRAPE_CACHE_DIR', None) # Where the last fetched pages are kept (None to not)
+# How similar (0 to 1) two titles at the same time need to be to count as the same event. None to need them equal
+FUZZY_TITLE_CUTOFF = getattr(settings, 'SCRAPE_FUZZY_TITLE_CUTOFF', None)
 # JSON_URL = "https://events.grinnell.edu/live/json/events/response_fields/all"
 
 
-def scrapeCalendar(num_events = "false"):
-    """ Scrapes Grinnell's events JSON feed """
-    url =JSON_URL + str(num_events)
-    events = json.loads(get(url, timeout=20).text)['data']
-
-    # Process the events
-    for event in events: # TODO: Add filtering for intended audience (at least make sure it's not profs)
-                         # And by location. And add tags for student orgs
-        title = event['title'].strip().replace('&amp;','&') # Replace the HTML & with &
-        startTime = datetime.strptime(event['date_utc'], "%Y-%m-%d %H:%M:%S")
-        startTime = pytz.utc.localize(startTime) # Make it timezone aware
-        if event['date2_utc']:
-            endTime = datetime.strptime(event['date2_utc'], "%Y-%m-%d %H:%M:%S")
-            endTime = pytz.utc.localize(endTime)
+def toCoordinate(value):
+    """ A coordinate rounded the way the database stores it, so it compares equal to what we already have """
+    if value is None or value == '':
+        return None
+    return Decimal(str(value)).quantize(COORDINATE_PLACES)
+
+
+def parseFeedItem(event):
+    """ Pulls what we store out of an item of the calendar feed. Returns (fields, tags), or None to skip it """
+    # TODO: Add filtering for intended audience (at least make sure it's not profs)
+    # And by location. And add tags for student orgs
+    title = event['title'].strip().replace('&amp;','&') # Replace the HTML & with &
+    startTime = datetime.strptime(event['date_utc'], "%Y-%m-%d %H:%M:%S")
+    startTime = pytz.utc.localize(startTime) # Make it timezone aware
+    if event['date2_utc']:
+        endTime = datetime.strptime(event['date2_utc'], "%Y-%m-%d %H:%M:%S")
+        endTime = pytz.utc.localize(endTime)
+    else:
+        endTime = startTime + timedelta(hours = 1) # If we don't know the end time, assume lasts an hour
+
+    if event['location_title']:
+        location = event['location_title']
+    else:
+        location = event['location']
+
+    if not location: # The calendar contains all day non-location holidays and stuff that aren't really *events*
+        return None
+
+    location = location.replace('&#160;','').replace('&amp;','&')
+    if event['location_latitude'] and event['location_longitude']:
+        lat = event['location_latitude']
+        long = event['location_longitude']
+    else:
+        # Check the lookup table for different common locations
+        lat, long = gazetteer.lookup(location) # TODO: Does this check for home vs away? No, but looks like the away are usually just names of the city
+
+    if event['description']:
+        description = event['description'].strip() # We won't clear the html here cause we're rendering it on the frontend
+    else:
+        description = "" #pylint: disable=C0103
+
+    # Get the existing tags
+    tags = set()
+    if event['tags']:
+        temp = list(map(lambda x: x.replace('Student Activity', 'Student Activities'), event['tags']))
+        tags.update(temp)
+    if event['event_types']:
+        tags.update(event['event_types'])
+    tags = list(tags)
+
+    # People don't give a shit about tabling, but instead of just kicking them out, we'll tag them
+    if ('tabling' in title.lower()) or ('tabling' in description.lower()):
+                    # Idk, is it possible some don't have a title? Prob not
+        tags.append('Tabling')
+
+    # Same with SCL or mentor seshs
+    terms = ['mentor session', "scl "]
+    if any(x in title.lower() for x in terms) or any(x in description.lower() for x in terms):
+        tags.append('Mentor Session')
+        try:
+            tags.remove('Student Activities') # We don't want them to fall in with regular activities
+        except ValueError:
+            pass
+
+    # This is for letting us claim events and implement contacting event hosts
+    if 'contact_info' in event:
+        contactEmail = re.search(r'[\w.+-]+@[\w-]+\.[\w.-]+', event['contact_info']).group(0).lower()
+    elif 'registration_owner_email' in event:
+        contactEmail = event['registration_owner_email']
+    else:
+        contactEmail = None
+
+    fields = {'title': title, 'location': location, 'start': startTime, 'end': endTime, 'description': description,
+              'studentsOnly': False, # I'm going to assume thats if it was on the college's public calendar, we
+                                     # don't need to hide it but also I know not all are, so maybe find a clever way
+              'liveWhaleID': event['id'], # Record the livewhale ID so we can avoid duplicates later
+              'contactEmail': contactEmail, 'lat': toCoordinate(lat), 'long': toCoordinate(long)}
+    return fields, tags
+
+
+def fingerprint(fields, tags):
+    """ A hash of everything we take from a feed item, to tell whether it's changed since the last scrape """
+    content = [fields[name] for name in SYNCED_FIELDS] + sorted({normalizeTagName(tag) for tag in tags})
+    return hashlib.sha256(json.dumps(content, default=str).encode()).hexdigest()
+
+
+def normalizeTitle(title):
+    """ A title ignoring case, punctuation and spacing, so 'Film Night: Alien' and 'film night - alien' match """
+    return re.sub(r'[\W_]+', ' ', title.casefold().replace('&', ' and ')).strip()
+
+
+class DuplicateIndex:
+    """ Events by when they are and their normalized title, to spot the calendar listing the same event twice under
+    different ids (revisions and rain locations). With a fuzzyCutoff, titles at the same times that are at least that
+    similar also match, which catches small edits like a typo being fixed """
+
+    def __init__(self, fuzzyCutoff = FUZZY_TITLE_CUTOFF):
+        self.fuzzyCutoff = fuzzyCutoff
+        self.events = defaultdict(lambda: defaultdict(list)) # (start, end) -> normalized title -> events
+        self.keys = {} # id(event) -> where it's filed, so we can move it when it changes
+
+    def add(self, event):
+        """ Indexes an event """
+        times, title = (event.start, event.end), normalizeTitle(event.title)
+        self.events[times][title].append(event)
+        self.keys[id(event)] = (times, title)
+
+    def update(self, event):
+        """ Re-files an indexed event after its title or times might have changed """
+        key = self.keys.get(id(event), None)
+        if key is None or key == ((event.start, event.end), normalizeTitle(event.title)):
+            return
+        times, title = key
+        self.events[times][title].remove(event)
+        if not self.events[times][title]:
+            del self.events[times][title]
+        self.add(event)
+
+    def matches(self, title, start, end):
+        """ The indexed events that look like the same event as the given title and times """
+        atTimes = self.events.get((start, end), None)
+        if not atTimes:
+            return []
+        title = normalizeTitle(title)
+        if title in atTimes:
+            return atTimes[title]
+        if self.fuzzyCutoff is None:
+            return []
+        closest = difflib.get_close_matches(title, list(atTimes), n = 1, cutoff = self.fuzzyCutoff)
+        return atTimes[closest[0]] if closest else []
+
+
+class EventUpsert:
+    """ Applies a whole feed to the database in a fixed number of queries, rather than a few per event.
+
+    Everything we might match against (events with the feed's liveWhaleIDs, and the moderator's events in the feed's
+    date range) is loaded up front and indexed in memory, the items are applied to those in order exactly like
+    the one at a time version did (including to events created earlier in the same run), and then only the rows
+    that actually changed are written with bulk_update/bulk_create in one transaction """
+
+    def __init__(self, items, moderator):
+        self.moderator = moderator
+        self.toCreate = [] # New events, in feed order
+        self.dirty = {} # pk -> existing event with changes to write
+        self.newTags = [] # (event, tag names) to add
+        self.byLiveWhaleID = {}
+        self.duplicates = DuplicateIndex() # The moderator's events
+
+        if not items:
+            return
+        self.byLiveWhaleID = Event.objects.in_bulk([fields['liveWhaleID'] for fields, _ in items],
+                                                   field_name = 'liveWhaleID')
+        loaded = {event.pk: event for event in self.byLiveWhaleID.values()}
+        starts = [fields['start'] for fields, _ in items]
+        for event in Event.objects.filter(host = moderator, start__range = (min(starts), max(starts))):
+            loaded.setdefault(event.pk, event) # Use the same instance if we already have it
+        for event in loaded.values(): # Including ones outside the range, since an update might move them into it
+            if event.host_id == moderator.pk:
+                self.duplicates.add(event)
+
+        # The rain location check treats the newest event as the alternative, and older ones as revisions
+        self.newestPk = Event.objects.order_by('-pk').values_list('pk', flat = True).first()
+        self.newestPending = None
+
+    def isNewest(self, event):
+        """ Whether nothing's been created after the event """
+        if self.newestPending is not None:
+            return event is self.newestPending
+        return event.pk is not None and event.pk == self.newestPk
+
+    def apply(self, event, fields):
+        """ Sets the fields on an existing (or pending) event, keeping the indexes and the write set up to date """
+        changed = {name: value for name, value in fields.items() if getattr(event, name) != value}
+        if not changed:
+            return
+        oldID = event.liveWhaleID
+        for name, value in changed.items():
+            setattr(event, name, value)
+        self.duplicates.update(event)
+        if event.liveWhaleID != oldID:
+            if self.byLiveWhaleID.get(oldID) is event:
+                del self.byLiveWhaleID[oldID]
+            self.byLiveWhaleID[event.liveWhaleID] = event
+        if event.pk is not None: # Pending ones get written when they're created
+            self.dirty[event.pk] = event
+
+    def add(self, fields, tags):
+        """ Applies one item of the feed. Returns the event it went into (None if it was skipped), and whether that's
+        a new one """
+        event = self.byLiveWhaleID.get(fields['liveWhaleID'], None)
+        if event is not None:
+            if event.host_id != self.moderator.pk: # We want to avoid changing them if someone has claimed it
+                return None, False
+            self.apply(event, fields)
+            self.newTags.append((event, tags))
+            return event, False
+
+        # If there's nothing with that LiveWhale ID, that means we don't have this event yet. Ok clearly the livewhale
+        # filtering alone wasn't enough since there's lots of duplicates all over the place. Seems like the college
+        # often updates events/puts two down for rain locations and those have different IDS
+        ## TODO: Support Rain/Alt Locations
+        matches = self.duplicates.matches(fields['title'], fields['start'], fields['end'])
+        if len(matches) == 1:
+            match = matches[0]
+            description = fields['description']
+            # Idk this just is the best I can think of. If something's wrong, they can make an account
+            if any(x in description.lower() for x in [" overflow ", " rain "]):
+                description = match.description
+            update = {**fields, 'description': description}
+            if fields['location'] != match.location:
+                if self.isNewest(match): # If the match is the most recent, it's likely it's an alternative, if it's not then it might be a revision
+                    update['description'] += ALT_LOCATION_NOTE.format(fields['location'])
+                    del update['location'], update['liveWhaleID'] # Keep the original's
+                else:
+                    update['description'] += ALT_LOCATION_NOTE.format(match.location)
+            self.apply(match, update)
+            return match, False
+        if matches:
+            return None, False
+
+        event = Event(host = self.moderator, **fields)
+        self.toCreate.append(event)
+        self.byLiveWhaleID[event.liveWhaleID] = event
+        self.duplicates.add(event)
+        self.newestPending = event
+        self.newTags.append((event, tags))
+        return event, True
+
+    def save(self):
+        """ Writes everything in one transaction. Returns the ids of the events that changed """
+        with transaction.atomic():
+            Event.objects.bulk_update(self.dirty.values(), SYNCED_FIELDS, batch_size = BATCH_SIZE)
+            Event.objects.bulk_create(self.toCreate, batch_size = BATCH_SIZE)
+            if any(event.pk is None for event in self.toCreate): # Not every database hands back the new ids
+                created = Event.objects.in_bulk([event.liveWhaleID for event in self.toCreate],
+                                                field_name = 'liveWhaleID')
+                for event in self.toCreate:
+                    event.pk = created[event.liveWhaleID].pk
+            # The feed's tags are only ever added, never removed
+            tagged = bulkAddEventTags(self.newTags, create_new = True, sendSignals = False)
+        return set(self.dirty) | {event.pk for event in self.toCreate} | tagged
+
+
+def ingestFeed(feedItems, moderator = None):
+    """ Adds/updates the auto-populated events from the items of the calendar feed. Items that haven't changed since
+    the last scrape are skipped before we look at any events. Returns how many were inserted, updated, unchanged
+    and skipped (no location, claimed, or too many possible duplicates) """
+    if moderator is None:
+        moderator = User.objects.get(username="moderator")
+    counts = Counter(inserted = 0, updated = 0, unchanged = 0, skipped = 0)
+
+    items = [] # (fields, tags, fingerprint) for everything we need to look at
+    for item in map(parseFeedItem, feedItems):
+        if item is None:
+            counts['skipped'] += 1
         else:
-            endTime = startTime + timedelta(hours = 1) # If we don't know the end time, assume lasts an hour
-
-        if event['location_title']:
-            location = event['location_title']
+            items.append((*item, fingerprint(*item)))
+    known = FeedFingerprint.objects.in_bulk([fields['liveWhaleID'] for fields, _, _ in items],
+                                            field_name = 'liveWhaleID')
+    changedItems = []
+    for fields, tags, itemFingerprint in items:
+        if (fields['liveWhaleID'] in known) and (known[fields['liveWhaleID']].fingerprint == itemFingerprint):
+            counts['unchanged'] += 1
         else:
-            location = event['location']
+            changedItems.append((fields, tags, itemFingerprint))
+
+    upsert = EventUpsert([(fields, tags) for fields, tags, _ in changedItems], moderator)
+    applied = [] # (liveWhaleID, fingerprint, event, whether it's new)
+    for fields, tags, itemFingerprint in changedItems:
+        event, created = upsert.add(fields, tags)
+        if event is None:
+            counts['skipped'] += 1
+        else:
+            applied.append((fields['liveWhaleID'], itemFingerprint, event, created))
+
+    with transaction.atomic():
+        changedIds = upsert.save()
+        fingerprints = {liveWhaleID: FeedFingerprint(liveWhaleID = liveWhaleID, fingerprint = itemFingerprint,
+                                                     event = event)
+                        for liveWhaleID, itemFingerprint, event, _ in applied} # Last one wins if an id's repeated
+        FeedFingerprint.objects.bulk_create(fingerprints.values(),
+            update_conflicts = True, unique_fields = ['liveWhaleID'], update_fields = ['fingerprint', 'event'],
+            batch_size = BATCH_SIZE)
+    for _, _, event, created in applied:
+        if created:
+            counts['inserted'] += 1
+        else:
+            counts['updated' if event.pk in changedIds else 'unchanged'] += 1
 
-        if not location: # The calendar contains all day non-location holidays and stuff that aren't really *events*
-            continue
+    # Bulk writes don't send any signals, so let the search index and such know about them
+    if changedIds:
+        eventsChanged.send(sender=Event, eventIds=changedIds)
+    return counts
 
-        location = location.replace('&#160;','').replace('&amp;','&')
-        if event['location_latitude'] and event['location_longitude']:
-            lat = event['location_latitude']
-            long = event['location_longitude']
-        else:
-            # Check the lookup table for different common locations
-            lat, long = checkCommonGrinnellLocations(location) # TODO: Does this check for home vs away? No, but looks like the away are usually just names of the city
 
-        if event['description']:
-            description = event['description'].strip() # We won't clear the html here cause we're rendering it on the frontend
-        else:
-            description = "" #pylint: disable=C0103
-
-        externalID = event['id'] # Record the livewhale ID so we can avoid duplicates later
-
-        # Get the existing tags
-        tags = set()
-        if event['tags']:
-            temp = list(map(lambda x: x.replace('Student Activity', 'Student Activities'), event['tags']))
-            tags.update(temp)
-        if event['event_types']:
-            tags.update(event['event_types'])
-        tags = list(tags)
-
-        # People don't give a shit about tabling, but instead of just kicking them out, we'll tag them
-        if ('tabling' in title.lower()) or ('tabling' in description.lower()):
-                        # Idk, is it possible some don't have a title? Prob not
-            tags.append('Tabling')
-
-        # Same with SCL or mentor seshs
-        terms = ['mentor session', "scl "]
-        if any(x in title.lower() for x in terms) or any(x in description.lower() for x in terms):
-            tags.append('Mentor Session')
-            try:
-                tags.remove('Student Activities') # We don't want them to fall in with regular activities
-            except ValueError:
-                pass
-
-        # This is for letting us claim events and implement contacting event hosts
-        if 'contact_info' in event:
-            contactEmail = re.search(r'[\w.+-]+@[\w-]+\.[\w.-]+', event['contact_info']).group(0).lower()
-        elif 'registration_owner_email' in event:
-            contactEmail = event['registration_owner_email']
-        else:
-            contactEmail = None
+class PageCache:
+    """ The pages of the feed we last downloaded, and the ETag/Last-Modified they came with, kept on disk so the next
+    scrape can ask LiveWhale for just the pages that changed. Each page is saved exactly as it came (so the directory
+    can be replayed with --replay), and their validators all go in one validators.json along with how many pages
+    the feed had.
 
+    New validators are only written by commit(), once the scrape that fetched them has finished. If it fails partway
+    through, the next one still has the old validators and downloads (and ingests) those pages again """
 
-        # Now we do the actual updating. We don't use get_or_create because I was too lazy to figure out what was broken
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents = True, exist_ok = True)
+        self.validators = self.saved(self.directory).get('validators', {})
+        self.staged = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def saved(directory):
+        """ What the last finished scrape left in validators.json: the 'validators' for each page and 'pageCount' """
         try:
-            event = Event.objects.get(liveWhaleID = externalID)
-            if event.host != autoPopulateUser: # We want to avoid changing them if someone has claimed it
-                continue
-
-            Event.objects.filter(liveWhaleID = externalID).update(
-                                    host = autoPopulateUser, title = title,
-                                    location = location, start = startTime, end = endTime,
-                                    description = description, studentsOnly = False,
-                                    liveWhaleID = externalID, contactEmail = contactEmail,
-                                    lat = lat, long = long)
-
-            event = Event.objects.get(liveWhaleID = externalID)
-        except ObjectDoesNotExist: # If there's nothing with that LiveWhale ID, that means we don't have this event yet
-
-            # Ok clearly the livewhale filtering alone wasn't enough since there's lots of duplicates all over the place.
-                # Seems like the college often updates events/puts two down for rain locations and those have different IDS
-            ## TODO: Support Rain/Alt Locations
-            matches = Event.objects.filter(host = autoPopulateUser, title = title, start = startTime, end = endTime)
-            if matches.count() == 1:
-                # Idk this just is the best I can think of. If something's wrong, they can make an account
-                if any(x in description.lower() for x in [" overflow ", " rain "]):
-                    description = matches[0].description
-                if location != matches[0].location:
-                    if not Event.objects.filter(pk__gt = matches[0].pk).exists(): # If the match is the most recent, it's likely it's an alternative, if it's not then it might be a revision
-                        description += f"\n<br><i>Potential Alternative/Rain Location Automatically Detected: {location}</i>"
-                        matches.update(host = autoPopulateUser, title = title, start = startTime, end = endTime,
-                                        description = description, studentsOnly = False,
-                                        contactEmail = contactEmail,
-                                        lat = lat, long = long)
-                    else:
-                        description = description + str(f"\n<br><i>Potential Alternative/Rain Location Automatically Detected: {matches[0].location}</i>"),
-                        matches.update(host = autoPopulateUser, title = title, start = startTime, end = endTime,
-                                        location = location, description = description, studentsOnly = False,
-                                        liveWhaleID = externalID, contactEmail = contactEmail,
-                                        lat = lat, long = long)
-                else:
-                    matches.update(host = autoPopulateUser, title = title, start = startTime, end = endTime,
-                                    description = description, studentsOnly = False,
-                                    liveWhaleID = externalID, contactEmail = contactEmail,
-                                    lat = lat, long = long)
-                continue
-            elif matches.count() >= 1:
-                continue
-
-            event = Event.objects.create(host = autoPopulateUser, title = title,
-                                    location = location, start = startTime, end = endTime,
-                                    description = description, studentsOnly = False, # I'm going to assume thats
-                                        # if it was on the college's public calendar, we don't need to hide it
-                                        # but also I know not all are, so maybe find a clever way to do this
-                                    liveWhaleID = externalID, contactEmail = contactEmail,
-                                    lat = lat, long = long)
-        addEventTags(event, tags, create_new = True)
+            with open(Path(directory) / 'validators.json', encoding = 'utf-8') as file:
+                saved = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        return saved if isinstance(saved, dict) else {}
+
+    def pagePath(self, page):
+        """ Where a page is saved """
+        return self.directory / f"page-{page}.json"
+
+    def requestHeaders(self, page, url):
+        """ The conditional request headers for a page we've seen before """
+        validators = self.validators.get(str(page), {})
+        if validators.get('url') != url or not self.pagePath(page).exists():
+            return {}
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('lastModified'):
+            headers['If-Modified-Since'] = validators['lastModified']
+        return headers
+
+    def read(self, page):
+        """ The saved copy of a page """
+        with open(self.pagePath(page), encoding = 'utf-8') as file:
+            return json.load(file)
+
+    def write(self, page, url, response):
+        """ Saves a freshly downloaded page """
+        self.pagePath(page).write_bytes(response.content)
+        with self.lock:
+            self.staged[str(page)] = {'url': url, 'etag': response.headers.get('ETag'),
+                                      'lastModified': response.headers.get('Last-Modified')}
+
+    def commit(self, pageCount):
+        """ Keeps the validators of the pages we've downloaded, now that they've been ingested, and drops any pages
+        past the end of the feed (ones left from when it was longer, or prefetched past the last page) """
+        with self.lock:
+            self.validators.update(self.staged)
+            self.staged = {}
+            self.validators = {page: validators for page, validators in self.validators.items()
+                               if int(page) <= pageCount}
+            temp = self.directory / 'validators.json.tmp'
+            temp.write_text(json.dumps({'pageCount': pageCount, 'validators': self.validators}), encoding = 'utf-8')
+            temp.replace(self.directory / 'validators.json')
+            for file in self.directory.glob('page-*.json'):
+                if int(file.stem.split('-')[1]) > pageCount:
+                    file.unlink()
+
+
+def fetchPage(session, page, pageSize = PAGE_SIZE, cache = None):
+    """ Downloads and parses one page of the feed. Returns the page and whether it's changed since we last saw it """
+    url = PAGE_URL.format(pageSize = pageSize, page = page)
+    headers = cache.requestHeaders(page, url) if cache else {}
+    response = session.get(url, headers = headers, timeout = FETCH_TIMEOUT)
+    if response.status_code == 304:
+        return cache.read(page), False
+    response.raise_for_status()
+    if cache:
+        cache.write(page, url, response)
+    return response.json(), True
+
+
+def feedPages(pageSize = PAGE_SIZE, workers = FETCH_WORKERS, cache = None, fetch = fetchPage):
+    """ Yields the pages of the feed in order, as (items, whether they've changed). The next few pages are downloaded
+    in the background while we work on the current one (by fetch, which takes fetchPage's arguments), so only a
+    handful are ever in memory at once """
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections = 1, pool_maxsize = workers)) # Reuse the connections
+    pool = ThreadPoolExecutor(max_workers = workers)
+    inFlight = deque()
+    nextPage = currentPage = 1
+    lastPage = None # Until the feed tells us (or we get a page that isn't full)
+    try:
+        while True:
+            while (len(inFlight) < 2 * workers) and (lastPage is None or nextPage <= lastPage):
+                inFlight.append(pool.submit(fetch, session, nextPage, pageSize, cache))
+                nextPage += 1
+            if not inFlight:
+                return
+            page, changed = inFlight.popleft().result()
+            if 'total_pages' in page.get('meta', {}):
+                lastPage = int(page['meta']['total_pages'])
+            yield page['data'], changed
+            # That was the last one (any pages after it were only prefetched before we knew)
+            if (len(page['data']) < pageSize) or (lastPage is not None and currentPage >= lastPage):
+                return
+            currentPage += 1
+    finally:
+        pool.shutdown(cancel_futures = True)
+        session.close()
+
+
+def savedFeedItems(path):
+    """ Yields the items of a saved feed: either a file with the feed's JSON, or a directory of pages saved by a
+    previous scrape """
+    path = Path(path)
+    if path.is_dir():
+        pageCount = PageCache.saved(path).get('pageCount')
+        if pageCount is None: # Not from a finished scrape, so all we can do is take every page there
+            files = sorted(path.glob('page-*.json'), key = lambda file: int(file.stem.split('-')[1]))
+        else:
+            files = [path / f"page-{page}.json" for page in range(1, pageCount + 1)]
+    else:
+        files = [path]
+    for file in files:
+        with open(file, encoding = 'utf-8') as feed:
+            feed = json.load(feed)
+        yield from feed['data'] if isinstance(feed, dict) else feed
+
+
+def ingestItems(items):
+    """ Ingests an iterable of feed items a batch at a time, so we never hold more than a batch of them """
+    moderator = User.objects.get(username="moderator")
+    counts = Counter(inserted = 0, updated = 0, unchanged = 0, skipped = 0)
+    while batch := list(islice(items, BATCH_SIZE)):
+        counts.update(ingestFeed(batch, moderator))
+    return counts
+
+
+def scrapeCalendar(pageSize = PAGE_SIZE, cacheDir = CACHE_DIR):
+    """ Scrapes Grinnell's events JSON feed, ingesting it a batch at a time as the pages come in. Pages that haven't
+    changed since the last scrape (LiveWhale answers 304) aren't ingested at all, so if none have, neither is anything """
+    cache = PageCache(cacheDir) if cacheDir else None
+    unchanged = pageCount = 0
+
+    def changedItems():
+        nonlocal unchanged, pageCount
+        for items, changed in feedPages(pageSize, cache = cache):
+            pageCount += 1
+            if changed:
+                yield from items
+            else:
+                unchanged += len(items)
+
+    counts = ingestItems(changedItems())
+    counts['unchanged'] += unchanged
+    if cache:
+        cache.commit(pageCount)
+    return counts
 
 
 ## This is what allows us to run this as a command from the console. The command name is the filename
@@ -205,5 +528,14 @@ class Command(BaseCommand):
     """ The wraper to run this command from the terminal """
     help = "Scrapes Grinnell's events calendar and adds them to GrinSync's database"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--replay', metavar = 'PATH',
+                            help = "Ingest a saved feed (a JSON file, or a directory of pages saved by a previous "
+                                   "scrape) instead of downloading it")
+
     def handle(self, *args, **options):
-        scrapeCalendar()
+        if options['replay']:
+            counts = ingestItems(savedFeedItems(options['replay']))
+        else:
+            counts = scrapeCalendar()
+        self.stdout.write(", ".join(f"{count} {outcome}" for outcome, count in counts.items()))
@@ -0,0 +1,31 @@
+"""
+This file creates a command that can be run from the command line. It sends the emails waiting in the outbox
+(see api/outbox.py), and is run by cron on the server, or kept running with --loop so mail goes out within seconds.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from api import outbox
+
+
+## This is what allows us to run this as a command from the console. The command name is the filename
+class Command(BaseCommand):
+    """ The wraper to run this command from the terminal """
+    help = "Sends the emails waiting in GrinSync's outbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action = 'store_true', help = "Keep checking for new mail instead of exiting")
+        parser.add_argument('--interval', type = float, default = 5,
+                            help = "Seconds to wait between checks with --loop")
+        parser.add_argument('--batch-size', type = int, default = outbox.BATCH_SIZE,
+                            help = "How many emails to read from the outbox at a time")
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = outbox.drain(options['batch_size'])
+            if sent or failed:
+                self.stdout.write(f"{sent} sent, {failed} failed")
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -8,6 +8,7 @@ ususally in views.py
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.forms import ValidationError
+from django.utils import timezone
 
 
 TYPES = [
@@ -73,6 +74,11 @@ class Event(models.Model):
     # For repeating events
     nextRepeat = models.OneToOneField('Event', blank = True, null=True, related_name="previousRepeat",
                                       on_delete=models.SET_NULL)
+    # Or, for series stored as a rule (see recurrence.py): repeats every repeatDays days and repeatMonths months
+    # until repeatUntil. This event is the first occurrence
+    repeatDays = models.PositiveIntegerField(default = 0)
+    repeatMonths = models.PositiveIntegerField(default = 0)
+    repeatUntil = models.DateTimeField(blank = True, null = True)
 
     # External Infomation
     liveWhaleID = models.PositiveIntegerField(blank=True, null=True, unique=True)
@@ -80,8 +86,100 @@ class Event(models.Model):
     lat = models.DecimalField(max_digits=9, decimal_places=6, blank=True, null=True)
     long = models.DecimalField(max_digits=9, decimal_places=6, blank=True, null=True)
 
+    class Meta:
+        """ Meta """
+        indexes = [
+            # Matches the (start, id) sort key the paginated list endpoints page through
+            models.Index(fields=['start', 'id'], name='event_start_id_idx'),
+            # For the calendar range queries (start bounded on both sides, end filtered from the index) and the
+            # upcoming feed, which starts from events that haven't ended yet
+            models.Index(fields=['start', 'end'], name='event_start_end_idx'),
+            models.Index(fields=['end', 'start'], name='event_end_start_idx'),
+        ]
+
     def save(self, *args, **kwargs): # pylint: disable=unused-argument
         if self.host is None and self.parentOrg is None:
             raise ValidationError("Events must have a host or hosting org")
 
         return super().save()
+
+class DataVersion(models.Model):
+    """ A counter bumped every time a kind of data changes (see versions.py), so clients and caches can cheaply
+    tell whether what they have is stale """
+    name = models.CharField(max_length=64, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+    modified = models.DateTimeField(auto_now=True)
+
+class OccurrenceOverride(models.Model):
+    """ A change to one occurrence of a series stored as a rule (see recurrence.py). Only changed or cancelled
+    occurrences have one. Fields left null keep the series' value """
+    series = models.ForeignKey(Event, related_name='overrides', on_delete=models.CASCADE)
+    occurrenceStart = models.DateTimeField() # When the occurrence would start if it hadn't been changed
+    cancelled = models.BooleanField(default=False)
+    title = models.CharField(max_length = 64, blank = True, null = True)
+    description = models.TextField(blank = True, null = True)
+    location = models.CharField(max_length = 64, blank = True, null = True)
+    start = models.DateTimeField(blank = True, null = True)
+    end = models.DateTimeField(blank = True, null = True)
+
+    class Meta:
+        """ Meta """
+        constraints = [
+            models.UniqueConstraint(fields=['series', 'occurrenceStart'], name='override_series_occurrence_unique'),
+        ]
+
+class FeedFingerprint(models.Model):
+    """ A hash of what the calendar feed last said about one of its events, so the scrape can skip the ones that
+    haven't changed without touching the events at all """
+    liveWhaleID = models.PositiveIntegerField(unique=True)
+    fingerprint = models.CharField(max_length=64)
+    # The event the item went into (deleting it forgets the fingerprint, so the next scrape brings it back)
+    event = models.ForeignKey(Event, related_name='feedFingerprints', on_delete=models.CASCADE)
+
+class Location(models.Model):
+    """ A place the scrape can find coordinates for by name, for events the calendar doesn't give coordinates for
+    (see locations.py) """
+    name = models.CharField(max_length=64)
+    # Comma separated. Any of them appearing in an event's location (ignoring case) means it's here
+    keywords = models.CharField(max_length=256)
+    lat = models.DecimalField(max_digits=9, decimal_places=6)
+    long = models.DecimalField(max_digits=9, decimal_places=6)
+    priority = models.PositiveIntegerField(default=0) # Lower goes first, for locations that mention more than one
+
+    def __str__(self):
+        return self.name
+
+class OutboxEmail(models.Model):
+    """ An email waiting to be sent (or that's been sent) by the sendmail command (see outbox.py), so requests
+    don't wait on the mail server """
+    subject = models.CharField(max_length=256)
+    body = models.TextField()
+    fromEmail = models.CharField(max_length=256)
+    recipients = models.JSONField() # A list of addresses
+    created = models.DateTimeField(auto_now_add=True)
+    sendAfter = models.DateTimeField(default=timezone.now) # Pushed back after each failed attempt
+    attempts = models.PositiveSmallIntegerField(default=0)
+    lastError = models.TextField(blank=True, default='')
+    sent = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        """ Meta """
+        indexes = [models.Index(fields=['sent', 'sendAfter'], name='outbox_due_idx')]
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.recipients)}"
+
+class FeedEntry(models.Model):
+    """ An upcoming event in a user's For You feed, with how well it matches them (see feeds.py) """
+    user = models.ForeignKey(User, related_name='feedEntries', on_delete=models.CASCADE)
+    event = models.ForeignKey(Event, related_name='feedEntries', on_delete=models.CASCADE)
+    score = models.FloatField()
+    # Copied from the event (for repeating events stored as a rule, from its first start to its last end), so the
+    # feed can be read without looking at events that have passed
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+
+    class Meta:
+        """ Meta """
+        constraints = [models.UniqueConstraint(fields=['user', 'event'], name='feed_entry_user_event_unique')]
+        indexes = [models.Index(fields=['user', 'end'], name='feed_entry_user_end_idx')]
@@ -0,0 +1,85 @@
+"""
+outbox.py - emails are queued in the database and sent in the background
+
+Sending mail inline meant every signup/claim request waited on the mail server's handshake (up to EMAIL_TIMEOUT),
+and a slow or failed send failed the whole request. Instead, views call queueMail, which just saves an OutboxEmail
+row, and the sendmail command (run by cron or as a long running worker with --loop) drains the outbox in batches
+over one connection to the mail server. A message that fails is retried with exponential backoff, up to
+OUTBOX_MAX_ATTEMPTS times; its last error is kept on the row (they show up in the admin site).
+
+Only run one sender at a time: rows aren't locked while they're being sent, so two would send the same mail twice.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.utils import timezone
+
+from api.models import OutboxEmail
+
+BATCH_SIZE = getattr(settings, 'OUTBOX_BATCH_SIZE', 50)
+MAX_ATTEMPTS = getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 8)
+RETRY_SECONDS = getattr(settings, 'OUTBOX_RETRY_SECONDS', 60) # Doubled after each failed attempt
+MAX_RETRY_SECONDS = 6 * 60 * 60
+
+
+def queueMail(subject, message, fromEmail, recipients):
+    """ Saves an email for the sender to send, like send_mail would have sent it """
+    return OutboxEmail.objects.create(subject = subject, body = message, fromEmail = fromEmail,
+                                      recipients = list(recipients))
+
+
+def retryDelay(attempts):
+    """ How long to wait before trying again after the given number of failed attempts """
+    return timedelta(seconds = min(RETRY_SECONDS * 2 ** (attempts - 1), MAX_RETRY_SECONDS))
+
+
+def dueEmails(batchSize = BATCH_SIZE):
+    """ The next emails that should be sent, oldest first """
+    return list(OutboxEmail.objects.filter(sent__isnull = True, sendAfter__lte = timezone.now(),
+                                           attempts__lt = MAX_ATTEMPTS).order_by('sendAfter', 'pk')[:batchSize])
+
+
+def failed(email, error):
+    """ Records a failed attempt and pushes the next one back """
+    email.attempts += 1
+    email.lastError = repr(error)
+    email.sendAfter = timezone.now() + retryDelay(email.attempts)
+    email.save(update_fields = ['attempts', 'lastError', 'sendAfter'])
+
+
+def sendBatch(emails, connection):
+    """ Sends the emails over an open connection, marking each as sent or failed. Returns how many were sent """
+    sentCount = 0
+    for email in emails:
+        message = EmailMessage(email.subject, email.body, email.fromEmail, email.recipients, connection = connection)
+        try:
+            message.send()
+        except Exception as e: # pylint: disable=broad-exception-caught
+            # Whatever went wrong (a bad address, the server dropping us, ...), the rest of the batch can still go
+            failed(email, e)
+            continue
+        email.sent = timezone.now()
+        email.save(update_fields = ['sent'])
+        sentCount += 1
+    return sentCount
+
+
+def drain(batchSize = BATCH_SIZE, connection = None):
+    """ Sends every email that's due, a batch at a time over one connection. Returns (sent, failed) counts """
+    connection = connection or get_connection()
+    sentCount = failedCount = 0
+    try:
+        while emails := dueEmails(batchSize):
+            try:
+                connection.open()
+            except Exception as e: # pylint: disable=broad-exception-caught
+                for email in emails: # Couldn't even reach the server, so none of them went
+                    failed(email, e)
+                return sentCount, failedCount + len(emails)
+            batchSent = sendBatch(emails, connection)
+            sentCount += batchSent
+            failedCount += len(emails) - batchSent
+    finally:
+        connection.close()
+    return sentCount, failedCount
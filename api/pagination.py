@@ -0,0 +1,125 @@
+"""
+pagination.py - keyset (cursor) pagination for the list endpoints
+
+Instead of OFFSET paging (which gets slower the further back you go), each page remembers the sort key of its
+last row in an opaque cursor, and the next page just asks the database for rows after that key. With an index on
+the sort key, every page costs about the same no matter how many events have piled up.
+
+Pagination is opt-in so the app keeps working: endpoints only paginate when the client sends 'pageSize' or 'cursor',
+and then they return {'results': [...], 'next': <cursor or null>} instead of a bare list.
+"""
+import base64
+import heapq
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = getattr(settings, 'API_DEFAULT_PAGE_SIZE', 50)
+MAX_PAGE_SIZE = getattr(settings, 'API_MAX_PAGE_SIZE', 200)
+
+# Sort keys for the different list endpoints. The last field has to be unique so the order is total
+EVENT_ORDERING = ('start', 'id')
+REVERSE_EVENT_ORDERING = ('-start', '-id')
+ORG_ORDERING = ('name', 'id')
+
+
+class InvalidPageRequest(ValueError):
+    """ Raised when a client sends a cursor or page size we can't use """
+
+
+def isPaginated(request):
+    """ Whether the client asked for a paginated response """
+    return ('pageSize' in request.GET) or ('cursor' in request.GET)
+
+
+def encodeCursor(values):
+    """ Turns the sort key of a row into an opaque, url safe cursor """
+    raw = json.dumps([value.isoformat() if hasattr(value, 'isoformat') else value for value in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decodeCursor(cursor, model, ordering):
+    """ Turns a cursor back into the (typed) sort key values it was made from """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise InvalidPageRequest("Invalid 'cursor' provided") from e
+    if (not isinstance(values, list)) or (len(values) != len(ordering)):
+        raise InvalidPageRequest("Invalid 'cursor' provided")
+
+    try:
+        return [model._meta.get_field(field.lstrip('-')).to_python(value) for field, value in zip(ordering, values)]
+    except ValidationError as e:
+        raise InvalidPageRequest("Invalid 'cursor' provided") from e
+
+
+def getPageSize(request):
+    """ Reads and bounds the requested page size """
+    try:
+        pageSize = int(request.GET.get('pageSize', DEFAULT_PAGE_SIZE))
+    except ValueError as e:
+        raise InvalidPageRequest("'pageSize' must be an integer") from e
+    if pageSize < 1:
+        raise InvalidPageRequest("'pageSize' must be positive")
+    return min(pageSize, MAX_PAGE_SIZE)
+
+
+def afterKey(ordering, values):
+    """ Builds the filter for 'rows that sort after this key', ie (a > x) or (a = x and b > y) or ... """
+    condition = Q()
+    for i, field in enumerate(ordering):
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        term = Q(**{f"{name}__{lookup}": values[i]})
+        for prevField, prevValue in zip(ordering[:i], values[:i]):
+            term &= Q(**{prevField.lstrip('-'): prevValue})
+        condition |= term
+    return condition
+
+
+def getPage(request, queryset, ordering=EVENT_ORDERING):
+    """ Returns the requested page of the queryset as a list, along with the cursor for the page after it """
+    pageSize = getPageSize(request)
+    queryset = queryset.order_by(*ordering)
+
+    cursor = request.GET.get('cursor', None)
+    if cursor:
+        queryset = queryset.filter(afterKey(ordering, decodeCursor(cursor, queryset.model, ordering)))
+
+    rows = list(queryset[:pageSize + 1]) # Grab one extra so we know if there's another page
+    if len(rows) <= pageSize:
+        return rows, None
+
+    rows = rows[:pageSize]
+    lastRow = rows[-1]
+    return rows, encodeCursor([getattr(lastRow, field.lstrip('-')) for field in ordering])
+
+
+def getMergedPage(request, queryset, extraRows, ordering=EVENT_ORDERING):
+    """ getPage for a queryset with extra rows mixed in that aren't in the database (like occurrences of repeating
+    events). extraRows(after, upTo, limit) returns the first limit of them, in order, whose sort key is after the
+    key after and no later than the key upTo (either None for no bound). Only for ascending orderings """
+    pageSize = getPageSize(request)
+    queryset = queryset.order_by(*ordering)
+
+    def keyOf(row):
+        return tuple(getattr(row, field) for field in ordering)
+
+    after = None
+    cursor = request.GET.get('cursor', None)
+    if cursor:
+        after = decodeCursor(cursor, queryset.model, ordering)
+        queryset = queryset.filter(afterKey(ordering, after))
+        after = tuple(after)
+
+    rows = list(queryset[:pageSize + 1])
+    # Extra rows past the last database row we grabbed can't make it onto this page (or tell us there's another)
+    upTo = keyOf(rows[-1]) if len(rows) > pageSize else None
+    rows = list(heapq.merge(rows, extraRows(after, upTo, pageSize + 1), key = keyOf))
+    if len(rows) <= pageSize:
+        return rows, None
+    rows = rows[:pageSize]
+    return rows, encodeCursor(list(keyOf(rows[-1])))
@@ -0,0 +1,161 @@
+"""
+recurrence.py - repeating events stored as a rule rather than a row per occurrence
+
+Repeating events used to always be a linked list of full Event rows (nextRepeat), one per occurrence. A series can
+instead be a single master row with repeatUntil set: the master is the first occurrence, and the rest repeat every
+repeatDays days and repeatMonths months until repeatUntil. Nothing stores the other occurrences; the endpoints that
+look at a window of time (getUpcoming, the calendar ranges, etc.) work out just the ones in their window, as unsaved
+copies of the master with occurrenceStart set (the id and occurrenceStart together identify an occurrence).
+Changing or cancelling a single occurrence stores an OccurrenceOverride for just that one.
+
+New repeating events are stored this way when the EVENT_REPEAT_RULES setting is on. Everything that reads events
+handles both kinds, so existing linked series keep working.
+"""
+import copy
+import heapq
+from datetime import timedelta
+
+from dateutil import relativedelta
+from django.db.models import Q
+from django.utils import timezone
+
+from api.aux_functions import getLongestEventSpan
+from api.models import OccurrenceOverride
+
+RECURRING = Q(repeatUntil__isnull = False) # Series masters
+OVERRIDDEN_FIELDS = ['title', 'description', 'location', 'start', 'end']
+
+
+def occurrenceOffset(master, i):
+    """ How far the i-th occurrence is from the first. Each is offset from the first rather than the one before, so
+    monthly series on the 31st don't slide back to the 28th after February """
+    return relativedelta.relativedelta(days = master.repeatDays * i, months = master.repeatMonths * i)
+
+
+def occurrenceStarts(master, windowStart = None, windowEnd = None):
+    """ Yields the (unchanged) start of each occurrence of the series that could overlap the window, in order """
+    firstStart = timezone.localtime(master.start) # So repeats keep the same local time across daylight savings
+    duration = master.end - master.start
+    i = 0
+    if (windowStart is not None) and master.repeatDays and not master.repeatMonths: # Skip straight to the window
+        # (one early, in case daylight savings moves the one we land on by an hour)
+        i = max(0, (windowStart - duration - master.start) // timedelta(days = master.repeatDays) - 1)
+    while True:
+        start = firstStart + occurrenceOffset(master, i)
+        if (start > master.repeatUntil) or (windowEnd is not None and start >= windowEnd):
+            return
+        if (windowStart is None) or (start + duration > windowStart):
+            yield start
+        i += 1
+
+
+def isOccurrence(master, start):
+    """ Whether the series has an occurrence starting at the given time """
+    return any(occurrence == start for occurrence in occurrenceStarts(master, start, start + timedelta(seconds = 1)))
+
+
+def expand(masters, windowStart = None, windowEnd = None):
+    """ The occurrences of the series masters overlapping [windowStart, windowEnd) (either end can be left open),
+    with their overrides applied, as unsaved Events in (start, id) order """
+    masters = list(masters)
+    if not masters:
+        return []
+
+    overrides = OccurrenceOverride.objects.filter(series__in = masters)
+    if windowStart is not None: # Overrides can move an occurrence, but we only look for them near the window
+        overrides = overrides.filter(occurrenceStart__gt = windowStart - getLongestEventSpan())
+    if windowEnd is not None:
+        overrides = overrides.filter(occurrenceStart__lt = windowEnd)
+    overrides = {(override.series_id, override.occurrenceStart): override for override in overrides}
+
+    occurrences = []
+    for master in masters:
+        duration = master.end - master.start
+        for start in occurrenceStarts(master, windowStart, windowEnd):
+            occurrence = copy.copy(master)
+            occurrence.occurrenceStart = start
+            occurrence.start, occurrence.end = start, start + duration
+            override = overrides.get((master.pk, start), None)
+            if override is not None:
+                if override.cancelled:
+                    continue
+                for field in OVERRIDDEN_FIELDS:
+                    if getattr(override, field) is not None:
+                        setattr(occurrence, field, getattr(override, field))
+                if ((windowStart is not None and occurrence.end <= windowStart) or
+                        (windowEnd is not None and occurrence.start >= windowEnd)): # Moved out of the window
+                    continue
+            occurrences.append(occurrence)
+    occurrences.sort(key = lambda occurrence: (occurrence.start, occurrence.pk))
+    return occurrences
+
+
+def seriesIn(events, windowStart = None, windowEnd = None):
+    """ The series masters among the events (a queryset that's been filtered by everything but time) that could
+    have occurrences in the window """
+    masters = events.filter(RECURRING)
+    if windowEnd is not None:
+        masters = masters.filter(start__lt = windowEnd)
+    if windowStart is not None:
+        masters = masters.filter(repeatUntil__gt = windowStart - getLongestEventSpan())
+    # (everything the serializer reads, so async views can serialize them without going back to the database)
+    return masters.select_related('host', 'parentOrg', 'previousRepeat').prefetch_related('tags')
+
+
+def occurrencesIn(events, windowStart = None, windowEnd = None):
+    """ The occurrences in the window of the series masters among the events, a queryset that's been filtered by
+    everything but time """
+    return expand(seriesIn(events, windowStart, windowEnd), windowStart, windowEnd)
+
+
+class SeriesOccurrences:
+    """ The occurrences in a window of the series masters among some events, worked out a page at a time (see
+    pagination.getMergedPage) so paging through a long window doesn't expand every occurrence for every page """
+
+    FIRST_CHUNK = timedelta(days = 31)
+
+    def __init__(self, events, windowStart = None, windowEnd = None):
+        self.windowStart = windowStart
+        self.windowEnd = windowEnd
+        self.masters = list(seriesIn(events, windowStart, windowEnd))
+
+    def all(self):
+        """ Every occurrence in the window, in (start, id) order """
+        return expand(self.masters, self.windowStart, self.windowEnd)
+
+    def page(self, after, upTo, limit):
+        """ The first limit occurrences (in (start, id) order) whose (start, id) is after the key after and no later
+        than the key upTo. Either key can be None for no bound """
+        if not self.masters:
+            return []
+        def inPage(occurrence):
+            key = (occurrence.start, occurrence.pk)
+            return (after is None or key > after) and (upTo is None or key <= upTo)
+
+        # Narrow the window to the keys (a hair wider, since windows are about overlapping rather than starting)
+        hair = timedelta(microseconds = 1)
+        start, end = self.windowStart, self.windowEnd
+        if after is not None:
+            start = after[0] - hair if start is None else max(start, after[0] - hair)
+        if upTo is not None:
+            end = upTo[0] + hair if end is None else min(end, upTo[0] + hair)
+
+        # Then expand a growing chunk of it at a time until we have enough (or run out of occurrences)
+        if start is None:
+            start = min(master.start for master in self.masters)
+        lastStart = max(master.repeatUntil for master in self.masters)
+        chunk = self.FIRST_CHUNK
+        while True:
+            chunkEnd = start + chunk if end is None else min(start + chunk, end)
+            occurrences = [occurrence for occurrence in expand(self.masters, start, chunkEnd) if inPage(occurrence)]
+            if (len(occurrences) >= limit) or (chunkEnd == end) or (chunkEnd > lastStart):
+                return occurrences[:limit]
+            chunk *= 2
+
+
+def merge(events, occurrences):
+    """ Merges occurrences into a list of regular events (both in (start, id) order). Leaves the events alone if
+    there are none, so querysets stay querysets """
+    if not occurrences:
+        return events
+    return list(heapq.merge(events, occurrences, key = lambda event: (event.start, event.pk)))
@@ -0,0 +1,152 @@
+"""
+search.py - the full text search index behind the search endpoint
+
+We keep a SQLite FTS5 table next to the events with one row per event (the rowid is the event's id) holding its
+title, location, description, host name, and tag names. The signals in signals.py keep it up to date whenever an
+event, its tags, or its host org changes, so searching is an index lookup instead of a LIKE over the whole table.
+
+Results are ranked with FTS5's BM25 (title matches count the most) and then pulled towards events close to today,
+so searching "concert" shows this week's concert before one from two years ago.
+
+FTS5 is part of the SQLite that ships with Python, but if we're ever not on SQLite (or the table is missing),
+isAvailable() returns False and the search view falls back to the old substring search.
+"""
+import re
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.db.models.expressions import RawSQL
+
+from api.models import Event
+
+FTS_TABLE = 'api_event_fts'
+FTS_COLUMNS = ['title', 'location', 'description', 'hostName', 'tags']
+COLUMN_WEIGHTS = [10.0, 4.0, 1.0, 3.0, 3.0] # Same order as the columns above
+
+# How quickly relevance drops off the further an event is from today (the score halves every this many days)
+DATE_HALF_LIFE_DAYS = getattr(settings, 'SEARCH_DATE_HALF_LIFE_DAYS', 30)
+MAX_RESULTS = getattr(settings, 'SEARCH_MAX_RESULTS', 50)
+INDEX_BATCH_SIZE = 500
+
+_available = False # Only ever cache a positive result, so the index starts working as soon as it's created
+
+
+def isAvailable():
+    """ Whether the FTS index exists and can be used """
+    global _available # pylint: disable=global-statement
+    if _available:
+        return True
+    if connection.vendor != 'sqlite':
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT 1 FROM {FTS_TABLE} LIMIT 0")
+    except DatabaseError:
+        return False
+    _available = True
+    return True
+
+
+def createIndex(**_kwargs):
+    """ Creates the FTS table if needed and fills it. Hooked up to post_migrate, so it runs on every migrate """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5({', '.join(FTS_COLUMNS)}, "
+                       "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')")
+    rebuildIndex()
+
+
+def rebuildIndex():
+    """ Throws out and re-adds every event in the index """
+    if not isAvailable():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+    eventIds = list(Event.objects.values_list('pk', flat=True))
+    for i in range(0, len(eventIds), INDEX_BATCH_SIZE):
+        indexEvents(eventIds[i:i + INDEX_BATCH_SIZE])
+
+
+def removeEvents(eventIds):
+    """ Drops the given events from the index """
+    eventIds = list(eventIds)
+    if (not eventIds) or (not isAvailable()):
+        return
+    with connection.cursor() as cursor:
+        for i in range(0, len(eventIds), INDEX_BATCH_SIZE):
+            batch = eventIds[i:i + INDEX_BATCH_SIZE]
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({', '.join(['%s'] * len(batch))})", batch)
+
+
+def indexEvents(eventIds):
+    """ (Re)indexes the given events. Ids of events that no longer exist are just dropped """
+    eventIds = list(eventIds)
+    if (not eventIds) or (not isAvailable()):
+        return
+    removeEvents(eventIds)
+
+    events = Event.objects.filter(pk__in = eventIds).select_related('host', 'parentOrg').prefetch_related('tags')
+    rows = []
+    for event in events:
+        if event.parentOrg is not None:
+            hostName = event.parentOrg.name
+        else:
+            hostName = f"{event.host.first_name} {event.host.last_name}"
+        rows.append((event.pk, event.title, event.location or '', event.description or '', hostName,
+                     ' '.join(tag.name for tag in event.tags.all())))
+
+    with connection.cursor() as cursor:
+        cursor.executemany(f"INSERT INTO {FTS_TABLE} (rowid, {', '.join(FTS_COLUMNS)}) "
+                           "VALUES (%s, %s, %s, %s, %s, %s)", rows)
+
+
+def buildMatchQuery(query):
+    """ Turns what the user typed into an FTS5 query: every word has to match, as a prefix. None if no words """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def matchingEvents(query):
+    """ A queryset of every event matching the query, unranked. Used when the client pages through results """
+    matchQuery = buildMatchQuery(query)
+    if matchQuery is None:
+        return Event.objects.none()
+    return Event.objects.filter(pk__in = RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s",
+                                                [matchQuery]))
+
+
+def searchEventIds(query, limit = MAX_RESULTS, tagIds = None, includeStudentsOnly = False):
+    """ Returns the ids of the best matching events for the query, best first. Filters are applied in the index
+    lookup itself so we still get a full top-k back """
+    matchQuery = buildMatchQuery(query)
+    if matchQuery is None:
+        return []
+
+    eventTable = connection.ops.quote_name(Event._meta.db_table)
+    tagsTable = connection.ops.quote_name(Event.tags.through._meta.db_table)
+    studentsOnly = connection.ops.quote_name(Event._meta.get_field('studentsOnly').column)
+    weights = ', '.join(str(weight) for weight in COLUMN_WEIGHTS)
+
+    # bm25 is negative (more negative is better), so dividing by the date distance pulls far away events towards 0
+    sql = (f"SELECT e.id FROM {FTS_TABLE} JOIN {eventTable} e ON e.id = {FTS_TABLE}.rowid "
+           f"WHERE {FTS_TABLE} MATCH %s")
+    params = [matchQuery]
+    if not includeStudentsOnly:
+        sql += f" AND NOT e.{studentsOnly}"
+    if tagIds is not None:
+        tagIds = list(tagIds)
+        if not tagIds:
+            return []
+        sql += (f" AND EXISTS (SELECT 1 FROM {tagsTable} t WHERE t.event_id = e.id "
+                f"AND t.tag_id IN ({', '.join(['%s'] * len(tagIds))}))")
+        params.extend(tagIds)
+    sql += (f" ORDER BY bm25({FTS_TABLE}, {weights}) / "
+            "(1.0 + abs(julianday(e.start) - julianday('now')) / %s) LIMIT %s")
+    params.extend([DATE_HALF_LIFE_DAYS, limit])
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
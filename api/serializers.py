@@ -3,7 +3,9 @@ This file contains a set of function which allow us to easily and consistently t
 can return to the client. In some of them, we create our own field to capture object relationship data that
 isn't otherwise included from django by default.
 """
+from django.db.models import Manager, prefetch_related_objects
 from rest_framework import serializers
+from .aux_functions import tagMap
 from .models import Organization, Tag, User, Event
 
 class UserSerializer(serializers.ModelSerializer):
@@ -15,30 +17,52 @@ class UserSerializer(serializers.ModelSerializer):
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
-        tags = []
-        for tagPk in data['interestedTags']:
-            tags.append(Tag.objects.get(pk=tagPk).name)
-
-        data['interestedTags'] = tags
+        data['interestedTags'] = tagMap.namesFor(data['interestedTags'])
 
         # flatten the follower data with the user data
         return {**data}
 
 
+class EventListSerializer(serializers.ListSerializer):
+    """ Serializes a list of Events in one batch, so the number of queries doesn't grow with the list """
+
+    def to_representation(self, data):
+        events = list(data.all() if isinstance(data, Manager) else data)
+
+        # Pull every relation the child serializer touches in one query each (already fetched ones are skipped)
+        prefetch_related_objects(events, *EventSerializer.PREFETCH_FIELDS)
+
+        # And look up the requesting user's likes once for the whole list rather than once per event
+        if 'likedEventIDs' not in self.context:
+            request = self.context.get('request', None)
+            if request and request.user.is_authenticated:
+                self.context['likedEventIDs'] = set(request.user.likedEvents.values_list('pk', flat=True))
+            else:
+                self.context['likedEventIDs'] = set()
+
+        return [self.child.to_representation(event) for event in events]
+
 class EventSerializer(serializers.ModelSerializer):
     """ Serializes an Event model """
 
+    # Every relation used while serializing an event, so list endpoints can load them up front
+    PREFETCH_FIELDS = ['host', 'parentOrg', 'previousRepeat', 'tags']
+
     # Create a custom method field
     isFavorited = serializers.SerializerMethodField('_isFavorite')
     hostName = serializers.SerializerMethodField('_hostName')
     prevRepeat = serializers.SerializerMethodField('_prevRepeat')
+    occurrenceStart = serializers.SerializerMethodField('_occurrenceStart')
+    tags = serializers.SlugRelatedField(many=True, read_only=True, slug_field='name')
 
     # Use this method for the custom field
     def _isFavorite(self, obj):
+        likedIDs = self.context.get('likedEventIDs', None)
+        if likedIDs is not None: # Set by the list serializer (or the caller) so we don't query per event
+            return obj.id in likedIDs
         request = self.context.get('request', None)
         if request and request.user.is_authenticated:
-            if obj.id in request.user.likedEvents.values_list('pk', flat=True):
-                return True
+            return request.user.likedEvents.filter(pk=obj.id).exists()
         return False
 
     def _hostName(self, obj):
@@ -51,22 +75,21 @@ class EventSerializer(serializers.ModelSerializer):
             return obj.previousRepeat.id
         return None
 
+    def _occurrenceStart(self, obj):
+        # Set on the occurrences of repeating events stored as rules (see recurrence.py)
+        return getattr(obj, 'occurrenceStart', None)
+
 
     class Meta:
         """ Meta """
         model = Event
         fields = '__all__'
+        list_serializer_class = EventListSerializer
 
-    def to_representation(self, instance):
-        data = super().to_representation(instance)
-        tags = []
-        for tagPk in data['tags']:
-            tags.append(Tag.objects.get(pk=tagPk).name)
-
-        data['tags'] = tags
-
-        # flatten the follower data with the user data
-        return {**data}
+    @classmethod
+    def eagerLoad(cls, queryset):
+        """ Joins/prefetches everything the serializer needs onto an Event queryset """
+        return queryset.select_related('host', 'parentOrg', 'previousRepeat').prefetch_related('tags')
 
 class TagSerializer(serializers.ModelSerializer):
     """ Serializes a Tag model """
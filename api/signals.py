@@ -0,0 +1,227 @@
+"""
+signals.py - keeps the things we derive from the database in sync with it
+
+The receivers here listen to django's model signals and to our own eventsChanged/eventsDeleted/tagsChanged (see
+changes.py for when those are sent, and how to send them yourself).
+"""
+# Receivers have to take sender and **kwargs whether they use them or not
+# pylint: disable=unused-argument
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from api import feeds, search, versions
+from api.authentication import forgetToken, forgetUser
+from api.aux_functions import tagMap
+from api.caching import EVENT_FEEDS, TAG_FEEDS, feedCache
+from api.autocomplete import suggestions
+from api.changes import eventsChanged, eventsDeleted, sendEventSignal, tagsChanged
+from api.locations import gazetteer
+from api.models import Event, Location, OccurrenceOverride, Organization, Tag, User
+
+
+@receiver(post_save, sender=Event)
+def eventSaved(sender, instance, **kwargs):
+    """ Any save might have changed what we derived from the event """
+    sendEventSignal(eventsChanged, [instance.pk])
+
+@receiver(post_delete, sender=Event)
+def eventDeleted(sender, instance, **kwargs):
+    """ Drop deleted events from anything derived from them """
+    sendEventSignal(eventsDeleted, [instance.pk])
+
+@receiver(m2m_changed, sender=Event.tags.through)
+def eventTagsChanged(sender, instance, action, reverse, pk_set, **kwargs):
+    """ Adding/removing tags changes the event (from either side of the relation) """
+    if action == 'pre_clear' and reverse: # We won't know which events lost the tag after it's cleared
+        instance.clearedEventIds = list(instance.event_set.values_list('pk', flat=True))
+    elif action in ['post_add', 'post_remove']:
+        eventsChanged.send(sender=Event, eventIds=list(pk_set) if reverse else [instance.pk])
+    elif action == 'post_clear':
+        eventsChanged.send(sender=Event, eventIds=getattr(instance, 'clearedEventIds', []) if reverse else [instance.pk])
+
+@receiver(post_save, sender=OccurrenceOverride)
+@receiver(post_delete, sender=OccurrenceOverride)
+def occurrenceChanged(sender, instance, **kwargs):
+    """ Changing or cancelling an occurrence of a repeating event changes the series """
+    sendEventSignal(eventsChanged, [instance.series_id])
+
+@receiver(post_save, sender=Organization)
+def orgSaved(sender, instance, created, **kwargs):
+    """ An org's name shows up as the host name on its events """
+    if not created:
+        eventsChanged.send(sender=Event, eventIds=list(instance.childEvents.values_list('pk', flat=True)))
+
+@receiver(pre_save, sender=User)
+def userSaving(sender, instance, update_fields=None, **kwargs):
+    """ Note whether a user is changing their name, since most user saves (like logging in) don't matter here """
+    if instance.pk is None or (update_fields is not None and not {'first_name', 'last_name'} & set(update_fields)):
+        instance.renamed = False
+    else:
+        instance.renamed = not User.objects.filter(pk = instance.pk, first_name = instance.first_name,
+                                                   last_name = instance.last_name).exists()
+
+@receiver(post_save, sender=User)
+def userSaved(sender, instance, **kwargs):
+    """ A user's name shows up as the host name on the events they host """
+    if getattr(instance, 'renamed', False):
+        eventsChanged.send(sender=Event, eventIds=list(instance.usersEvents.values_list('pk', flat=True)))
+
+@receiver(pre_save, sender=Tag)
+def tagSaving(sender, instance, **kwargs):
+    """ Note whether a tag is being renamed, since most tag saves (like changing defaults) don't matter here """
+    if instance.pk is None:
+        instance.renamed = False
+    else:
+        instance.renamed = not Tag.objects.filter(pk = instance.pk, name = instance.name).exists()
+
+@receiver(post_save, sender=Tag)
+def tagSaved(sender, instance, **kwargs):
+    """ Renaming a tag changes every event with it """
+    if getattr(instance, 'renamed', False):
+        eventsChanged.send(sender=Event, eventIds=list(instance.event_set.values_list('pk', flat=True)))
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(tagsChanged)
+def reloadTagMap(sender, **kwargs):
+    """ Make this process's tag name map pick up the change right away """
+    tagMap.markStale()
+
+@receiver(pre_delete, sender=Tag)
+def tagDeleting(sender, instance, **kwargs):
+    """ The tag's through rows go away without an m2m_changed, so remember whose they were """
+    instance.clearedEventIds = list(instance.event_set.values_list('pk', flat=True))
+
+@receiver(post_delete, sender=Tag)
+def tagDeleted(sender, instance, **kwargs):
+    """ Events lose a tag when it's deleted """
+    eventsChanged.send(sender=Event, eventIds=getattr(instance, 'clearedEventIds', []))
+
+
+## The things derived from events
+@receiver(eventsChanged)
+def updateSearchIndex(sender, eventIds, **kwargs):
+    """ Keep the full text search index up to date """
+    search.indexEvents(eventIds)
+
+@receiver(eventsDeleted)
+def removeFromSearchIndex(sender, eventIds, **kwargs):
+    """ Keep deleted events out of search results """
+    search.removeEvents(eventIds)
+
+@receiver(eventsChanged)
+@receiver(eventsDeleted)
+def invalidateEventFeeds(sender, **kwargs):
+    """ Any event change can change the cached public feeds """
+    feedCache.invalidate(EVENT_FEEDS)
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(tagsChanged)
+def invalidateTagFeeds(sender, **kwargs):
+    """ Tag changes show up in getTags, and change which events the default feeds include """
+    feedCache.invalidate(TAG_FEEDS)
+
+@receiver(eventsChanged)
+def updateSuggestions(sender, eventIds, **kwargs):
+    """ Keep autocomplete's titles and locations up to date """
+    suggestions.updateEvents(eventIds)
+
+@receiver(eventsDeleted)
+def removeFromSuggestions(sender, eventIds, **kwargs):
+    """ Stop suggesting deleted events """
+    suggestions.removeEvents(eventIds)
+
+@receiver(post_save, sender=Organization)
+def updateOrgSuggestion(sender, instance, **kwargs):
+    """ Orgs are suggested by name and alias once they're active """
+    suggestions.updateOrg(instance)
+
+@receiver(post_delete, sender=Organization)
+def removeOrgSuggestion(sender, instance, **kwargs):
+    """ Stop suggesting deleted orgs """
+    suggestions.removeOrg(instance.pk)
+
+
+@receiver(eventsChanged)
+def updateFeeds(sender, eventIds, **kwargs):
+    """ Keep the events' For You feed entries up to date (deleted ones' entries go with them) """
+    feeds.updateEvents(eventIds)
+
+def changedUserIds(sender, instance, action, reverse, pk_set):
+    """ For an m2m_changed on one of a user's relations (tags, follows, likes), the ids of the users whose side of it
+    changed, or None if it hasn't changed yet (the pre_ actions) """
+    if action == 'pre_clear' and reverse: # We won't know whose it was after it's cleared
+        # (the through table's other column is named after the tag/org/event's model)
+        instance.clearedUserIds = list(sender.objects.filter(**{instance._meta.model_name: instance}).values_list(
+            'user_id', flat=True))
+    elif action in ['post_add', 'post_remove']:
+        return list(pk_set) if reverse else [instance.pk]
+    elif action == 'post_clear':
+        return getattr(instance, 'clearedUserIds', []) if reverse else [instance.pk]
+    return None
+
+@receiver(m2m_changed, sender=User.interestedTags.through)
+@receiver(m2m_changed, sender=User.followedOrgs.through)
+@receiver(m2m_changed, sender=User.likedEvents.through)
+def updateUserFeeds(sender, instance, action, reverse, pk_set, **kwargs):
+    """ Changing someone's tags, follows or likes (from either side of the relation) changes their feed """
+    userIds = changedUserIds(sender, instance, action, reverse, pk_set)
+    if userIds is not None:
+        feeds.updateUsers(userIds)
+
+
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+def recompileGazetteer(sender, **kwargs):
+    """ Make this process's location lookups pick up the change """
+    gazetteer.markStale()
+
+
+## Cached logins (see authentication.py)
+@receiver(post_delete, sender=Token)
+def forgetDeletedToken(sender, instance, **kwargs):
+    """ Logging out deletes the token, so stop accepting it """
+    forgetToken(instance.key)
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forgetUserTokens(sender, instance, **kwargs):
+    """ Requests should see account changes (deactivation, deletion, etc.) right away """
+    forgetUser(instance.pk)
+
+
+## Version stamps for conditional GETs (see versions.py)
+@receiver(eventsChanged)
+@receiver(eventsDeleted)
+def bumpEventsVersion(sender, **kwargs):
+    """ Events changed """
+    versions.bump(versions.EVENTS)
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(tagsChanged)
+def bumpTagsVersion(sender, **kwargs):
+    """ Tags changed """
+    versions.bump(versions.TAGS)
+
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+def bumpOrgsVersion(sender, **kwargs):
+    """ Orgs changed """
+    versions.bump(versions.ORGS)
+
+@receiver(m2m_changed, sender=User.likedEvents.through)
+def bumpLikesVersion(sender, instance, action, reverse, pk_set, **kwargs):
+    """ Someone's likes changed (from either side of the relation) """
+    userIds = changedUserIds(sender, instance, action, reverse, pk_set)
+    if userIds:
+        versions.bump(*[versions.likesVersion(uid) for uid in userIds])
+
+@receiver(m2m_changed, sender=User.followedOrgs.through)
+def bumpFollowsVersion(sender, instance, action, reverse, pk_set, **kwargs):
+    """ Someone's followed orgs changed (from either side of the relation) """
+    userIds = changedUserIds(sender, instance, action, reverse, pk_set)
+    if userIds:
+        versions.bump(*[versions.followsVersion(uid) for uid in userIds])
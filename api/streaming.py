@@ -0,0 +1,69 @@
+"""
+streaming.py - streams big event lists to the client instead of building them in memory
+
+The regular list endpoints serialize every event into one big list and then encode that into one big string, so
+a worker's memory (and how long the client waits for the first byte) grows with the number of events. Here we walk
+the queryset a chunk at a time with the same keyset filter the paginated endpoints use, and write each chunk out
+as soon as it's encoded.
+
+Clients opt in by sending 'stream=true'; the body is the same JSON array the endpoint would normally return.
+"""
+import heapq
+from itertools import chain, islice
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+from api.pagination import EVENT_ORDERING, afterKey
+from api.serializers import EventSerializer
+
+STREAM_CHUNK_SIZE = getattr(settings, 'API_STREAM_CHUNK_SIZE', 200)
+
+
+def isStreamed(request):
+    """ Whether the client asked for a streamed response """
+    return request.GET.get('stream', '').lower() in ['true', '1', 't', 'y', 'yes']
+
+
+def iterateChunks(queryset, ordering = EVENT_ORDERING, chunkSize = STREAM_CHUNK_SIZE):
+    """ Yields the queryset as lists of at most chunkSize rows, running one small query per chunk """
+    queryset = queryset.order_by(*ordering)
+    lastKey = None
+    while True:
+        chunkQuery = queryset if lastKey is None else queryset.filter(afterKey(ordering, lastKey))
+        chunk = list(chunkQuery[:chunkSize])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunkSize:
+            return
+        lastKey = [getattr(chunk[-1], field.lstrip('-')) for field in ordering]
+
+
+def mergeChunks(queryset, extra, ordering = EVENT_ORDERING, chunkSize = STREAM_CHUNK_SIZE):
+    """ iterateChunks, with some extra events (in the same order) that aren't rows of the queryset mixed in """
+    fields = [field.lstrip('-') for field in ordering]
+    rows = heapq.merge(chain.from_iterable(iterateChunks(queryset, ordering, chunkSize)), extra,
+                       key = lambda row: tuple(getattr(row, field) for field in fields),
+                       reverse = ordering[0].startswith('-'))
+    while chunk := list(islice(rows, chunkSize)):
+        yield chunk
+
+
+def streamEvents(request, queryset, ordering = EVENT_ORDERING, extra = ()):
+    """ Returns a response that serializes and sends the events a chunk at a time. extra is any events that aren't
+    rows of the queryset (like occurrences of repeating events), in the same order, to mix in """
+    # One context for every chunk, so things like the user's liked events are only looked up once
+    context = {'request': request}
+    encoder = DjangoJSONEncoder()
+
+    def generate():
+        yield '['
+        separator = ''
+        for chunk in (mergeChunks(queryset, extra, ordering) if extra else iterateChunks(queryset, ordering)):
+            eventsJson = EventSerializer(chunk, many = True, context = context).data
+            yield separator + ','.join(encoder.encode(event) for event in eventsJson)
+            separator = ','
+        yield ']'
+
+    return StreamingHttpResponse(generate(), content_type='application/json')
@@ -0,0 +1,130 @@
+"""
+versions.py - version stamps for the data the app polls, and conditional GET support built on them
+
+Every kind of data a read endpoint depends on has a DataVersion row (events, tags, orgs, and each user's likes and
+follows) that the receivers in signals.py bump whenever it changes. An endpoint's ETag is then just a hash of the
+versions it depends on plus the request parameters, which costs one small query to compute. If the app sends back
+the ETag it already has (If-None-Match), or a date after the last change (If-Modified-Since), we answer
+304 Not Modified without running the query or the serializer at all.
+
+    @conditionalOn(lambda request: [EVENTS, likesVersion(request.user.pk)])
+    def getLikedEvents(request):
+"""
+from calendar import timegm
+import functools
+import hashlib
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.http import condition
+
+from api.models import DataVersion
+
+EVENTS = 'events'
+TAGS = 'tags'
+ORGS = 'orgs'
+
+def likesVersion(userId):
+    """ The version name for a user's liked events """
+    return f"likes:{userId}"
+
+def followsVersion(userId):
+    """ The version name for a user's followed orgs """
+    return f"follows:{userId}"
+
+
+def bump(*names):
+    """ Marks the named data as changed """
+    now = timezone.now()
+    for name in names:
+        if DataVersion.objects.filter(name = name).update(version = F('version') + 1, modified = now):
+            continue
+        try: # First change we've seen for it
+            with transaction.atomic():
+                DataVersion.objects.create(name = name, version = 1)
+        except IntegrityError: # Someone else just created it
+            DataVersion.objects.filter(name = name).update(version = F('version') + 1, modified = now)
+
+
+def getVersions(names):
+    """ Maps each name to its (version, modified) pair, in one query. Never-changed data is version 0 """
+    found = {name: (version, modified) for name, version, modified in
+             DataVersion.objects.filter(name__in = names).values_list('name', 'version', 'modified')}
+    return {name: found.get(name, (0, None)) for name in names}
+
+async def agetVersions(names):
+    """ getVersions, for async views """
+    found = {name: (version, modified) async for name, version, modified in
+             DataVersion.objects.filter(name__in = names).values_list('name', 'version', 'modified')}
+    return {name: found.get(name, (0, None)) for name in names}
+
+def versionsKey(request, names):
+    """ The named versions, for keying cached copies of a response built from them on. Uses the ones conditionalOn
+    already looked up for the request, if it did (which can include per user ones, like likes, that a shared copy
+    mustn't be keyed on) """
+    dataVersions = getattr(request, 'dataVersions', None)
+    if dataVersions is None or not set(names) <= dataVersions.keys():
+        dataVersions = getVersions(names)
+    return tuple(sorted((name, version) for name, (version, _) in dataVersions.items() if name in names))
+
+
+def etagFor(request, dataVersions, extraKey = None, window = None):
+    """ The ETag for a response built from the given versions (see conditionalOn) """
+    key = [sorted((name, version) for name, (version, _) in dataVersions.items()), sorted(request.GET.lists()),
+           extraKey(request) if extraKey else None, window(request) if window else None]
+    return hashlib.md5(repr(key).encode()).hexdigest()
+
+def lastModifiedFor(request, dataVersions, window = None):
+    """ When a response built from the given versions last changed, or None if we can't tell """
+    modified = [modified for _, modified in dataVersions.values() if modified is not None]
+    if window:
+        modified.append(window(request))
+    return max(modified, default = None)
+
+
+def conditionalOn(versionNames, extraKey = None, window = None):
+    """ Decorator adding ETag/Last-Modified support to a GET view. versionNames(request) lists the versions the
+    response depends on, extraKey(request) anything else it depends on (like who's asking), and window(request) the
+    start of the current time window for responses that also change as time passes """
+
+    def requestVersions(request):
+        # The ETag and Last-Modified functions both need these, so only look them up once per request
+        if not hasattr(request, 'dataVersions'):
+            request.dataVersions = getVersions(versionNames(request))
+        return request.dataVersions
+
+    def etag(request, *_args, **_kwargs):
+        return etagFor(request, requestVersions(request), extraKey, window)
+
+    def lastModified(request, *_args, **_kwargs):
+        return lastModifiedFor(request, requestVersions(request), window)
+
+    return condition(etag_func = etag, last_modified_func = lastModified)
+
+
+def aconditionalOn(versionNames, extraKey = None, window = None):
+    """ conditionalOn, for async views (django's condition decorator would look the versions up synchronously) """
+
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return await view(request, *args, **kwargs)
+            dataVersions = request.dataVersions = await agetVersions(versionNames(request)) # For versionsKey
+            etag = quote_etag(etagFor(request, dataVersions, extraKey, window))
+            lastModified = lastModifiedFor(request, dataVersions, window)
+            lastModified = lastModified and timegm(lastModified.utctimetuple())
+
+            response = get_conditional_response(request, etag = etag, last_modified = lastModified)
+            if response is None:
+                response = await view(request, *args, **kwargs)
+            if lastModified and not response.has_header('Last-Modified'):
+                response.headers['Last-Modified'] = http_date(lastModified)
+            response.headers.setdefault('ETag', etag)
+            return response
+        return wrapper
+
+    return decorator
@@ -3,28 +3,40 @@ This is the file where most of the logic happens. Each file has a descriptor inf
 but bascially, this is where the modification and updating of the information stored in the database occurs
 """
 # pylint: disable=unused-argument
-from datetime import timedelta
-from django.utils import timezone
-from smtplib import SMTPException
+from datetime import datetime, timedelta
 
 import pytz
 from dateutil import relativedelta
+from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.tokens import default_token_generator
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.mail import send_mail
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, F, OuterRef
 from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils.dateparse import parse_date, parse_datetime
 from django.views.decorators.csrf import ensure_csrf_cookie
-from rest_framework.authtoken.models import Token
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
 
+import api.caching as caching
+import api.feeds as feeds
+import api.pagination as pagination
+import api.recurrence as recurrence
+import api.search as searchIndex
 import api.serializers as serializers
-from api.aux_functions import addEventTags, setEventTags
-from api.models import Event, Organization, Tag, User
+import api.streaming as streaming
+import api.versions as versions
+from api.autocomplete import DEFAULT_LIMIT as SUGGESTION_LIMIT, suggestions
+from api.caching import feedCache
+from api.aux_functions import (UnknownTagError, addEventTags, bulkAddEventTags, bulkSetEventTags, eventsInRange,
+                               followingRepeats, resolveTagList, seriesRepeats)
+from api.changes import batchedEventSignals, eventsChanged
+from api.models import Event, OccurrenceOverride, Organization, Tag, User
+from api.outbox import queueMail
 
 
 
@@ -38,17 +50,61 @@ def getAutoPopulatedEventUser():
 
 # TODO: What happens if a non student creates a student only event? We prob let this happen, but can they edit it?
 
-def home(request):
-    """ The landing page for people interested in the app """
-
-    now = timezone.now() # assigns the current time
-    tags = Tag.objects.filter(selectedDefault = True)
-    upcoming = Event.objects.filter(end__gte=now).exclude(start__gt = now + timedelta(days = 2))
-    upcoming = upcoming.filter(tags__in = tags).distinct()
-    upcoming = upcoming.exclude(studentsOnly = True)
-    upcoming = upcoming.order_by('start')
+## What the polled read endpoints depend on, for their ETags (see versions.py)
+def upcomingVersions(request):
+    """ The upcoming feed shows events (picked by tags), with the user's favorites """
+    if request.user.is_authenticated:
+        return [versions.EVENTS, versions.TAGS, versions.likesVersion(request.user.pk)]
+    return [versions.EVENTS, versions.TAGS]
+
+def likedVersions(request):
+    """ The liked events list shows the user's liked events, with their tags """
+    return [versions.EVENTS, versions.TAGS, versions.likesVersion(request.user.pk)]
+
+def audience(request):
+    """ Who's asking, as far as which events they can see """
+    return (request.user.is_authenticated, getattr(request.user, 'type', None))
+
+def feedWindow(request):
+    """ Feeds relative to now change as time passes, one cache window at a time """
+    return caching.currentWindow()
+
+def listResponse(request, queryset, serializerClass, ordering = pagination.EVENT_ORDERING, series = None):
+    """ Serializes a list endpoint's queryset (with the occurrences of any repeating events, a
+    recurrence.SeriesOccurrences, mixed in), one page at a time if the client asked for pagination """
+    if not pagination.isPaginated(request):
+        listJson = serializerClass(recurrence.merge(queryset, series.all() if series else ()), many = True,
+                                   context={'request': request})
+        return JsonResponse(listJson.data, safe=False)
 
-    return render(request, "home.html", {'upcomingEvents': upcoming})
+    try:
+        if series and series.masters:
+            page, nextCursor = pagination.getMergedPage(request, queryset, series.page, ordering)
+        else:
+            page, nextCursor = pagination.getPage(request, queryset, ordering)
+    except pagination.InvalidPageRequest as e:
+        return JsonResponse({'error' : str(e)}, safe=False, status = 400)
+    listJson = serializerClass(page, many = True, context={'request': request})
+    return JsonResponse({'results' : listJson.data, 'next' : nextCursor}, safe=False)
+
+def homeEvents(now):
+    """ The public events with a default tag in the next couple days, with everything the page shows about them """
+    defaultTagged = Exists(Event.tags.through.objects.filter(event = OuterRef('pk'), tag__selectedDefault = True))
+    events = Event.objects.filter(defaultTagged).exclude(studentsOnly = True) # (no join, so no need for distinct)
+    upcoming = events.exclude(recurrence.RECURRING).filter(end__gte = now, start__lte = now + timedelta(days = 2))
+    upcoming = upcoming.select_related('host', 'parentOrg').order_by('start', 'id')
+    return list(recurrence.merge(upcoming, recurrence.occurrencesIn(events, now, now + timedelta(days = 2))))
+
+@versions.conditionalOn(lambda request: [versions.EVENTS, versions.TAGS], window = feedWindow)
+def home(request):
+    """ The landing page for people interested in the app. The page is the same for everyone, so it's rendered once
+    and shared until events or tags change or the cache window rolls over """
+    window = caching.currentWindow()
+    # The versions are in the key so changes made by other processes (like the scrape) show up right away too
+    cacheKey = ('home', versions.versionsKey(request, [versions.EVENTS, versions.TAGS]), window)
+    page = feedCache.getOrSet(cacheKey, lambda: render_to_string("home.html", {
+        'upcomingEvents': homeEvents(caching.windowEnd(window))}))
+    return HttpResponse(page)
 
 @ensure_csrf_cookie
 @api_view(['GET'])
@@ -67,13 +123,12 @@ def sendEmailVerification(request, user):
     """ Generate a token for and send a verification email to the provided user """
     confirmationToken = default_token_generator.make_token(user)
 
-    send_mail(
+    queueMail(
         "GrinSync Email Verification",
         ("Welcome to GrinSync! Please click here to verify your email: "
             f"{request.build_absolute_uri('/api/verifyUser')}?token={confirmationToken}&tempId={user.pk}"),
         "register@grinsync.com",
         [user.email],
-        fail_silently=False,
     )
     return
 
@@ -107,11 +162,10 @@ def createUser(request):
                                         type = userType, email = email.lower(), username = email.lower(),
                                         password = password, is_active = False)
         if tags:
-            for tag in tags.split(';'):
-                try:
-                    user.interestedTags.add(Tag.objects.get(name=tag))
-                except ObjectDoesNotExist:
-                    return JsonResponse({'error':f"Requested tag '{tag}' is not a valid tag"}, safe=False, status = 400)
+            try:
+                user.interestedTags.add(*resolveTagList(tags))
+            except UnknownTagError as e:
+                return JsonResponse({'error' : str(e)}, safe=False, status = 400)
         else:
             user.interestedTags.set(Tag.objects.filter(selectedDefault = True))
         user.save()
@@ -127,11 +181,7 @@ def createUser(request):
                                         type = userType, email = email.lower(), username = email.lower(),
                                         password = password, is_active = False)
 
-    try:
-        sendEmailVerification(request, user)
-    except SMTPException:
-        user.delete()
-        return JsonResponse({'error' : "Email failed to send, please try registering again"}, safe=False, status = 400)
+    sendEmailVerification(request, user) # Queued, so the sendmail command retries it if the mail server is down
 
     # Return the newly created user's id. Although the status code is probably more important
     return JsonResponse({'id' : user.id}, safe=False, status = 200)
@@ -164,14 +214,14 @@ def getUser(request):
 
     # Get the desired user's ID from the request
     uid = request.GET.get("id", None)
-    if not uid: # If they didn't provide an id, assume they want their own user info
-        uid = Token.objects.get(key=request.auth.key).user_id
-
-    # Check if there is a user with that id
-    try:
-        user = User.objects.get(pk = uid)
-    except ObjectDoesNotExist:
-        return HttpResponse("User does not exist", status = 404)
+    if not uid: # If they didn't provide an id, assume they want their own user info (which we already have)
+        user = request.user
+    else:
+        # Check if there is a user with that id
+        try:
+            user = User.objects.get(pk = uid)
+        except ObjectDoesNotExist:
+            return HttpResponse("User does not exist", status = 404)
 
     # Seralize the user object and return that info
     userJson = serializers.UserSerializer(user)
@@ -225,7 +275,7 @@ def createOrg(request):
     confirmationToken = default_token_generator.make_token(org)
 
 
-    send_mail(
+    queueMail(
         "GrinSync Organization Verification",
         (f"Hi, this email was sent because { request.user.first_name } { request.user.last_name } is creating "
          f"a GrinSync Organization named { org.name }. This is the email they listed, "
@@ -234,7 +284,6 @@ def createOrg(request):
                 f"token={confirmationToken}&org={org.pk}"),
         "confirmation@grinsync.com",
         [org.email],
-        fail_silently=False,
     )
 
     if warnings != '':
@@ -285,7 +334,7 @@ def claimOrg(request): # Potential todo: let existing leaders add other leaders
 
     confirmationToken = default_token_generator.make_token(user)
 
-    send_mail(
+    queueMail(
         "GrinSync Organization Co-Leader Request",
         (f"Hi, this email was sent because { user.first_name } { user.last_name } is requesting to join "
          f"{ org.name } as a co-leader with editing ability. This is the listed contact email for { org.name }, "
@@ -294,7 +343,6 @@ def claimOrg(request): # Potential todo: let existing leaders add other leaders
                 f"token={confirmationToken}&org={org.pk}&newCo={user.pk}"),
         "confirmation@grinsync.com",
         [org.email],
-        fail_silently=False,
     )
     return JsonResponse("Confirmation Email Sent", safe = False, status = 200)
 
@@ -363,8 +411,7 @@ def getAllOrgs(request):
     activeOrgs = Organization.objects.filter(is_active = True)
 
     # Seralize the org objects and return that info
-    orgsJson = serializers.OrgSerializer(activeOrgs, many = True, context={'request': request})
-    return JsonResponse(orgsJson.data, safe=False)
+    return listResponse(request, activeOrgs, serializers.OrgSerializer, pagination.ORG_ORDERING)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
@@ -379,10 +426,9 @@ def getOrgEvents(request):
         except ObjectDoesNotExist:
             return HttpResponse(f"Org with id/name '{orgID}' does not exist", status = 404)
 
-    events = org.childEvents.all()
-    # Seralize the org objects and return that info
-    eventsJson = serializers.EventSerializer(events, many = True, context={'request': request})
-    return JsonResponse(eventsJson.data, safe=False)
+    events = serializers.EventSerializer.eagerLoad(org.childEvents.all())
+    # Seralize the event objects and return that info
+    return listResponse(request, events, serializers.EventSerializer)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated]) # Make sure user is logged in
@@ -400,7 +446,6 @@ def followOrg(request):
 
     user = request.user
     user.followedOrgs.add(org)
-    user.save()
     orgJson = serializers.OrgSerializer(org, context={'request': request})
     return JsonResponse(orgJson.data, safe=False, status=200)
 
@@ -418,7 +463,6 @@ def unfollowOrg(request):
 
     user = request.user
     user.followedOrgs.remove(org)
-    user.save()
     orgJson = serializers.OrgSerializer(org, context={'request': request})
     return JsonResponse(orgJson.data, safe=False, status=200)
 
@@ -439,12 +483,12 @@ def toggleFollowedOrg(request):
         user.followedOrgs.remove(org)
     else:
         user.followedOrgs.add(org)
-    user.save()
     orgJson = serializers.OrgSerializer(org, context={'request': request})
     return JsonResponse(orgJson.data, safe=False, status=200)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated]) # Make sure user is logged in
+@versions.conditionalOn(lambda request: [versions.ORGS, versions.EVENTS, versions.followsVersion(request.user.pk)])
 def getFollowedOrgs(request):
     """ Return all of a user's followed orgs. """
     user = request.user
@@ -525,26 +569,36 @@ def createEvent(request):
 
         repeatEnd = datetime.strptime(repeatEnd, "%Y-%m-%d %H:%M:%S.%f").replace(hour=23, minute=59)
         offset = relativedelta.relativedelta(days=repeatDays, months=repeatMonths)
-        firstEvent = Event.objects.create(host = request.user, parentOrg = hostOrg, title = title,
-                                    location = location, start = startDT, end = endDT,
-                                    description = description, studentsOnly = studentsOnly,
-                                    contactEmail = contactEmail)
-        addEventTags(firstEvent, tags) # addEventTags saves the event too, which feels harmless, but idk
+        if startDT + offset <= startDT:
+            return JsonResponse({'error' : "Value Error: Repeating events have to repeat forwards in time"},
+                                safe=False, status = 400)
 
-        prevEvent = firstEvent
-        startDT = startDT + offset
-        endDT = endDT + offset
-        while startDT <= repeatEnd:
+        if getattr(settings, 'EVENT_REPEAT_RULES', False): # Just store the rule (see recurrence.py)
             event = Event.objects.create(host = request.user, parentOrg = hostOrg, title = title,
-                                    location = location, start = startDT, end = endDT,
-                                    description = description, studentsOnly = studentsOnly,
-                                    contactEmail = contactEmail)
+                                         location = location, start = startDT, end = endDT,
+                                         description = description, studentsOnly = studentsOnly,
+                                         contactEmail = contactEmail, repeatDays = repeatDays,
+                                         repeatMonths = repeatMonths, repeatUntil = repeatEnd)
             addEventTags(event, tags)
-            prevEvent.nextRepeat = event
-            prevEvent.save()
-            prevEvent = event
-            startDT = startDT + offset
-            endDT = endDT + offset
+            return JsonResponse({'id' : event.id}, safe=False, status = 200)
+
+        # Work out every occurrence first, so we can write them all at once. Each one is offset from the first
+        # rather than the one before, so monthly events on the 31st don't slide back to the 28th after February
+        occurrences = []
+        while (not occurrences) or (startDT + offset * len(occurrences) <= repeatEnd):
+            occurrences.append(Event(host = request.user, parentOrg = hostOrg, title = title,
+                                     location = location, start = startDT + offset * len(occurrences),
+                                     end = endDT + offset * len(occurrences), description = description,
+                                     studentsOnly = studentsOnly, contactEmail = contactEmail))
+        with transaction.atomic():
+            Event.objects.bulk_create(occurrences)
+            for event, nextEvent in zip(occurrences, occurrences[1:]):
+                event.nextRepeat = nextEvent
+            Event.objects.bulk_update(occurrences[:-1], ['nextRepeat'])
+            bulkAddEventTags([(event, tags) for event in occurrences], sendSignals = False)
+        # Bulk writes don't send any signals, so let the search index and such know about them
+        eventsChanged.send(sender=Event, eventIds=[event.pk for event in occurrences])
+        firstEvent = occurrences[0]
 
         # Send the user back the information it'll need
         return JsonResponse({'id' : firstEvent.id}, safe=False, status = 200)
@@ -566,16 +620,17 @@ def createEvent(request):
 def updateInterestedTags(request):
     """ Updates an user's interested tags """
     tags = request.POST.get("tags", None)
+    if tags is None:
+        return JsonResponse({'error':"No 'tags' field provided"}, safe=False, status = 400)
 
-    user = request.user
-    user.interestedTags.clear()
+    # Resolve them all first, so a bad tag doesn't leave the user with half their tags
+    try:
+        tagIds = resolveTagList(tags)
+    except UnknownTagError as e:
+        return JsonResponse({'error' : str(e)}, safe=False, status = 400)
 
-    for tag in tags.split(';'):
-        try:
-            user.interestedTags.add(Tag.objects.get(name=tag))
-        except ObjectDoesNotExist:
-            return JsonResponse({'error':f"Requested tag '{tag}' is not a valid tag"}, safe=False, status = 400)
-    user.save()
+    user = request.user
+    user.interestedTags.set(tagIds)
     return JsonResponse('Success', safe=False, status = 200)
 
 
@@ -592,122 +647,259 @@ def getEvent(request):
 
 @api_view(['GET'])
 def search(request): # TODO: decide if want one search for everything or different for events vs users
-    """ Return all the matching events for a given search. Takes: query """
+    """ Return the best matching events for a given search. Takes: query, and optionally tags and limit """
     tags = request.GET.get("tags", None)
     query = request.GET.get("query", None)
     if not query:
         return JsonResponse({'error' : "Required Argument 'query' was not provided"}, safe=False, status = 400)
 
-    matching = (Event.objects.filter(title__contains = query) |
-                    Event.objects.filter(location__contains = query)) # TODO: Sort by closeness to date not exceeding?
-
+    tagIds = None
     if tags: # If tags aren't provided, we'll assume we want all events that match
-        tagObjs = []
-        for tag in tags.split(';'):
-            # if tag == 'ALL': # If we want to support the "ALL" tag, but I think just not sending any will work
-            #     tagObjs = Tag.objects.all()
-            #     break
-            try:
-                tagObjs.append(Tag.objects.get(name=tag))
-            except ObjectDoesNotExist:
-                return JsonResponse({'error':f"Requested tag '{tag}' is not a valid tag"}, safe=False, status = 400)
-        matching = matching.filter(tags__in = tagObjs).distinct()
+        # (If we want to support the "ALL" tag, but I think just not sending any will work)
+        try:
+            tagIds = resolveTagList(tags)
+        except UnknownTagError as e:
+            return JsonResponse({'error' : str(e)}, safe=False, status = 400)
+
+    isStudent = request.user.is_authenticated and (request.user.type == "STU")
+
+    # Unless they're paging through everything, return the top ranked matches from the full text index
+    if searchIndex.isAvailable() and not pagination.isPaginated(request):
+        try:
+            limit = min(int(request.GET.get("limit", searchIndex.MAX_RESULTS)), pagination.MAX_PAGE_SIZE)
+        except ValueError:
+            return JsonResponse({'error' : "'limit' must be an integer"}, safe=False, status = 400)
+        if limit < 1:
+            return JsonResponse({'error' : "'limit' must be positive"}, safe=False, status = 400)
+        rankedIds = searchIndex.searchEventIds(query, limit, tagIds = tagIds, includeStudentsOnly = isStudent)
+        matching = serializers.EventSerializer.eagerLoad(Event.objects.filter(pk__in = rankedIds))
+        rank = {eid: i for i, eid in enumerate(rankedIds)}
+        matching = sorted(matching, key = lambda event: rank[event.pk])
+        eventJson = serializers.EventSerializer(matching, many = True, context={'request': request})
+        return JsonResponse(eventJson.data, safe=False)
+
+    if searchIndex.isAvailable():
+        matching = searchIndex.matchingEvents(query)
+    else: # Not on SQLite, so just fall back to substring matching
+        matching = (Event.objects.filter(title__contains = query) |
+                        Event.objects.filter(location__contains = query))
+
+    if tagIds is not None:
+        matching = matching.filter(tags__in = tagIds).distinct()
 
     # hide student-only events if user is not a student
-    if (not request.user.is_authenticated) or (request.user.type != "STU"):
+    if not isStudent:
         matching = matching.exclude(studentsOnly = True)
 
-    eventJson = serializers.EventSerializer(matching, many = True, context={'request': request})
-    return JsonResponse(eventJson.data, safe=False)
+    matching = serializers.EventSerializer.eagerLoad(matching)
+    return listResponse(request, matching, serializers.EventSerializer)
+
+@api_view(['GET'])
+def autocomplete(request):
+    """ Suggests events, orgs and locations for a partly typed (or misspelled) search. Takes: query, limit """
+    query = request.GET.get("query", "")
+    try:
+        limit = min(int(request.GET.get("limit", SUGGESTION_LIMIT)), 50)
+    except ValueError:
+        return JsonResponse({'error' : "'limit' must be an integer"}, safe=False, status = 400)
+    if limit < 1:
+        return JsonResponse({'error' : "'limit' must be positive"}, safe=False, status = 400)
+
+    isStudent = request.user.is_authenticated and (request.user.type == "STU")
+    return JsonResponse(suggestions.suggest(query, limit, includeStudentsOnly = isStudent), safe=False)
 
 @api_view(['GET'])
 def getAll(request):
     """ Return all the info for all events. """
     ## Do we want the calendar to update the tags by default?
     tags = request.GET.get("tags", None)
+    isStudent = request.user.is_authenticated and (request.user.type == "STU")
+
+    # The plain (not paged or streamed) response is the same for everyone with the same tags and audience, until
+    # the events or tags change (in this process or any other)
+    isCacheable = not (pagination.isPaginated(request) or streaming.isStreamed(request))
+    if isCacheable:
+        cacheKey = ('all', caching.tagsKey(tags) if tags else None, isStudent,
+                    versions.versionsKey(request, [versions.EVENTS, versions.TAGS]))
+        eventsJson = feedCache.get(cacheKey)
+        if eventsJson is not None:
+            return JsonResponse(caching.overlayFavorites(request, eventsJson), safe=False)
+
     if not tags: # If no tags are provided, just include all of them
         tags = Tag.objects.all()
     else:
-        tagObjs = []
-        for tag in tags.split(';'):
-            try:
-                tagObjs.append(Tag.objects.get(name=tag))
-            except ObjectDoesNotExist:
-                return JsonResponse({'error':f"Requested tag '{tag}' is not a valid tag"}, safe=False, status = 400)
-        tags = tagObjs
+        try:
+            tags = resolveTagList(tags)
+        except UnknownTagError as e:
+            return JsonResponse({'error' : str(e)}, safe=False, status = 400)
 
     events = Event.objects.all()
     events = events.filter(tags__in = tags).distinct()
 
     # Removes student-only events if user is not a student
     # We do this instead of the decorator for this function because everyone should be able to see public events
-    if (not request.user.is_authenticated) or (request.user.type != "STU"):
+    if not isStudent:
         events = events.exclude(studentsOnly = True)
-    eventsJson = serializers.EventSerializer(events, many = True, context={'request': request}) #turns info into a string
-    return JsonResponse(eventsJson.data, safe=False)  #returns the info that the user needs in JSON form
+    series = recurrence.SeriesOccurrences(events) # Every occurrence of the repeating ones, since this is everything
+    events = serializers.EventSerializer.eagerLoad(events.exclude(recurrence.RECURRING).order_by('start', 'id'))
+    if streaming.isStreamed(request): # Big calendars can be streamed rather than built in memory
+        return streaming.streamEvents(request, events, extra = series.all())
+    if not isCacheable: # Paginated, so only the occurrences each page needs are worked out
+        return listResponse(request, events, serializers.EventSerializer, series = series)
+
+    # Cache it without anyone's favorites, then fill in this user's
+    eventsJson = serializers.EventSerializer(recurrence.merge(events, series.all()), many = True,
+                                             context={'request': request, 'likedEventIDs': set()}).data
+    feedCache.set(cacheKey, eventsJson)
+    return JsonResponse(caching.overlayFavorites(request, eventsJson), safe=False)  #returns the info in JSON form
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated]) # Make sure user is logged in
 def getAllCreated(request):
     """ Return all the info for all events. """
     events = request.user.usersEvents
-    events = events.order_by('-start')
-    eventsJson = serializers.EventSerializer(events, many = True, context={'request': request}) #turns info into a string
-    return JsonResponse(eventsJson.data, safe=False)  #returns the info that the user needs in JSON form
+    events = serializers.EventSerializer.eagerLoad(events.order_by('-start'))
+    return listResponse(request, events, serializers.EventSerializer, pagination.REVERSE_EVENT_ORDERING)
 
-@api_view(['GET'])
-def getUpcoming(request):
-    """ Return all the info for upcoming events. """
+def upcomingCacheKey(request, now):
+    """ Everyone asking for the same tags and audience in the same window gets the same upcoming feed, as long as
+    the events and tags haven't changed since (the versions are the ones its ETag was made from) """
     tags = request.GET.get("tags", None)
+    isStudent = request.user.is_authenticated and (request.user.type == "STU")
+    dataVersions = versions.versionsKey(request, [versions.EVENTS, versions.TAGS])
+    if tags:
+        return ('upcoming', caching.tagsKey(tags), isStudent, now, dataVersions)
+    return ('upcoming', request.user.is_authenticated, isStudent, now, dataVersions) # Logged in vs universal defaults
+
+def upcomingEvents(request, now):
+    """ The regular events (in order) and the events to look for repeating ones in, for getUpcoming. Raises
+    UnknownTagError """
+    tags = request.GET.get("tags", None)
+    isStudent = request.user.is_authenticated and (request.user.type == "STU")
     if (not tags) or (tags == ""): # This setup lets us do the default by not sending anything. Can't set no tags tho
         if request.user.is_authenticated: # If the user's logged in, use their defaults
             tags = Tag.objects.all()
         else: # Otherwise, we'll use the universal defaults
             tags = Tag.objects.filter(selectedDefault = True)
+    elif 'ALL' in tags.split(';'):
+        tags = "ALL"
     else:
-        tagObjs = []
-        for tag in tags.split(';'):
-            if tag == 'ALL':
-                tagObjs = "ALL"
-                break
-            try:
-                tagObjs.append(Tag.objects.get(name=tag))
-            except ObjectDoesNotExist:
-                return JsonResponse({'error':f"Requested tag '{tag}' is not a valid tag"}, safe=False, status = 400)
-        tags = tagObjs
+        tags = resolveTagList(tags)
 
-    now = timezone.now() # assigns the current time
-    upcoming = Event.objects.filter(end__gte=now) # gets events with an ending time >= to now
-    upcoming = upcoming.exclude(start__gt = now + timedelta(weeks = 1)) # limits upcoming events a week out
+    events = Event.objects.all()
     if tags != "ALL":
-        upcoming = upcoming.filter(tags__in = tags).distinct()
+        events = events.filter(tags__in = tags).distinct()
 
     # hide student-only events if user is not a student
-    if (not request.user.is_authenticated) or (request.user.type != "STU"):
-        upcoming = upcoming.exclude(studentsOnly = True)
-    upcoming = upcoming.order_by('start')
-    eventsJson = serializers.EventSerializer(upcoming, many = True, context={'request': request}) #turns info into a string
-    return JsonResponse(eventsJson.data, safe=False)  #returns the info that the user needs in JSON form
+    if not isStudent:
+        events = events.exclude(studentsOnly = True)
+
+    upcoming = events.exclude(recurrence.RECURRING).filter(end__gte=now) # gets events with an ending time >= to now
+    upcoming = upcoming.exclude(start__gt = now + timedelta(weeks = 1)) # limits upcoming events a week out
+    return serializers.EventSerializer.eagerLoad(upcoming.order_by('start', 'id')), events
 
 @api_view(['GET'])
-def getEventsInDay(request):
-    """ Return the info for a day's events. """
-    requestedDay = request.GET.get("start") # get the requested day
-    eventsInDay = Event.objects.filter(start__gte=requestedDay) # get events that start on the request day
-    eventsInDay = eventsInDay.exclude(start__gt = requestedDay + timedelta(day = 1)) # limits events to the requested day
+@versions.conditionalOn(upcomingVersions, extraKey = audience, window = feedWindow)
+def getUpcoming(request):
+    """ Return all the info for upcoming events. """
+    now = caching.currentWindow() # assigns the current time (rounded so the cached feed can be shared)
+
+    cacheKey = upcomingCacheKey(request, now)
+    if not streaming.isStreamed(request):
+        eventsJson = feedCache.get(cacheKey)
+        if eventsJson is not None:
+            return JsonResponse(caching.overlayFavorites(request, eventsJson), safe=False)
+
+    since = caching.windowEnd(now) # So nothing that's ended by the time we're still serving it is in there
+    try:
+        upcoming, events = upcomingEvents(request, since)
+    except UnknownTagError as e:
+        return JsonResponse({'error' : str(e)}, safe=False, status = 400)
+    occurrences = recurrence.occurrencesIn(events, since, since + timedelta(weeks = 1)) # And repeating ones that week
+    if streaming.isStreamed(request):
+        return streaming.streamEvents(request, upcoming, extra = occurrences)
+
+    # Cache it without anyone's favorites, then fill in this user's
+    eventsJson = serializers.EventSerializer(recurrence.merge(upcoming, occurrences), many = True,
+                                             context={'request': request, 'likedEventIDs': set()}).data
+    feedCache.set(cacheKey, eventsJson)
+    return JsonResponse(caching.overlayFavorites(request, eventsJson), safe=False)  #returns the info in JSON form
+
+def parseDateTimeParam(value):
+    """ Reads a date or datetime sent as a parameter, assuming central time if there's no timezone. None if invalid """
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            if day is None:
+                return None
+            parsed = datetime.combine(day, datetime.min.time()) # Midnight at the start of the day
+    except ValueError: # Formatted right but not a real date, like the 31st of February
+        return None
+    if parsed.tzinfo is None:
+        parsed = CST.localize(parsed)
+    return parsed
+
+MAX_RANGE = timedelta(days = 366)
+
+def eventsInRangeResponse(request, rangeStart, rangeEnd):
+    """ Returns the events overlapping [rangeStart, rangeEnd), filtered by the request's tags and studentsOnly """
+    if rangeStart >= rangeEnd:
+        return JsonResponse({'error' : "Invalid range: 'from' must be before 'to'"}, safe=False, status = 400)
+    if rangeEnd - rangeStart > MAX_RANGE:
+        return JsonResponse({'error' : "Invalid range: ranges can be at most a year long"}, safe=False, status = 400)
+
+    events = Event.objects.all()
+
+    tags = request.GET.get("tags", None)
+    if tags and (tags != "ALL"): # No tags means every event, like the calendar used to get from getAll
+        try:
+            events = events.filter(tags__in = resolveTagList(tags)).distinct()
+        except UnknownTagError as e:
+            return JsonResponse({'error' : str(e)}, safe=False, status = 400)
+
+    # Audience filter: only student events, only public events, or (by default) both
+    studentsOnly = request.GET.get("studentsOnly", None)
+    if studentsOnly:
+        events = events.filter(studentsOnly = studentsOnly.lower() in ['true', '1', 't', 'y', 'yes'])
+
     # hide student-only events if user is not a student
     if (not request.user.is_authenticated) or (request.user.type != "STU"):
-        eventsInDay = eventsInDay.exclude(studentsOnly = True)
-    eventsJson = serializers.EventSerializer(eventsInDay, many = True,
-                                             context={'request': request}) #turns info into a string
-    return JsonResponse(eventsJson.data, safe=False) #returns the info that the user needs in JSON form
+        events = events.exclude(studentsOnly = True)
+
+    series = recurrence.SeriesOccurrences(events, rangeStart, rangeEnd) # Repeating events are worked out separately
+    events = eventsInRange(events.exclude(recurrence.RECURRING), rangeStart, rangeEnd)
+    events = serializers.EventSerializer.eagerLoad(events.order_by('start', 'id'))
+    return listResponse(request, events, serializers.EventSerializer, series = series)
 
 @api_view(['GET'])
+def getEventsInRange(request):
+    """ Return the events overlapping a window of time, for the calendar views. Takes: from, to, and optionally
+    tags and studentsOnly """
+    rangeStart = parseDateTimeParam(request.GET.get("from", ""))
+    rangeEnd = parseDateTimeParam(request.GET.get("to", ""))
+    if not (rangeStart and rangeEnd):
+        return JsonResponse({'error' : "Invalid DateTime: check your 'from' and 'to' fields"}, safe=False, status = 400)
+    return eventsInRangeResponse(request, rangeStart, rangeEnd)
+
+@api_view(['GET'])
+def getEventsInDay(request):
+    """ Return the info for a day's events. Takes: start (the day), and optionally tags and studentsOnly """
+    requestedDay = parseDateTimeParam(request.GET.get("start", "")) # get the requested day
+    if not requestedDay:
+        return JsonResponse({'error' : "Invalid DateTime: check your 'start' field"}, safe=False, status = 400)
+    day = requestedDay.astimezone(CST).date()
+    dayStart = CST.localize(datetime.combine(day, datetime.min.time()))
+    dayEnd = CST.localize(datetime.combine(day + timedelta(days = 1), datetime.min.time()))
+    return eventsInRangeResponse(request, dayStart, dayEnd)
+
+@api_view(['GET'])
+@versions.conditionalOn(lambda request: [versions.TAGS])
 def getTags(request):
     """ Return all the current tags. """
-    tags = Tag.objects.all()
-    tagsJson = serializers.TagSerializer(tags, many = True) #turns info into a string
-    return JsonResponse(tagsJson.data, safe=False)  #returns the info that the user needs in JSON form
+    cacheKey = ('tags', versions.versionsKey(request, [versions.TAGS]))
+    tagsJson = feedCache.getOrSet(cacheKey, lambda: serializers.TagSerializer(Tag.objects.all(), many = True).data)
+    return JsonResponse(tagsJson, safe=False)  #returns the info that the user needs in JSON form
 
 @api_view(['POST'])
 @permission_classes([IsAdminUser]) # Make sure user is an admin
@@ -737,7 +929,6 @@ def likeEvent(request):
 
     user = request.user
     user.likedEvents.add(event)
-    user.save()
     eventJson = serializers.EventSerializer(event, context={'request': request})
     return JsonResponse(eventJson.data, safe=False, status=200)
 
@@ -755,7 +946,6 @@ def unlikeEvent(request):
 
     user = request.user
     user.likedEvents.remove(event)
-    user.save()
     eventJson = serializers.EventSerializer(event, context={'request': request})
     return JsonResponse(eventJson.data, safe=False, status=200)
 
@@ -776,17 +966,32 @@ def toggleLikedEvent(request):
         user.likedEvents.remove(event)
     else:
         user.likedEvents.add(event)
-    user.save()
     eventJson = serializers.EventSerializer(event, context={'request': request})
     return JsonResponse(eventJson.data, safe=False, status=200)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated]) # Make sure user is logged in
+@versions.conditionalOn(likedVersions, extraKey = audience)
 def getLikedEvents(request):
     """ Return all of a users liked events. """
     user = request.user
-    eventJson = serializers.EventSerializer(user.likedEvents.all(), many = True, context={'request': request})
-    return JsonResponse(eventJson.data, safe=False, status=200)
+    likedEvents = serializers.EventSerializer.eagerLoad(user.likedEvents.all())
+    return listResponse(request, likedEvents, serializers.EventSerializer)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated]) # Make sure user is logged in
+def getForYou(request):
+    """ Return the upcoming events that best match a user's tags, followed orgs and likes, best first. Takes:
+    optionally limit """
+    try:
+        limit = min(int(request.GET.get("limit", pagination.DEFAULT_PAGE_SIZE)), pagination.MAX_PAGE_SIZE)
+    except ValueError:
+        return JsonResponse({'error' : "'limit' must be an integer"}, safe=False, status = 400)
+    if limit < 1:
+        return JsonResponse({'error' : "'limit' must be positive"}, safe=False, status = 400)
+    eventsJson = serializers.EventSerializer(feeds.forYou(request.user, limit), many = True,
+                                             context={'request': request})
+    return JsonResponse(eventsJson.data, safe=False)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated]) # Make sure user is logged in
@@ -805,6 +1010,10 @@ def editEvent(request):
             (not event.parentOrg) or (request.user not in event.parentOrg.studentLeaders.all())):
         return JsonResponse({'error':"This user is not the event's host"}, status = 403)
 
+    occurrenceStart = request.POST.get("occurrenceStart", None)
+    if occurrenceStart: # Just changing one occurrence of a repeating event
+        return editOccurrence(request, event, occurrenceStart)
+
     #TODO: Add extending event, which means need to store repeat info
 
     # Update the start and end times
@@ -873,55 +1082,88 @@ def editEvent(request):
             return HttpResponse("You cannot add an org that hasn't been verified to an event", status = 404)
 
 
-    firstEventpk = event.pk
-    while event:
-        nextEvent = event.nextRepeat
-        # Allow users to cut off the repeat # TODO: Add the ability to extend the repeat
+    if event.repeatUntil is not None: # A rule rather than a chain of events (see recurrence.py)
         if newRepeatEnd:
-            if event.start <= newRepeatEnd:
-                event.delete()
-                event = nextEvent
-                continue
-
-        # Update the start and end times
-        event.start = event.start + startOffset
-        event.end = event.end + endOffset
-
-        # Update the location
-        if newLocation:
-            event.location = newLocation
-
-        # Update the title
-        if newTitle:
-            event.title = newTitle
-
-        # Update the description
-        if newDescription:
-            event.description = newDescription
-
-        # Update the org
-        if newOrg:
-            event.parentOrg = newOrg
+            event.repeatUntil = newRepeatEnd
+            newRepeatEnd = None
+
+    # This occurrence and every later one, read with one recursive query rather than a query per occurrence
+    series = followingRepeats(event.pk)
+    # Allow users to cut off the repeat (but never the occurrence they're editing) # TODO: Add extending the repeat
+    cutIds = [repeat.pk for repeat in series[1:] if newRepeatEnd and repeat.start > newRepeatEnd]
+    editedIds = [repeat.pk for repeat in series if repeat.pk not in cutIds]
+
+    changes = {}
+    if startOffset: # Shift the start and end times
+        changes['start'] = F('start') + startOffset
+    if endOffset:
+        changes['end'] = F('end') + endOffset
+    if event.repeatUntil is not None:
+        changes['repeatUntil'] = event.repeatUntil
+    if newLocation:
+        changes['location'] = newLocation
+    if newTitle:
+        changes['title'] = newTitle
+    if newDescription:
+        changes['description'] = newDescription
+    if newOrg:
+        changes['parentOrg'] = newOrg
+    if newStudentsOnly:
+        changes['studentsOnly'] = newStudentsOnly.lower() in ['true', '1', 't', 'y', 'yes']
+
+    with transaction.atomic(), batchedEventSignals():
+        if cutIds: # Deleting them unlinks the last one we keep (nextRepeat is SET_NULL)
+            Event.objects.filter(pk__in = cutIds).delete()
+        if changes:
+            Event.objects.filter(pk__in = editedIds).update(**changes)
+        if startOffset and (event.repeatUntil is not None): # Keep the overrides with the occurrences they're for
+            event.overrides.update(occurrenceStart = F('occurrenceStart') + startOffset)
+        # Update the tags, for the whole series at once
+        if newTags:
+            bulkSetEventTags([(eventId, newTags.split(';')) for eventId in editedIds], sendSignals = False)
+    # update() doesn't send any signals, so let the search index and such know
+    eventsChanged.send(sender=Event, eventIds=editedIds)
 
-        # Update studentsOnly
-        if newStudentsOnly:
-            event.studentsOnly = newStudentsOnly.lower() in ['true', '1', 't', 'y', 'yes']
+    return JsonResponse({"id":event.pk}, safe=False, status=200)
 
-        # Update the tags
-        if newTags:
-            tags = newTags.split(';')
-            event = setEventTags(event, tags)
+def editOccurrence(request, series, occurrenceStart):
+    """ Changes a single occurrence of a repeating event stored as a rule, by saving an override for it """
+    occurrenceStart = parseDateTimeParam(occurrenceStart)
+    if (occurrenceStart is None) or (series.repeatUntil is None) or not recurrence.isOccurrence(series, occurrenceStart):
+        return JsonResponse({'error' : "Invalid occurrenceStart: the event has no occurrence starting then"},
+                            safe=False, status = 400)
 
+    try:
+        override = series.overrides.get(occurrenceStart = occurrenceStart)
+    except ObjectDoesNotExist:
+        override = OccurrenceOverride(series = series, occurrenceStart = occurrenceStart)
+
+    for field in ['title', 'description', 'location']:
+        if request.POST.get(field, None):
+            setattr(override, field, request.POST[field])
+    for field in ['start', 'end']:
+        if request.POST.get(field, None):
+            value = parseDateTimeParam(request.POST[field])
+            if value is None:
+                return JsonResponse({'error' : "Invalid DateTime: check your 'start' and 'end' fields"},
+                                    safe=False, status = 400)
+            setattr(override, field, value)
 
-        event.save()
-        event = nextEvent
+    start = override.start or occurrenceStart
+    end = override.end or (occurrenceStart + (series.end - series.start))
+    if start >= end:
+        return JsonResponse({'error' : "Invalid DateTime: your event start is after the end"},
+                                safe=False, status = 400)
 
-    return JsonResponse({"id":firstEventpk}, safe=False, status=200)
+    override.save()
+    return JsonResponse({"id":series.pk}, safe=False, status=200)
 
 @api_view(['DELETE'])
 @permission_classes([IsAuthenticated])
 def deleteEvent(request):
-    """ Delete an event. """
+    """ Delete an event. Takes: id (of event), and optionally scope ('single', 'following' to delete this occurrence
+    and every later one, or 'series' for every occurrence) and occurrenceStart (for repeating events stored as a
+    rule) """
     eid = request.POST.get("id", "")
     try:
         event = Event.objects.get(pk = eid)
@@ -935,15 +1177,47 @@ def deleteEvent(request):
             (not event.parentOrg) or (request.user not in event.parentOrg.studentLeaders.all())):
         return JsonResponse({'error':"This user is not the event's host"}, status = 403)
 
-    if hasattr(event, 'previousRepeat') and event.previousRepeat is not None:
-                    # Nothing to do if it's the first event (also, it would handle
-                    # it just fine if we didn't do this for the last event either, but whatever)
-        prevEvent = event.previousRepeat
-        prevEvent.nextRepeat = event.nextRepeat
-        event.delete() # Need this order otherwise the 1-to-1 field doesn't allow it
-        prevEvent.save()
-    else:
-        event.delete()
+    scope = request.POST.get("scope", "single")
+    if scope not in ['single', 'following', 'series']:
+        return JsonResponse({'error' : "Invalid scope: must be 'single', 'following' or 'series'"},
+                            safe=False, status = 400)
+
+    occurrenceStart = request.POST.get("occurrenceStart", None)
+    if occurrenceStart and (scope != 'series'): # Just some occurrences of a repeating event stored as a rule
+        occurrenceStart = parseDateTimeParam(occurrenceStart)
+        if (occurrenceStart is None) or (event.repeatUntil is None) or (
+                not recurrence.isOccurrence(event, occurrenceStart)):
+            return JsonResponse({'error' : "Invalid occurrenceStart: the event has no occurrence starting then"},
+                                safe=False, status = 400)
+        if scope == 'single':
+            OccurrenceOverride.objects.update_or_create(series = event, occurrenceStart = occurrenceStart,
+                                                        defaults = {'cancelled': True})
+            return JsonResponse("Success", safe=False, status = 200)
+        if occurrenceStart > event.start: # End the series just before it (deleting from the first is the same as
+                                          # deleting the whole series, below)
+            with transaction.atomic():
+                event.overrides.filter(occurrenceStart__gte = occurrenceStart).delete()
+                event.repeatUntil = occurrenceStart - timedelta(microseconds = 1)
+                event.save()
+            return JsonResponse("Success", safe=False, status = 200)
+
+    if (scope == 'single') or (event.repeatUntil is not None): # A rule's row is the whole series
+        if hasattr(event, 'previousRepeat') and event.previousRepeat is not None:
+                        # Nothing to do if it's the first event (also, it would handle
+                        # it just fine if we didn't do this for the last event either, but whatever)
+            prevEvent = event.previousRepeat
+            prevEvent.nextRepeat = event.nextRepeat
+            event.delete() # Need this order otherwise the 1-to-1 field doesn't allow it
+            prevEvent.save()
+        else:
+            event.delete()
+        return JsonResponse("Success", safe=False, status = 200)
+
+    # Find the whole run of occurrences with one recursive query, and delete them all at once. The one before them
+    # (if any) is unlinked by the delete, since nextRepeat is SET_NULL
+    repeats = followingRepeats(event.pk) if scope == 'following' else seriesRepeats(event.pk)
+    with transaction.atomic(), batchedEventSignals():
+        Event.objects.filter(pk__in = [repeat.pk for repeat in repeats]).delete()
 
     return JsonResponse("Success", safe=False, status = 200)
 
@@ -988,7 +1262,7 @@ def claimEvent(request): #TODO: Frontend should have some sort of check or confi
 
     confirmationToken = default_token_generator.make_token(user)
 
-    send_mail(
+    queueMail(
         "GrinSync Event Claim",
         (f"Hi, this email was sent because { user.first_name } { user.last_name } would like to claim "
          f"overship for { event.title }; an auto-populated event for which you are the contact. If you "
@@ -997,7 +1271,6 @@ def claimEvent(request): #TODO: Frontend should have some sort of check or confi
                 f"token={confirmationToken}&event={event.pk}&newHost={user.pk}"),
         "confirmation@grinsync.com",
         [event.contactEmail],
-        fail_silently=False,
     )
     return JsonResponse("Confirmation Email Sent", safe = False, status = 200)
 